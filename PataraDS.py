@@ -7,14 +7,87 @@ Created on Aug 02, 2018
 from twisted_cut import defer, TangoTwisted
 import logging
 import time
+import os
+import threading
+from collections import OrderedDict
 import numpy as np
 from PyTango.server import Device, DeviceMeta
-from PyTango.server import attribute, command
+from PyTango.server import attribute, command, pipe
 from PyTango.server import device_property
 import PyTango as pt
 from patara_control import PataraControl
+from patara_parameters import PataraDerivedParameter
 from patara_state import StateDispatcher
 
+# Channels with window aggregate attributes: attribute name prefix -> (parameter name, unit)
+AGGREGATE_CHANNELS = {"current": ("channel1_sensed_current_flow", "A"),
+                      "voltage": ("channel1_power_supply_voltage", "V"),
+                      "diode_temperature": ("channel1_temperature", "degC"),
+                      "tec_temperature": ("tec_sensed_temp", "degC"),
+                      "tec_power": ("tec_power", "%"),
+                      "humidity": ("humidity_reading", "%")}
+
+AGGREGATE_STATS = ["min", "max", "mean", "std"]
+
+# Attribute quality for the staleness levels returned by PataraControl.get_staleness
+STALENESS_QUALITY = [pt.AttrQuality.ATTR_VALID, pt.AttrQuality.ATTR_WARNING, pt.AttrQuality.ATTR_INVALID]
+
+# Number of finished operations kept for the operations attribute and operation_status command
+MAX_OPERATIONS = 100
+
+# Polled blocks exposed as raw spectrum attributes: (modbus function, attribute name prefix)
+RAW_BLOCKS = [(1, "raw_coils"), (2, "raw_discrete_inputs"), (4, "raw_input_registers")]
+
+# Attributes with change and archive events pushed from the decode path:
+# parameter name -> list of (attribute name, read method name)
+EVENT_ATTRIBUTES = {"channel1_sensed_current_flow": [("current", "get_current")],
+                    "channel1_power_supply_voltage": [("voltage", "get_voltage")],
+                    "channel1_temperature": [("diode_temperatue", "get_diode_temperature")],
+                    "shutter": [("shutter", "get_shutter")],
+                    "emission": [("emission", "get_emission")],
+                    "humidity_reading": [("humidity", "get_humidity")],
+                    "channel1_pulsed_mode_shot_counter": [("shot_counter", "get_shotcounter")],
+                    "channel1_repetition_rate": [("repetition_rate", "get_repetition_rate")],
+                    "channel1_warranty_timer_rate": [("warranty_timer_rate", "get_warranty_timer_rate")],
+                    "channel1_warranty_timer": [("warranty_timer", "get_warranty_timer")],
+                    "tec_sensed_temp": [("tec_temperatue", "get_tec_temperature")],
+                    "tec_power": [("tec_power", "get_tec_power")]}
+
+# Attributes with events pushed when the state notifier is called: (attribute name, read method name)
+STATE_EVENT_ATTRIBUTES = [("fault_list", "get_fault_list"), ("interlock_list", "get_interlock_list"),
+                          ("drifting_parameters", "get_drifting_parameters")]
+
+# Spectrum attributes where Tango polling detects changes
+POLLED_EVENT_ATTRIBUTES = ["current_history", "voltage_history", "diode_temperature_history",
+                           "tec_power_history", "history_time"]
+
+# Decimals shown for derived parameters, which are not quantized by a register resolution
+DERIVED_DECIMALS = 3
+# Max decimals shown for register parameters
+MAX_DECIMALS = 6
+
+
+def get_parameter_format(p):
+    """
+    Display format of a numeric parameter. Register values are factor * raw + offset with integer
+    raw values, so the format shows the decimals needed for the factor and offset. Derived
+    parameters are rates and get a fixed number of decimals.
+
+    :param p: PataraParameter
+    :return: printf style format string
+    """
+    if isinstance(p, PataraDerivedParameter):
+        return "%.{0}f".format(DERIVED_DECIMALS)
+    decimals = 0
+    for x in [p.factor, p.offset]:
+        for d in range(decimals, MAX_DECIMALS + 1):
+            scaled = abs(x) * 10 ** d
+            if abs(scaled - round(scaled)) < 1e-6 * max(1.0, scaled):
+                break
+        decimals = max(decimals, d)
+    return "%.{0}f".format(decimals)
+
+
 # logger = logging.getLogger("PataraControl")
 # while len(logger.handlers):
 #     logger.removeHandler(logger.handlers[0])
@@ -29,6 +102,10 @@ from patara_state import StateDispatcher
 class PataraDS(Device):
     __metaclass__ = DeviceMeta
 
+    snapshot = pipe(label="snapshot",
+                    doc="All parameters from one controller snapshot: sequence, names, values, "
+                        "timestamps and qualities")
+
     # --- Expert attributes
     #
     warranty_timer = attribute(label='warranty_timer',
@@ -113,6 +190,23 @@ class PataraDS(Device):
                              fget="get_shotcounter",
                              doc="Shot counter", )
 
+    repetition_rate = attribute(label='repetition rate',
+                                dtype=float,
+                                access=pt.AttrWriteType.READ,
+                                unit="shots/s",
+                                format="%8.1f",
+                                fget="get_repetition_rate",
+                                doc="Shot rate calculated from the shot counter", )
+
+    warranty_timer_rate = attribute(label='warranty timer rate',
+                                    dtype=float,
+                                    access=pt.AttrWriteType.READ,
+                                    display_level=pt.DispLevel.EXPERT,
+                                    unit="h/day",
+                                    format="%6.2f",
+                                    fget="get_warranty_timer_rate",
+                                    doc="Hours per day accumulated on the warranty timer", )
+
     tec_temperatue = attribute(label='TEC temperature',
                                dtype=np.float,
                                display_level=pt.DispLevel.EXPERT,
@@ -155,6 +249,86 @@ class PataraDS(Device):
                                fget="get_interlock_list",
                                doc="List of currently active interlocks", )
 
+    drifting_parameters = attribute(label='Drifting parameters',
+                                    dtype=[str],
+                                    access=pt.AttrWriteType.READ,
+                                    max_dim_x=128,
+                                    fget="get_drifting_parameters",
+                                    doc="Parameters whose EWMA baseline has drifted from the running mean by more "
+                                        "than the threshold in the drift_thresholds property. Change events are "
+                                        "pushed when the list changes.", )
+
+    operations = attribute(label='Operations',
+                           dtype=[str],
+                           access=pt.AttrWriteType.READ,
+                           display_level=pt.DispLevel.EXPERT,
+                           max_dim_x=MAX_OPERATIONS,
+                           fget="get_operations",
+                           doc="Recent commands and attribute writes as 'id name status latency [error]'. "
+                               "Status is pending, done or failed, latency in seconds. Change events are "
+                               "pushed when an operation is started or finished.", )
+
+    block_hit_ratios = attribute(label='Block hit ratios',
+                                 dtype=[str],
+                                 access=pt.AttrWriteType.READ,
+                                 display_level=pt.DispLevel.EXPERT,
+                                 max_dim_x=64,
+                                 fget="get_block_hit_ratios",
+                                 doc="Ratio of responses identical to the previous one, where decoding "
+                                     "was skipped, for each polled block as 'func start_address count ratio'", )
+
+    # --- History attributes
+    #
+    current_history = attribute(label='current history',
+                                dtype=[float],
+                                access=pt.AttrWriteType.READ,
+                                display_level=pt.DispLevel.EXPERT,
+                                unit="A",
+                                format="%6.1f",
+                                max_dim_x=100000,
+                                fget="get_current_history",
+                                doc="Diode current history. Sample times in history_time", )
+
+    voltage_history = attribute(label='ps voltage history',
+                                dtype=[float],
+                                access=pt.AttrWriteType.READ,
+                                display_level=pt.DispLevel.EXPERT,
+                                unit="V",
+                                format="%6.1f",
+                                max_dim_x=100000,
+                                fget="get_voltage_history",
+                                doc="Diode power supply voltage history. Sample times in history_time", )
+
+    diode_temperature_history = attribute(label='Diode temperature history',
+                                          dtype=[float],
+                                          access=pt.AttrWriteType.READ,
+                                          display_level=pt.DispLevel.EXPERT,
+                                          unit="degC",
+                                          format="%6.1f",
+                                          max_dim_x=100000,
+                                          fget="get_diode_temperature_history",
+                                          doc="Diode laser head temperature history. Sample times in history_time", )
+
+    tec_power_history = attribute(label='TEC power level history',
+                                  dtype=[float],
+                                  access=pt.AttrWriteType.READ,
+                                  display_level=pt.DispLevel.EXPERT,
+                                  unit="%",
+                                  format="%6.1f",
+                                  max_dim_x=100000,
+                                  fget="get_tec_power_history",
+                                  doc="Thermoelectric cooler power level history. Sample times in history_time", )
+
+    history_time = attribute(label='history time',
+                             dtype=[float],
+                             access=pt.AttrWriteType.READ,
+                             display_level=pt.DispLevel.EXPERT,
+                             unit="s",
+                             format="%12.2f",
+                             max_dim_x=100000,
+                             fget="get_history_time",
+                             doc="Sample timestamps (epoch seconds) of the history attributes", )
+
     # --- Device properties
     #
     ip_address = device_property(dtype=str,
@@ -169,6 +343,88 @@ class PataraDS(Device):
                                doc="Device id",
                                default_value=1)
 
+    history_depth = device_property(dtype=int,
+                                    doc="Number of samples kept in the parameter history (max 100000)",
+                                    default_value=2000)
+
+    history_dir = device_property(dtype=str,
+                                  doc="Directory for persistent history files. A subdirectory is created "
+                                      "for each device. Empty to disable.",
+                                  default_value="")
+
+    history_file_records = device_property(dtype=int,
+                                           doc="Number of records in each persistent history file "
+                                               "before it wraps around",
+                                           default_value=500000)
+
+    compressed_history_size = device_property(dtype=float,
+                                              doc="Maximum size in MB of the compressed raw history kept "
+                                                  "in memory for each polled block. 0 to disable.",
+                                              default_value=0.0)
+
+    fault_capture_dir = device_property(dtype=str,
+                                        doc="Directory for fault capture files with the poll cycles around "
+                                            "a fault. A subdirectory is created for each device. Empty to disable.",
+                                        default_value="")
+
+    pre_trigger_cycles = device_property(dtype=int,
+                                         doc="Number of poll cycles saved before a fault",
+                                         default_value=100)
+
+    post_trigger_cycles = device_property(dtype=int,
+                                          doc="Number of poll cycles saved after a fault",
+                                          default_value=20)
+
+    aggregate_windows = device_property(dtype=[float],
+                                        doc="Window lengths in seconds for min/max/mean/std aggregate attributes",
+                                        default_value=[1.0, 10.0, 60.0])
+
+    ewma_time = device_property(dtype=float,
+                                doc="Time constant in seconds of the EWMA baseline used for drift detection",
+                                default_value=600.0)
+
+    drift_thresholds = device_property(dtype=[str],
+                                       doc="Drift thresholds as parameter_name:threshold. A parameter is "
+                                           "listed in drifting_parameters and the status when the EWMA baseline "
+                                           "differs from its running mean by more than threshold standard "
+                                           "deviations.",
+                                       default_value=[])
+
+    deadbands = device_property(dtype=[str],
+                                doc="Change deadbands as parameter_name:absolute or parameter_name:absolute:relative. "
+                                    "Changes within the deadband do not push events and are not stored in the "
+                                    "compressed history.",
+                                default_value=[])
+
+    default_deadband = device_property(dtype=float,
+                                       doc="Default absolute deadband of measurement parameters, "
+                                           "in units of the register resolution",
+                                       default_value=1.0)
+
+    default_relative_deadband = device_property(dtype=float,
+                                                doc="Default relative deadband of measurement parameters",
+                                                default_value=0.0)
+
+    stale_warning_factor = device_property(dtype=float,
+                                           doc="Attribute quality is WARNING when the value is older than "
+                                               "this number of poll intervals",
+                                           default_value=3.0)
+
+    stale_invalid_factor = device_property(dtype=float,
+                                           doc="Attribute quality is INVALID when the value is older than "
+                                               "this number of poll intervals",
+                                           default_value=10.0)
+
+    default_max_age = device_property(dtype=float,
+                                      doc="Age in seconds after which a parameter outside the polled "
+                                          "ranges is read again when its attribute is read",
+                                      default_value=10.0)
+
+    max_ages = device_property(dtype=[str],
+                               doc="Max age overrides for parameters outside the polled ranges "
+                                   "as parameter_name:seconds",
+                               default_value=[])
+
     def __init__(self, klass, name):
         self.controller = None              # type: PataraControl
         self.setup_attr_params = dict()
@@ -177,6 +433,14 @@ class PataraDS(Device):
         self.analyse_params = dict()
         self.db = None
         self.state_dispatcher = None    # type: StateDispatcher
+        self.aggregate_attr_dict = dict()
+        self.event_read_dict = dict()
+        self.parameter_attr_dict = dict()
+        self.raw_block_attr_dict = dict()
+        # Operation id -> [id, name, status, start time, latency, error]
+        self.operation_dict = OrderedDict()
+        self.operation_counter = 0
+        self.operation_lock = threading.Lock()
         Device.__init__(self, klass, name)
 
     def init_device(self):
@@ -189,14 +453,73 @@ class PataraDS(Device):
                 self.state_dispatcher.stop()
         except Exception as e:
             self.error_info("Error stopping state dispatcher: {0}".format(e))
+        if self.controller is not None:
+            self.controller.stop_staleness_check()
+            self.controller.close_history_stores()
+        if self.history_dir != "":
+            history_dir = os.path.join(self.history_dir, self.get_name().replace("/", "_"))
+        else:
+            history_dir = None
+        if self.fault_capture_dir != "":
+            fault_capture_dir = os.path.join(self.fault_capture_dir, self.get_name().replace("/", "_"))
+        else:
+            fault_capture_dir = None
+        drift_thresholds = dict()
+        for drift_str in self.drift_thresholds:
+            try:
+                name, threshold = drift_str.split(":")
+                drift_thresholds[name.strip()] = float(threshold)
+            except ValueError:
+                self.error_stream("Invalid drift threshold {0}, should be name:threshold".format(drift_str))
+        deadbands = dict()
+        for deadband_str in self.deadbands:
+            try:
+                parts = deadband_str.split(":")
+                if len(parts) == 2:
+                    deadbands[parts[0].strip()] = (float(parts[1]), 0.0)
+                else:
+                    deadbands[parts[0].strip()] = (float(parts[1]), float(parts[2]))
+            except (ValueError, IndexError):
+                self.error_stream("Invalid deadband {0}, should be name:absolute[:relative]".format(deadband_str))
+        max_ages = dict()
+        for max_age_str in self.max_ages:
+            try:
+                name, max_age = max_age_str.split(":")
+                max_ages[name.strip()] = float(max_age)
+            except ValueError:
+                self.error_stream("Invalid max age {0}, should be name:seconds".format(max_age_str))
         try:
-            self.controller = PataraControl(self.ip_address, self.port, self.slave_id)
+            self.controller = PataraControl(self.ip_address, self.port, self.slave_id,
+                                            history_depth=min(self.history_depth, 100000),
+                                            aggregate_windows=self.aggregate_windows,
+                                            history_dir=history_dir,
+                                            history_file_records=self.history_file_records,
+                                            compressed_history_bytes=int(self.compressed_history_size * 1e6),
+                                            fault_capture_dir=fault_capture_dir,
+                                            pre_trigger_cycles=self.pre_trigger_cycles,
+                                            post_trigger_cycles=self.post_trigger_cycles,
+                                            ewma_time=self.ewma_time,
+                                            drift_thresholds=drift_thresholds,
+                                            deadbands=deadbands,
+                                            default_deadband_lsb=self.default_deadband,
+                                            default_relative_deadband=self.default_relative_deadband,
+                                            stale_warning_factor=self.stale_warning_factor,
+                                            stale_invalid_factor=self.stale_invalid_factor,
+                                            default_max_age=self.default_max_age,
+                                            max_ages=max_ages)
             self.controller.add_state_notifier(self.change_state)
         except Exception as e:
             self.error_stream("Error creating Patara controller: {0}".format(e))
             return
 
         self.setup_params()
+        self.setup_aggregate_attributes()
+        self.setup_parameter_attributes()
+        self.setup_raw_block_attributes()
+        self.setup_events()
+        self.controller.add_parameter_notifier(self.push_parameter_events)
+        self.controller.add_register_map_notifier(self.rebuild_map_attributes)
+        self.controller.start_staleness_check()
 
         self.state_dispatcher = StateDispatcher(self.controller)
         self.state_dispatcher.start()
@@ -220,147 +543,479 @@ class PataraDS(Device):
         else:
             tg_state = pt.DevState.UNKNOWN
         self.set_state(tg_state)
-
         if new_status is not None:
             self.set_status(new_status)
+        if not self.event_read_dict:
+            # Events not set up yet
+            return
+        try:
+            self.push_change_event("State", tg_state)
+            self.push_archive_event("State", tg_state)
+            if new_status is not None:
+                self.push_change_event("Status", new_status)
+        except pt.DevFailed as e:
+            self.debug_stream("Error pushing state event: {0}".format(e))
+        for attr_name, read_name in STATE_EVENT_ATTRIBUTES:
+            self.push_attribute_event(attr_name)
 
     def setup_params(self):
         pass
 
+    def setup_aggregate_attributes(self):
+        """
+        Add attributes named <channel>_<stat>_<window>s, e.g. current_mean_10s, for the
+        channels in AGGREGATE_CHANNELS and the windows in the aggregate_windows property.
+        :return:
+        """
+        for attr_prefix, (param_name, unit) in AGGREGATE_CHANNELS.items():
+            for window in self.aggregate_windows:
+                for stat in AGGREGATE_STATS:
+                    attr_name = "{0}_{1}_{2:g}s".format(attr_prefix, stat, window)
+                    if attr_name in self.aggregate_attr_dict:
+                        continue
+                    attr = pt.Attr(attr_name, pt.DevDouble, pt.AttrWriteType.READ)
+                    prop = pt.UserDefaultAttrProp()
+                    prop.set_unit(unit)
+                    prop.set_description("{0} of {1} over {2:g} s windows".format(stat, param_name, window))
+                    attr.set_default_properties(prop)
+                    self.add_attribute(attr, r_meth=self.read_aggregate)
+                    self.aggregate_attr_dict[attr_name] = (param_name, window, stat)
+
+    def setup_parameter_attributes(self):
+        """
+        Add an attribute for each parameter in the register map that is not already exposed by a
+        static attribute (EVENT_ATTRIBUTES) and whose name is not taken by an attribute or command.
+        Coils and holding registers are writable. Each attribute gets its own read method that
+        looks up the parameter in the current snapshot.
+        :return:
+        """
+        device_attr = self.get_device_attr()
+        for name, p in sorted(self.controller.patara_data.parameters.items()):
+            attr_name = name.replace("-", "_")
+            if name in self.parameter_attr_dict or name in EVENT_ATTRIBUTES or hasattr(type(self), attr_name):
+                continue
+            try:
+                device_attr.get_attr_by_name(attr_name)
+                continue
+            except pt.DevFailed:
+                pass
+            func = p.get_function_code()
+            if func in [1, 3]:
+                access = pt.AttrWriteType.READ_WRITE
+                w_meth = self.make_parameter_writer(name)
+            else:
+                access = pt.AttrWriteType.READ
+                w_meth = None
+            if func in [1, 2]:
+                attr = pt.Attr(attr_name, pt.DevBoolean, access)
+                default_value = False
+            else:
+                attr = pt.Attr(attr_name, pt.DevDouble, access)
+                default_value = 0.0
+            prop = pt.UserDefaultAttrProp()
+            prop.set_unit(p.unit)
+            prop.set_description(p.get_description() or name)
+            if func not in [1, 2]:
+                prop.set_format(get_parameter_format(p))
+            attr.set_default_properties(prop)
+            if p.category != "measurement":
+                attr.set_disp_level(pt.DispLevel.EXPERT)
+            self.add_attribute(attr, r_meth=self.make_parameter_reader(name, default_value), w_meth=w_meth)
+            self.parameter_attr_dict[name] = attr_name
+
+    def setup_raw_block_attributes(self):
+        """
+        Add a spectrum attribute with the raw data of each polled block, named <prefix>_<start address>.
+        Registers are uint16, bits are packed eight per uint8 with the first bit in the least
+        significant position. The attribute timestamp is the acquisition time of the block.
+        :return:
+        """
+        read_ranges = {1: self.controller.patara_data.coil_read_range,
+                       2: self.controller.patara_data.discrete_input_read_range,
+                       4: self.controller.patara_data.input_register_read_range}
+        for func, prefix in RAW_BLOCKS:
+            if not read_ranges[func]:
+                continue
+            (min_addr, max_addr, read_rate) = read_ranges[func][0]
+            attr_name = "{0}_{1}".format(prefix, min_addr)
+            if attr_name in self.raw_block_attr_dict:
+                continue
+            count = max_addr - min_addr + 1
+            if func in [1, 2]:
+                attr = pt.SpectrumAttr(attr_name, pt.DevUChar, pt.AttrWriteType.READ, (count + 7) // 8)
+                desc = "Raw bits {0} to {1} packed eight per byte, first bit in the least " \
+                       "significant position".format(min_addr, max_addr)
+            else:
+                attr = pt.SpectrumAttr(attr_name, pt.DevUShort, pt.AttrWriteType.READ, count)
+                desc = "Raw registers {0} to {1}".format(min_addr, max_addr)
+            prop = pt.UserDefaultAttrProp()
+            prop.set_description(desc)
+            attr.set_default_properties(prop)
+            attr.set_disp_level(pt.DispLevel.EXPERT)
+            self.add_attribute(attr, r_meth=self.read_raw_block)
+            self.raw_block_attr_dict[attr_name] = (func, min_addr)
+
+    def rebuild_map_attributes(self, map_name):
+        """
+        Register map notifier. The generated parameter and raw block attributes are removed
+        and added again from the new map, so clients must subscribe to their events again.
+        :param map_name: Name of the new register map
+        :return:
+        """
+        self.info_stream("Register map changed to {0}, rebuilding attributes".format(map_name))
+        for attr_name in list(self.parameter_attr_dict.values()) + list(self.raw_block_attr_dict.keys()):
+            try:
+                self.remove_attribute(attr_name)
+            except pt.DevFailed as e:
+                self.debug_stream("Error removing attribute {0}: {1}".format(attr_name, e))
+        self.parameter_attr_dict = dict()
+        self.raw_block_attr_dict = dict()
+        self.setup_parameter_attributes()
+        self.setup_raw_block_attributes()
+        self.setup_generated_events()
+
+    def read_raw_block(self, attr):
+        (func, min_addr) = self.raw_block_attr_dict[attr.get_name()]
+        block = self.controller.get_raw_block(func, min_addr)
+        if block is None:
+            attr.set_value_date_quality([], time.time(), pt.AttrQuality.ATTR_INVALID)
+        else:
+            attr.set_value_date_quality(block[0], block[1], pt.AttrQuality.ATTR_VALID)
+
+    def make_parameter_reader(self, name, default_value):
+        """
+        Create the read method for a register map attribute.
+        :param name: Parameter name
+        :param default_value: Value sent with INVALID quality before the parameter is read
+        :return: Read method
+        """
+        invalid = pt.AttrQuality.ATTR_INVALID
+
+        def read_parameter(attr):
+            controller = self.controller
+            controller.refresh_parameter(name)
+            p = controller.snapshot.values.get(name)
+            if p is None or p.value is None:
+                attr.set_value_date_quality(default_value, time.time(), invalid)
+            else:
+                attr.set_value_date_quality(p.value, p.timestamp,
+                                            STALENESS_QUALITY[controller.get_staleness(name, p.timestamp)])
+
+        # Tango stores the read method on the device under its function name
+        read_parameter.__name__ = "read_{0}".format(name.replace("-", "_"))
+        return read_parameter
+
+    def make_parameter_writer(self, name):
+        """
+        Create the write method for a writable register map attribute.
+        :param name: Parameter name
+        :return: Write method
+        """
+        def write_parameter(attr):
+            value = attr.get_write_value()
+            self.info_stream("Writing {0} to {1}".format(value, name))
+            op_id = self.start_operation("write_{0}".format(name))
+            d = self.controller.write_parameter(name, value, process_now=True, readback=True)
+            d.addCallbacks(self.command_done, self.command_failed, callbackArgs=(op_id, ), errbackArgs=(op_id, ))
+
+        write_parameter.__name__ = "write_{0}".format(name.replace("-", "_"))
+        return write_parameter
+
+    def setup_events(self):
+        """
+        Enable change and archive events on all attributes. Events for parameter attributes are
+        pushed from the decode path when the value changes, so change detection by Tango is
+        disabled for those. Spectrum and aggregate attributes use Tango change detection on polling.
+        :return:
+        """
+        for attr_list in list(EVENT_ATTRIBUTES.values()) + [STATE_EVENT_ATTRIBUTES]:
+            for attr_name, read_name in attr_list:
+                self.event_read_dict[attr_name] = getattr(self, read_name)
+        for attr_name in ["State", "Status", "operations"] + list(self.event_read_dict.keys()):
+            self.set_change_event(attr_name, True, False)
+            self.set_archive_event(attr_name, True, False)
+        for attr_name in POLLED_EVENT_ATTRIBUTES + list(self.aggregate_attr_dict.keys()):
+            self.set_change_event(attr_name, True, True)
+            self.set_archive_event(attr_name, True, True)
+        self.setup_generated_events()
+
+    def setup_generated_events(self):
+        """
+        Enable events on the attributes generated from the register map.
+        :return:
+        """
+        for attr_name in self.parameter_attr_dict.values():
+            self.set_change_event(attr_name, True, False)
+            self.set_archive_event(attr_name, True, False)
+        for attr_name in self.raw_block_attr_dict.keys():
+            self.set_change_event(attr_name, True, True)
+            self.set_archive_event(attr_name, True, True)
+
+    def push_parameter_events(self, names, snapshot):
+        """
+        Parameter notifier called from the decode path with the names of changed parameters, and
+        from the staleness check with the names of parameters whose quality changed.
+        :param names: List of parameter names
+        :param snapshot: ParameterSnapshot
+        :return:
+        """
+        values = snapshot.values
+        for name in names:
+            for attr_name, read_name in EVENT_ATTRIBUTES.get(name, ()):
+                self.push_attribute_event(attr_name)
+            attr_name = self.parameter_attr_dict.get(name)
+            if attr_name is not None:
+                p = values[name]
+                if p.value is None:
+                    continue
+                quality = STALENESS_QUALITY[self.controller.get_staleness(name, p.timestamp)]
+                try:
+                    self.push_change_event(attr_name, p.value, p.timestamp, quality)
+                    self.push_archive_event(attr_name, p.value, p.timestamp, quality)
+                except pt.DevFailed as e:
+                    self.debug_stream("Error pushing event for {0}: {1}".format(attr_name, e))
+
+    def push_attribute_event(self, attr_name):
+        value, t, q = self.event_read_dict[attr_name]()
+        if value is None:
+            return
+        try:
+            self.push_change_event(attr_name, value, t, q)
+            self.push_archive_event(attr_name, value, t, q)
+        except pt.DevFailed as e:
+            self.debug_stream("Error pushing event for {0}: {1}".format(attr_name, e))
+
+    def send_command(self, cmd, **kwargs):
+        """
+        Send a command to the state handler without waiting for the controller. Completion
+        is tracked as an operation that is updated when the controller deferred fires.
+
+        :param cmd: Command name
+        :return: Operation id
+        """
+        op_id = self.start_operation(cmd)
+        try:
+            d = self.state_dispatcher.send_command(cmd, **kwargs)
+        except Exception as e:
+            self.error_stream("Command {0} failed: {1}".format(cmd, e))
+            self.finish_operation(op_id, "failed", str(e))
+            return op_id
+        # The operation is only done when the state accepted the command and the controller
+        # completed it. Rejected commands arrive here as a failed deferred.
+        d.addCallbacks(self.command_done, self.command_failed, callbackArgs=(op_id, ), errbackArgs=(op_id, ))
+        return op_id
+
+    def command_done(self, result, op_id):
+        self.finish_operation(op_id, "done")
+        return result
+
+    def command_failed(self, err, op_id):
+        self.finish_operation(op_id, "failed", err.getErrorMessage())
+        return None
+
+    def start_operation(self, name):
+        """
+        Register a new pending operation. The oldest operations are dropped when there
+        are more than MAX_OPERATIONS.
+
+        :param name: Command name
+        :return: Operation id
+        """
+        with self.operation_lock:
+            self.operation_counter += 1
+            op_id = self.operation_counter
+            self.operation_dict[op_id] = [op_id, name, "pending", time.time(), None, ""]
+            while len(self.operation_dict) > MAX_OPERATIONS:
+                self.operation_dict.popitem(last=False)
+        self.push_operations_event()
+        return op_id
+
+    def finish_operation(self, op_id, status, error=""):
+        with self.operation_lock:
+            try:
+                op = self.operation_dict[op_id]
+            except KeyError:
+                return
+            op[2] = status
+            op[4] = time.time() - op[3]
+            op[5] = error
+        if status == "failed":
+            self.error_stream("Operation {0} {1} failed: {2}".format(op_id, op[1], error))
+        else:
+            self.debug_stream("Operation {0} {1} {2} in {3:.3f} s".format(op_id, op[1], status, op[4]))
+        self.push_operations_event()
+
+    def push_operations_event(self):
+        value, t, q = self.get_operations()
+        try:
+            self.push_change_event("operations", value, t, q)
+        except pt.DevFailed as e:
+            self.debug_stream("Error pushing operations event: {0}".format(e))
+
+    def get_operations(self):
+        with self.operation_lock:
+            op_list = list(self.operation_dict.values())
+        value = list()
+        for (op_id, name, status, start_time, latency, error) in op_list:
+            latency_str = "-" if latency is None else "{0:.3f}".format(latency)
+            value.append(" ".join([str(op_id), name, status, latency_str, error]).strip())
+        return value, time.time(), pt.AttrQuality.ATTR_VALID
+
+    def get_block_hit_ratios(self):
+        hit_ratios = self.controller.get_block_hit_ratios()
+        value = ["{0} {1} {2} {3:.3f}".format(func, min_addr, count, ratio)
+                 for (func, min_addr, count), ratio in sorted(hit_ratios.items())]
+        return value, time.time(), pt.AttrQuality.ATTR_VALID
+
+    @command(dtype_in=int, dtype_out=pt.DevVarDoubleStringArray,
+             doc_in="Operation id returned by a command",
+             doc_out="[[id, start time, latency], [name, status, error]] Latency is NaN while pending. "
+                     "Status is unknown if the id is not among the recent operations.")
+    def operation_status(self, op_id):
+        with self.operation_lock:
+            op = self.operation_dict.get(op_id)
+            if op is not None:
+                op = list(op)
+        if op is None:
+            return [float(op_id), np.nan, np.nan], ["", "unknown", ""]
+        latency = np.nan if op[4] is None else op[4]
+        return [float(op[0]), op[3], latency], [op[1], op[2], op[5]]
+
     @command
+    def reset_drift_statistics(self):
+        self.info_stream("Resetting drift statistics")
+        self.controller.reset_statistics()
+
+    @command(dtype_out=int, doc_out="Operation id")
     def open(self):
         self.info_stream("Opening shutter")
-        self.state_dispatcher.send_command("open")
+        return self.send_command("open")
 
-    @command
+    @command(dtype_out=int, doc_out="Operation id")
     def close(self):
         self.info_stream("Closing shutter")
-        self.state_dispatcher.send_command("close")
+        return self.send_command("close")
 
-    @command
+    @command(dtype_out=int, doc_out="Operation id")
     def start(self):
         self.info_stream("Laser emission ON")
-        self.state_dispatcher.send_command("start")
+        return self.send_command("start")
 
-    @command
+    @command(dtype_out=int, doc_out="Operation id")
     def stop(self):
         self.info_stream("Laser emission OFF")
-        self.state_dispatcher.send_command("stop")
+        return self.send_command("stop")
 
-    @command
+    @command(dtype_out=int, doc_out="Operation id")
     def clear_fault(self):
         self.info_stream("Sending CLEAR FAULT command")
-        self.state_dispatcher.send_command("clear_fault")
+        return self.send_command("clear_fault")
 
-    def get_current(self):
-        p = self.controller.get_parameter("channel1_sensed_current_flow")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
+    @command(dtype_in=pt.DevVarDoubleStringArray, dtype_out=pt.DevVarDoubleArray,
+             doc_in="[[t], [name1, name2, ...]] Time (epoch seconds) and parameter names",
+             doc_out="[value1, value2, ..., t1, t2, ...] Last value at or before t for each parameter "
+                     "and its timestamp. NaN if not available.")
+    def history_values_at(self, argin):
+        t = argin[0][0]
+        name_list = list(argin[1])
+        (values, timestamps) = self.controller.query_values_at(name_list, t)
+        return np.hstack((values, timestamps))
+
+    @command(dtype_in=pt.DevVarDoubleStringArray, dtype_out=pt.DevVarDoubleArray,
+             doc_in="[[t0, t1], [name1, name2, ...]] Time range (epoch seconds) and parameter names",
+             doc_out="[n1, t1_0, ..., t1_n1-1, v1_0, ..., v1_n1-1, n2, ...] For each parameter the number "
+                     "of samples followed by the sample timestamps and values")
+    def history_range(self, argin):
+        t0 = argin[0][0]
+        t1 = argin[0][1]
+        name_list = list(argin[1])
+        parts = list()
+        for (timestamps, values) in self.controller.query_history(name_list, t0, t1):
+            parts.append(np.array([len(timestamps)], dtype=np.float64))
+            parts.append(timestamps)
+            parts.append(values)
+        return np.hstack(parts)
+
+    def read_parameter_value(self, name):
+        """
+        Read a parameter from the current controller snapshot.
+        :param name: Parameter name
+        :return: Tuple (value, timestamp, quality)
+        """
+        self.controller.refresh_parameter(name)
+        p = self.controller.get_parameter_value(name)
+        if p is None or p.value is None:
+            return None, None, pt.AttrQuality.ATTR_INVALID
+        return p.value, p.timestamp, STALENESS_QUALITY[self.controller.get_staleness(name, p.timestamp)]
+
+    @command(dtype_in=[str], dtype_out=pt.DevVarDoubleStringArray,
+             doc_in="[name1, name2, ...] Parameter names, empty for all parameters",
+             doc_out="[[sequence, n, value1, ..., value_n, t1, ..., t_n, q1, ..., q_n], [name1, ..., name_n]] "
+                     "Values, timestamps and qualities (Tango AttrQuality) from one snapshot. NaN if not read.")
+    def get_snapshot(self, argin):
+        (sequence, names, values, timestamps, qualities) = self.get_snapshot_arrays(list(argin))
+        header = np.array([sequence, len(names)], dtype=np.float64)
+        return np.hstack((header, values, timestamps, qualities)), names
+
+    @command(dtype_in=float, dtype_out=pt.DevVarDoubleStringArray,
+             doc_in="Change token from the previous call, 0 for all parameters. Tokens from another "
+                    "server process or register map return all parameters.",
+             doc_out="[[token, n, value1, ..., value_n, t1, ..., t_n, q1, ..., q_n], [name1, ..., name_n]] "
+                     "Parameters changed since the token, and the new token")
+    def get_changes(self, argin):
+        (token, names, values) = self.controller.get_changes_since(int(argin))
+        n = len(names)
+        packed = np.zeros(2 + 3 * n, dtype=np.float64)
+        packed[0] = token
+        packed[1] = n
+        now = time.time()
+        for ind, p in enumerate(values):
+            if p.value is None:
+                packed[2 + ind] = np.nan
+                packed[2 + n + ind] = np.nan
+                packed[2 + 2 * n + ind] = float(pt.AttrQuality.ATTR_INVALID)
             else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+                packed[2 + ind] = p.value
+                packed[2 + n + ind] = p.timestamp
+                staleness = self.controller.get_staleness(names[ind], p.timestamp, now)
+                packed[2 + 2 * n + ind] = float(STALENESS_QUALITY[staleness])
+        return packed, names
+
+    def read_snapshot(self):
+        (sequence, names, values, timestamps, qualities) = self.get_snapshot_arrays()
+        return "snapshot", dict(sequence=sequence, names=names, values=values,
+                                timestamps=timestamps, qualities=qualities)
+
+    def get_snapshot_arrays(self, name_list=None):
+        (sequence, names, values, timestamps, staleness) = self.controller.get_snapshot_arrays(name_list)
+        qualities = np.array([float(q) for q in STALENESS_QUALITY])[staleness]
+        return sequence, names, values, timestamps, qualities
+
+    def get_current(self):
+        return self.read_parameter_value("channel1_sensed_current_flow")
 
     def set_current(self, current):
         self.info_stream("Setting diode current to {0} A".format(current))
         if 0 <= current < 30:
-            self.state_dispatcher.send_command("set_current", value=current)
+            self.send_command("set_current", value=current)
 
     def get_shutter(self):
-        p = self.controller.get_parameter("shutter")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("shutter")
 
     def get_emission(self):
-        p = self.controller.get_parameter("emission")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("emission")
 
     def get_voltage(self):
-        p = self.controller.get_parameter("channel1_power_supply_voltage")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("channel1_power_supply_voltage")
 
     def get_humidity(self):
-        p = self.controller.get_parameter("humidity_reading")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("humidity_reading")
 
     def get_diode_temperature(self):
-        p = self.controller.get_parameter("channel1_temperature")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("channel1_temperature")
 
     def get_tec_temperature(self):
-        p = self.controller.get_parameter("tec_sensed_temp")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("tec_sensed_temp")
 
     def set_tec_temperature(self, temperature):
         self.info_stream("Setting TEC temperature to {0} degC".format(temperature))
@@ -369,91 +1024,56 @@ class PataraDS(Device):
             # self.state_dispatcher.send_command("set_tec_temperature", value=temperature)
 
     def get_tec_power(self):
-        p = self.controller.get_parameter("tec_power")
-        if p is None:
-            value = None
-            t = None
-            q = pt.AttrQuality.ATTR_INVALID
-        else:
-            value = p.value
-            t = p.timestamp
-            if value is not None:
-                q = pt.AttrQuality.ATTR_VALID
-            else:
-                q = pt.AttrQuality.ATTR_VALID
-        return value, t, q
+        return self.read_parameter_value("tec_power")
 
     def get_shotcounter(self):
-        p = self.controller.get_parameter("channel1_pulsed_mode_shot_counter_low")
-        if p is None:
-            value_low = None
-            t = None
-            q_low = pt.AttrQuality.ATTR_INVALID
-        else:
-            value_low = p.value
-            t = p.timestamp
-            if value_low is not None:
-                q_low = pt.AttrQuality.ATTR_VALID
-            else:
-                q_low = pt.AttrQuality.ATTR_VALID
+        return self.read_parameter_value("channel1_pulsed_mode_shot_counter")
 
-        p = self.controller.get_parameter("channel1_pulsed_mode_shot_counter_high")
-        if p is None:
-            value_high = None
-            t = None
-            q_high = pt.AttrQuality.ATTR_INVALID
-        else:
-            value_high = p.value
-            t = p.timestamp
-            if value_high is not None:
-                q_high = pt.AttrQuality.ATTR_VALID
-            else:
-                q_high = pt.AttrQuality.ATTR_VALID
+    def get_warranty_timer(self):
+        return self.read_parameter_value("channel1_warranty_timer")
 
-        if q_high is pt.AttrQuality.ATTR_VALID and q_low is pt.AttrQuality.ATTR_VALID:
-            q = pt.AttrQuality.ATTR_VALID
-            value = 1e3 * (value_high * 65536 + value_low)
+    def read_history(self, name, timestamps=False):
+        h = self.controller.get_history(name)
+        if h is None:
+            return [], time.time(), pt.AttrQuality.ATTR_INVALID
+        if timestamps is True:
+            value = h[0]
         else:
-            q = pt.AttrQuality.ATTR_INVALID
-            value = None
+            value = h[1]
+        if len(h[0]) > 0:
+            t = h[0][-1]
+        else:
+            t = time.time()
+        return value, t, pt.AttrQuality.ATTR_VALID
 
-        return value, t, q
+    def get_current_history(self):
+        return self.read_history("channel1_sensed_current_flow")
 
-    def get_warranty_timer(self):
-        p = self.controller.get_parameter("channel1_warranty_timer_low")
-        if p is None:
-            value_low = None
-            t = None
-            q_low = pt.AttrQuality.ATTR_INVALID
-        else:
-            value_low = p.value
-            t = p.timestamp
-            if value_low is not None:
-                q_low = pt.AttrQuality.ATTR_VALID
-            else:
-                q_low = pt.AttrQuality.ATTR_VALID
+    def get_voltage_history(self):
+        return self.read_history("channel1_power_supply_voltage")
 
-        p = self.controller.get_parameter("channel1_warranty_timer_high")
-        if p is None:
-            value_high = None
-            t = None
-            q_high = pt.AttrQuality.ATTR_INVALID
-        else:
-            value_high = p.value
-            t = p.timestamp
-            if value_high is not None:
-                q_high = pt.AttrQuality.ATTR_VALID
-            else:
-                q_high = pt.AttrQuality.ATTR_VALID
+    def get_diode_temperature_history(self):
+        return self.read_history("channel1_temperature")
+
+    def get_tec_power_history(self):
+        return self.read_history("tec_power")
+
+    def get_history_time(self):
+        return self.read_history("channel1_sensed_current_flow", timestamps=True)
 
-        if q_high is pt.AttrQuality.ATTR_VALID and q_low is pt.AttrQuality.ATTR_VALID:
-            q = pt.AttrQuality.ATTR_VALID
-            value = (value_high * 65536 + value_low) / 3600.0
+    def read_aggregate(self, attr):
+        (param_name, window, stat) = self.aggregate_attr_dict[attr.get_name()]
+        agg = self.controller.get_aggregate(param_name, window)
+        if agg is None:
+            attr.set_value_date_quality(0.0, time.time(), pt.AttrQuality.ATTR_INVALID)
         else:
-            q = pt.AttrQuality.ATTR_INVALID
-            value = None
+            attr.set_value_date_quality(agg[stat], agg["time"], pt.AttrQuality.ATTR_VALID)
 
-        return value, t, q
+    def get_repetition_rate(self):
+        return self.read_parameter_value("channel1_repetition_rate")
+
+    def get_warranty_timer_rate(self):
+        return self.read_parameter_value("channel1_warranty_timer_rate")
 
     def get_fault_list(self):
         value = self.controller.get_fault_list()
@@ -467,9 +1087,17 @@ class PataraDS(Device):
         t = time.time()
         return value, t, q
 
+    def get_drifting_parameters(self):
+        value = self.controller.get_drift_list()
+        q = pt.AttrQuality.ATTR_VALID
+        t = time.time()
+        return value, t, q
+
     def delete_device(self):
         self.info_stream("In delete_device: closing connection to patara")
+        self.controller.stop_staleness_check()
         self.controller.close_client()
+        self.controller.close_history_stores()
 
 
 if __name__ == "__main__":
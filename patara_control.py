@@ -9,10 +9,14 @@ Created on Jul 25, 2018
 from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 from twisted_cut import defer, TangoTwisted, failure
 import patara_parameters as pp
+import patara_register_map as prm
+import patara_history as ph
 import logging
 import time
 import Queue
 import threading
+import os
+import random
 import numpy as np
 
 reload(pp)
@@ -26,22 +30,180 @@ fh = logging.StreamHandler()
 fh.setFormatter(f)
 logger.addHandler(fh)
 
+# Change tokens are epoch << CHANGE_SEQUENCE_BITS | sequence, kept below 2**53 so that they are
+# exact when passed as a double
+CHANGE_SEQUENCE_BITS = 32
+CHANGE_EPOCH_MAX = 2 ** 20 - 1
+
+
+class ResponseBlock(object):
+    """
+    Keeps the raw payload of the previous response for a polled block of addresses.
+    If a new response is identical to the previous one the decoding can be skipped and
+    only the timestamps of the parameters in the block are refreshed.
+    """
+    def __init__(self, func, min_addr):
+        self.func = func
+        self.min_addr = min_addr
+        self.raw = None
+        self.result = None
+        self.parameters = list()
+        self.names = list()
+        self.history = None     # type: ph.BlockHistory
+        self.aggregator = None  # type: ph.BlockAggregator
+        self.statistics = None  # type: ph.BlockStatistics
+        self.history_store = None   # type: ph.HistoryStore
+        self.compressed_history = None  # type: ph.CompressedHistory
+        self.raw_deadband = None
+        self.raw_reference = None
+        self.raw_array = None
+        self.timestamp = None
+        self.hits = 0
+        self.misses = 0
+
+    def check_payload(self, data, t=None):
+        """
+        Check if data is identical to the stored raw payload. Update hit/miss counters.
+        :param data: List of registers or bits from the response
+        :param t: Acquisition timestamp of the response
+        :return: True if the payload is unchanged
+        """
+        self.timestamp = t
+        if self.raw is not None and data == self.raw:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def store(self, data, result, parameters):
+        self.raw = list(data)
+        self.result = result
+        self.parameters = parameters
+        self.names = [p.name for p in parameters]
+        if self.func in [1, 2]:
+            # Pack bits with the first bit in the least significant position, as in the modbus response
+            bits = np.zeros(8 * ((len(data) + 7) // 8), dtype=np.uint8)
+            bits[:len(data)] = data
+            self.raw_array = np.dot(bits.reshape(-1, 8), 1 << np.arange(8)).astype(np.uint8)
+        else:
+            self.raw_array = np.array(data, dtype=np.uint16)
+
+    def apply_raw_deadband(self, data):
+        """
+        Replace registers that changed less than their deadband since the last significant change
+        with the reference value, so that small fluctuations compress to zero deltas.
+
+        :param data: Raw registers
+        :return: Array of registers
+        """
+        row = np.array(data, dtype=np.int64)
+        reference = self.raw_reference
+        if reference is not None:
+            (absolute, relative) = self.raw_deadband
+            keep = np.abs(row - reference) <= absolute + relative * np.abs(reference)
+            row[keep] = reference[keep]
+        self.raw_reference = row
+        return row
+
+    def invalidate(self):
+        self.raw = None
+
+    def get_hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
 
 class PataraControl(object):
-    def __init__(self, ip="172.16.109.70", port=502, slave_id=1):
+    def __init__(self, ip="172.16.109.70", port=502, slave_id=1, history_depth=2000,
+                 aggregate_windows=(1.0, 10.0, 60.0), history_dir=None, history_file_records=500000,
+                 compressed_history_bytes=0, fault_capture_dir=None, pre_trigger_cycles=100,
+                 post_trigger_cycles=20, ewma_time=600.0, drift_thresholds=None, deadbands=None,
+                 default_deadband_lsb=1.0, default_relative_deadband=0.0, stale_warning_factor=3.0,
+                 stale_invalid_factor=10.0, default_max_age=10.0, max_ages=None, staleness_check_interval=1.0):
         self.client = None
         self.connected = False
         self.read_len = 64
         self.ip = ip
         self.port = port
         self.slave_id = slave_id
-        self.patara_data = pp.PataraHardwareParameters()
+        self.register_map_name = prm.DEFAULT_REGISTER_MAP
+        self.patara_data = pp.PataraHardwareParameters(self.register_map_name)
+
+        # Parameter deadbands, dict name -> (absolute, relative). Parameters not in the dict get
+        # defaults from the register resolution. Changes within the deadband are not sent to
+        # parameter notifiers and not stored in the compressed history.
+        self.deadbands = deadbands
+        self.default_deadband_lsb = default_deadband_lsb
+        self.default_relative_deadband = default_relative_deadband
+        self.patara_data.set_deadbands(deadbands, default_deadband_lsb, default_relative_deadband)
+        # Last value sent to parameter notifiers for each parameter
+        self.notify_reference = dict()
+        # Sequence number of the last significant change of each parameter, used as change token.
+        # Tokens also hold change_epoch, a random number chosen per process and register map, so
+        # that tokens from another process or map are detected and get a full resync.
+        self.change_generation = dict()
+        self.change_epoch = random.randint(1, CHANGE_EPOCH_MAX)
 
         self.command_queue = Queue.Queue()
         self.lock = threading.Lock()
         self.response_pending = False
         self.queue_pending_deferred = None
 
+        # Raw payload of the previous response for each polled block, key (func, min_addr, count)
+        self.response_blocks = dict()
+
+        # Decoded values published as an immutable ParameterSnapshot. A new snapshot is
+        # swapped in after each decoded block, so readers never need a lock.
+        # Each decoded block gets a new sequence number.
+        self.sequence = 0
+        self.snapshot = pp.ParameterSnapshot(0, None, dict())
+        self.publish_lock = threading.Lock()
+
+        # Ring buffer history of analog parameters, one BlockHistory per polled register block.
+        # history_index maps parameter name to BlockHistory and is replaced (not modified) when
+        # a new block is added.
+        self.history_depth = history_depth
+        self.history_index = dict()
+
+        # Aggregates (min, max, mean, std, count) over fixed windows, one BlockAggregator
+        # per polled register block. Indexed by parameter name like the history.
+        self.aggregate_windows = [float(w) for w in aggregate_windows]
+        self.aggregate_index = dict()
+
+        # Running mean/variance and EWMA baseline of analog parameters, one BlockStatistics
+        # per polled register block. Parameters in drift_thresholds with a baseline further
+        # than the threshold from the running mean are listed in drift_list.
+        self.ewma_time = ewma_time
+        if drift_thresholds is None:
+            drift_thresholds = dict()
+        self.drift_thresholds = drift_thresholds
+        self.statistics_index = dict()
+        self.drift_list = list()
+
+        # Persistent raw history in memory mapped files, one HistoryStore per polled block
+        # in history_dir. Disabled if history_dir is None.
+        self.history_dir = history_dir
+        self.history_file_records = history_file_records
+        if history_dir is not None and not os.path.isdir(history_dir):
+            os.makedirs(history_dir)
+
+        # Delta encoded in-memory history of raw block values, one CompressedHistory per polled
+        # block limited to compressed_history_bytes each. Disabled if 0.
+        self.compressed_history_bytes = compressed_history_bytes
+
+        # Pre-trigger capture of the raw values of all polled blocks, saved to fault_capture_dir
+        # when a fault or interlock is first detected. Disabled if fault_capture_dir is None.
+        self.fault_capture_dir = fault_capture_dir
+        self.fault_active = False
+        if fault_capture_dir is not None:
+            if not os.path.isdir(fault_capture_dir):
+                os.makedirs(fault_capture_dir)
+            self.fault_capture = ph.FaultCapture(pre_trigger_cycles, post_trigger_cycles)
+        else:
+            self.fault_capture = None
+
         self.state = "unknown"
         self.com0_state = "unknown"
         self.channel1_state = "unknown"
@@ -49,6 +211,11 @@ class PataraControl(object):
         self.status = ""
         self.active_fault_list = list()
         self.active_interlock_list = list()
+        # Cached status string. status_generation is incremented under status_lock each time the
+        # inputs change, so that a string built from old inputs is not stored after the change.
+        self._status_string = None
+        self.status_generation = 0
+        self.status_lock = threading.Lock()
 
         self.setup_attr_params = dict()
         # self.setup_attr_params["shutter"] = False
@@ -65,7 +232,36 @@ class PataraControl(object):
         self.active_polling_attrs["status"] = 0.3
         self.active_polling_attrs["control"] = 0.5
 
+        # Parameters outside the polled blocks are read on demand by refresh_parameter when
+        # the cached value is older than their max age (max_ages, name -> seconds, or
+        # default_max_age). Reads are done per read range, and pending_reads holds the ranges
+        # with a read in the queue so that concurrent requests share one read. refresh_times
+        # holds the time of the last read of each range, so a range is read at most once per
+        # max age even if the read fails or clients keep asking.
+        self.default_max_age = default_max_age
+        if max_ages is None:
+            max_ages = dict()
+        self.max_ages = max_ages
+        self.pending_reads = set()
+        self.refresh_times = dict()
+
+        # A parameter value is stale (level 1) when it is older than stale_warning_factor
+        # expected update intervals and invalid (level 2) when older than stale_invalid_factor
+        # intervals. The interval is the poll interval, or the max age for parameters read on
+        # demand. stale_limits maps parameter name -> (warning age, invalid age, polled).
+        # check_staleness runs every staleness_check_interval seconds and calls the parameter
+        # notifiers for parameters whose level changed, with the last notified level in
+        # staleness_reference.
+        self.stale_warning_factor = stale_warning_factor
+        self.stale_invalid_factor = stale_invalid_factor
+        self.stale_limits = self.build_stale_limits(self.patara_data)
+        self.staleness_reference = dict()
+        self.staleness_check_interval = staleness_check_interval
+        self.staleness_deferred = None
+
         self.state_notifier_list = list()
+        self.parameter_notifier_list = list()
+        self.register_map_notifier_list = list()
 
         self.logger = logging.getLogger("PataraControl")
         while len(self.logger.handlers):
@@ -98,16 +294,104 @@ class PataraControl(object):
             self.connected = False
         return self.connected
 
+    def select_register_map(self, process_now=True):
+        """
+        Read the system controller firmware version (sc_firmware_version_x/y/z) and
+        select the matching register map. The read ranges (and so the polled blocks)
+        are taken from the selected map. If the version could not be read the current
+        map is kept.
+
+        :param process_now: True if the queue should be processed immediately
+        :return: Deferred that fires with the name of the selected register map
+        """
+        addr_list = [self.patara_data.get_parameter_address(name) for name in
+                     ["sc_firmware_version_x", "sc_firmware_version_y", "sc_firmware_version_z"]]
+        min_addr = min(addr_list)
+        max_addr = max(addr_list)
+        self.logger.debug("Reading firmware version from {0} to {1}".format(min_addr, max_addr))
+        d = self.defer_to_queue(self.client.read_input_registers, min_addr, max_addr - min_addr + 1,
+                                unit=self.slave_id)
+        d.addCallbacks(self.select_register_map_cb, self.select_register_map_eb,
+                       callbackKeywords={"min_addr": min_addr, "addr_list": addr_list})
+        if process_now is True:
+            self.process_queue()
+        return d
+
+    def select_register_map_cb(self, response, min_addr=0, addr_list=None):
+        try:
+            data = response.registers
+        except (ValueError, AttributeError):
+            self.logger.warning("Could not read firmware version: {0}. "
+                                "Keeping register map {1}".format(response, self.register_map_name))
+            return self.register_map_name
+        version = tuple([data[addr - min_addr] for addr in addr_list])
+        map_name = prm.get_register_map_name(version)
+        self.logger.info("Firmware version {0}, using register map {1}".format(version, map_name))
+        if map_name != self.register_map_name:
+            self.set_register_map(map_name)
+        t = time.time()
+        parameters = list()
+        for addr, reg in enumerate(data):
+            self.patara_data.set_parameter_from_modbus_addr(4, addr + min_addr, reg, t)
+            name = self.patara_data.get_name_from_modbus_addr(4, addr + min_addr)
+            if name is not None:
+                parameters.append(self.patara_data.parameters[name])
+        self.publish_parameters(parameters, t)
+        return self.register_map_name
+
+    def select_register_map_eb(self, err):
+        self.logger.warning("Error reading firmware version: {0}. "
+                            "Keeping register map {1}".format(err, self.register_map_name))
+        return self.register_map_name
+
+    def set_register_map(self, map_name):
+        """
+        Replace the parameter store with one built from a different register map.
+        :param map_name: Register map name
+        :return:
+        """
+        patara_data = pp.PataraHardwareParameters(map_name)
+        patara_data.set_deadbands(self.deadbands, self.default_deadband_lsb, self.default_relative_deadband)
+        self.close_history_stores()
+        stale_limits = self.build_stale_limits(patara_data)
+        with self.lock:
+            self.patara_data = patara_data
+            self.register_map_name = map_name
+            self.stale_limits = stale_limits
+            self.response_blocks = dict()
+            self.history_index = dict()
+            self.aggregate_index = dict()
+            self.statistics_index = dict()
+        self.update_drift_list()
+        with self.publish_lock:
+            self.snapshot = pp.ParameterSnapshot(self.sequence, None, dict())
+            self.notify_reference = dict()
+            self.change_generation = dict()
+            self.change_epoch = random.randint(1, CHANGE_EPOCH_MAX)
+            self.staleness_reference = dict()
+        for notifier in self.register_map_notifier_list:
+            notifier(map_name)
+
     def close_client(self):
         """
         Close connection to client
         :return:
         """
         self.logger.info("Close connection to client")
+        dropped = list()
         with self.lock:
+            while self.command_queue.empty() is False:
+                dropped.append(self.command_queue.get_nowait())
             self.command_queue = Queue.Queue()
-        self.cancel_queue_cmd_from_deferred(self.queue_pending_deferred)
+            self.pending_reads = set()
         self.queue_pending_deferred = None
+        # Commands still in the queue will not run. Cancel them so that their callers
+        # get a CancelledError instead of waiting forever.
+        for d in dropped:
+            d.cancel()
+        # Force a full decode of the first responses after reconnect
+        for block in self.response_blocks.values():
+            block.invalidate()
         if self.client is not None:
             self.client.close()
         self.client = None
@@ -179,19 +463,18 @@ class PataraControl(object):
 
     def queue_cb(self, d_called, f, *args, **kwargs):
         """
-        Start thread running function. Copy callbacks from calling
-        deferred and clear them from the calling deferred, stalling
-        callback execution until the thread completes.
+        Start thread running function. The thread deferred is returned, so the
+        calling deferred pauses until the thread completes and then continues
+        its callbacks (also those added later) with the result of the thread.
         :param d_called: Result from callback of d_callback (it sends itself as result)
         :param f: Function to execute in thread
         :param args: Arguments to function
         :param kwargs: Keyword arguments to function
-        :return: Nada
+        :return: Thread deferred
         """
         d = TangoTwisted.defer_to_thread(f, canceller=self.dummy_canceller, *args, **kwargs)
-        d.callbacks = d_called.callbacks
         d.addCallbacks(self.command_done, self.command_error)
-        d_called.callbacks = []
+        return d
 
     def process_queue(self):
         if self.response_pending is False:
@@ -221,9 +504,10 @@ class PataraControl(object):
     def command_done(self, response):
         self.logger.debug("Command done.")
         self.response_pending = False
+        d = self.queue_pending_deferred
         try:
-            if self.queue_pending_deferred.called is False:
-                self.queue_pending_deferred.callback(response)
+            if d is not None and d.called is False:
+                d.callback(response)
         except defer.AlreadyCalledError:
             self.logger.error("Pending deferred already called")
         self.process_queue()
@@ -233,7 +517,9 @@ class PataraControl(object):
     def command_error(self, err):
         self.logger.error(str(err))
         self.response_pending = False
-        self.queue_pending_deferred.errback(err)
+        d = self.queue_pending_deferred
+        if d is not None and d.called is False:
+            d.errback(err)
         return err
 
     def write_parameter(self, name, value, process_now=True, readback=True):
@@ -274,16 +560,17 @@ class PataraControl(object):
 
         d = self.defer_to_queue(f, addr, w_val, unit=self.slave_id)
         # d = defer.Deferred()
-        d.addErrback(self.client_error)
+        d.addErrback(self.write_error)
         if readback is True:
-            d = self.read_parameter(name, process_now)
+            d_read = self.read_parameter(name, process_now)
+            d = defer.DeferredList([d, d_read], fireOnOneErrback=True, consumeErrors=True)
         if process_now is True:
             self.process_queue()
         return d
 
     def clear_fault(self):
         self.logger.info("Sending CLEAR FAULT command")
-        self.write_parameter("clear_fault", True, process_now=True, readback=False)
+        return self.write_parameter("clear_fault", True, process_now=True, readback=False)
 
     def read_parameter(self, name, process_now=True):
         """
@@ -328,6 +615,72 @@ class PataraControl(object):
             self.process_queue()
         return d
 
+    def refresh_parameter(self, name):
+        """
+        Queue a background read of a parameter that is not polled if its cached value is older
+        than its max age. The whole read range containing the parameter is read, and only one
+        read per range is queued at a time. The cached value is used until the read is done.
+
+        :param name: Parameter name
+        :return: True if a read is pending for the parameter
+        """
+        limits = self.stale_limits.get(name)
+        if (limits is not None and limits[2] is True) or self.connected is False:
+            # Polled parameter, or no connection
+            return False
+        t = time.time()
+        max_age = self.max_ages.get(name, self.default_max_age)
+        p = self.snapshot.values.get(name)
+        if p is not None and p.timestamp is not None and t - p.timestamp <= max_age:
+            return False
+        parameter = self.patara_data.parameters.get(name)
+        if parameter is None or parameter.get_function_code() not in [1, 2, 3, 4]:
+            return False
+        func = parameter.get_function_code()
+        addr = parameter.get_address()
+        read_ranges = {1: self.patara_data.coil_read_range,
+                       2: self.patara_data.discrete_input_read_range,
+                       3: self.patara_data.holding_register_read_range,
+                       4: self.patara_data.input_register_read_range}
+        key = (func, addr, addr)
+        for (min_addr, max_addr, read_rate) in read_ranges[func]:
+            if min_addr <= addr <= max_addr:
+                key = (func, min_addr, max_addr)
+                break
+        with self.lock:
+            if key in self.pending_reads:
+                return True
+            if t - self.refresh_times.get(key, 0.0) < max_age:
+                # Range read recently, wait for the max age before trying again
+                return False
+            self.pending_reads.add(key)
+            self.refresh_times[key] = t
+        read_functions = {1: self.client.read_coils,
+                          2: self.client.read_discrete_inputs,
+                          3: self.client.read_holding_registers,
+                          4: self.client.read_input_registers}
+        self.logger.debug("On demand read of {0} to {1}, func {2}".format(key[1], key[2], func))
+        d = self.defer_to_queue(read_functions[func], key[1], key[2] - key[1] + 1, unit=self.slave_id)
+        d.addCallback(self.process_parameters, min_addr=key[1])
+        d.addErrback(self.refresh_error, key)
+        d.addBoth(self.refresh_done, key)
+        self.process_queue()
+        return True
+
+    def refresh_error(self, err, key):
+        """
+        A failed on demand read is only logged. Connection errors are detected by the poll
+        loop, and reconnecting from here would clear the command queue.
+        """
+        self.logger.warning("On demand read of {0} to {1}, func {2} failed: {3}".format(key[1], key[2],
+                                                                                          key[0], err))
+        return None
+
+    def refresh_done(self, result, key):
+        with self.lock:
+            self.pending_reads.discard(key)
+        return result
+
     def read_control_state(self, process_now=True, **kwargs):
         """
         Place a read_coils command on the command queue. Returns a deferred that
@@ -446,6 +799,11 @@ class PataraControl(object):
     def process_parameters(self, response, min_addr=0):
         self.logger.debug("Processing parameters response: {0}".format(response))
         func = response.function_code
+        if func > 0x80:
+            # Modbus exception response, the function code has the error bit set
+            self.logger.warning("Exception response for parameters from {0}, func {1}: {2}".format(
+                min_addr, func & 0x7f, response))
+            return None
         if func == 1 or func == 2:
             data = response.bits
         else:
@@ -454,11 +812,12 @@ class PataraControl(object):
         result = dict()
         for addr, reg in enumerate(data):
             self.logger.debug("Addr: {0}, reg {1}".format(addr + min_addr, reg))
-            if addr == 16:
-                self.logger.info("Read channel1_active_current: {0}".format(reg))
             set_res = self.patara_data.set_parameter_from_modbus_addr(func, addr + min_addr, reg, t)
             self.logger.debug("Set result: {0}".format(set_res))
             name = self.patara_data.get_name_from_modbus_addr(func, addr + min_addr)
+            if name is None:
+                # Unused address inside a read range
+                continue
             try:
                 value = self.patara_data.parameters[name].get_value()
             except KeyError:
@@ -466,8 +825,40 @@ class PataraControl(object):
                 continue
             self.logger.debug("Name: {0}, value: {1}".format(name, value))
             result[name] = value
+        self.publish_parameters([self.patara_data.parameters[name] for name in result], t)
         return result
 
+    def get_response_block(self, func, min_addr, data):
+        key = (func, min_addr, len(data))
+        try:
+            block = self.response_blocks[key]
+        except KeyError:
+            block = ResponseBlock(func, min_addr)
+            self.response_blocks[key] = block
+        return block
+
+    def get_raw_block(self, func, min_addr):
+        """
+        Get the raw data of the last response for a polled block. Registers are returned as
+        uint16, bits packed in uint8 with the first bit in the least significant position.
+
+        :param func: Modbus function code
+        :param min_addr: Start address of the block
+        :return: Tuple (array, timestamp) or None if the block has not been read
+        """
+        for key, block in list(self.response_blocks.items()):
+            if key[0] == func and key[1] == min_addr and block.raw_array is not None:
+                return block.raw_array, block.timestamp
+        return None
+
+    def get_block_hit_ratios(self):
+        """
+        Get the ratio of responses that were identical to the previous response, i.e. where
+        decoding was skipped, for each polled block.
+        :return: Dict with (func, min_addr, count) keys and hit ratio values
+        """
+        return dict([(key, block.get_hit_ratio()) for key, block in self.response_blocks.items()])
+
     def process_control_state(self, response, min_addr=0):
         self.logger.debug("Processing status response: {0}".format(response))
         try:
@@ -475,11 +866,22 @@ class PataraControl(object):
         except ValueError:
             return response
         t = time.time()
+        block = self.get_response_block(1, min_addr, data)
+        if block.check_payload(data, t) is True:
+            sequence = self.publish_parameters([], t, unchanged=block.names)
+            self.persist_block(block, data, t, sequence)
+            return block.result
         result = dict()
+        parameters = list()
         for addr, bit in enumerate(data):
             self.patara_data.set_parameter_from_modbus_addr(1, addr + min_addr, bit, t)
             name = self.patara_data.get_name_from_modbus_addr(1, addr + min_addr)
             result[name] = bit
+            if name is not None:
+                parameters.append(self.patara_data.parameters[name])
+        block.store(data, result, parameters)
+        sequence = self.publish_parameters(parameters, t)
+        self.persist_block(block, data, t, sequence)
         return result
 
     def process_input_registers(self, response, min_addr=0):
@@ -489,19 +891,42 @@ class PataraControl(object):
         except ValueError:
             return response
         t = time.time()
+        block = self.get_response_block(4, min_addr, data)
+        if block.check_payload(data, t) is True:
+            derived = self.patara_data.update_derived_parameters(t, block.names)
+            sequence = self.publish_parameters(derived, t, unchanged=block.names)
+            self.persist_block(block, data, t, sequence)
+            block.history.append_repeat(t, sequence)
+            block.aggregator.add_repeat(t)
+            if block.statistics.add_repeat(t) is True:
+                self.update_drift_list()
+            return block.result
         result = dict()
+        parameters = list()
         for addr, reg in enumerate(data):
             # self.logger.debug("Addr: {0}, reg {1}".format(addr + min_addr, reg))
             self.patara_data.set_parameter_from_modbus_addr(4, addr + min_addr, reg, t)
             # self.logger.debug("Set result: {0}".format(set_res))
             name = self.patara_data.get_name_from_modbus_addr(4, addr + min_addr)
             try:
-                value = self.patara_data.parameters[name].get_value()
+                p = self.patara_data.parameters[name]
             except KeyError:
                 # self.logger.error("KeyError for name {0}, addr {1}".format(name, addr + min_addr))
                 continue
+            value = p.get_value()
             # self.logger.debug("Name: {0}, value: {1}".format(name, value))
             result[name] = value
+            parameters.append(p)
+        for p in self.patara_data.set_composites_from_modbus_block(4, min_addr, data, t):
+            result[p.name] = p.get_value()
+            parameters.append(p)
+        block.store(data, result, parameters)
+        derived = self.patara_data.update_derived_parameters(t)
+        for p in derived:
+            result[p.name] = p.get_value()
+        sequence = self.publish_parameters(parameters + derived, t)
+        self.persist_block(block, data, t, sequence)
+        self.record_history(block, t, sequence)
         return result
 
     def process_status(self, response, min_addr=0):
@@ -511,8 +936,15 @@ class PataraControl(object):
         except ValueError:
             return response
         t = time.time()
+        block = self.get_response_block(2, min_addr, data)
+        if block.check_payload(data, t) is True:
+            # Same bits as last time: state, faults and interlocks are unchanged
+            sequence = self.publish_parameters([], t, unchanged=block.names)
+            self.persist_block(block, data, t, sequence)
+            return response
         faults = list()
         interlocks = list()
+        parameters = list()
         state = None
         channel1_state = None
         shutter_state = None
@@ -521,10 +953,12 @@ class PataraControl(object):
             self.patara_data.set_parameter_from_modbus_addr(2, addr + min_addr, bit, t)
             name = self.patara_data.get_name_from_modbus_addr(2, addr + min_addr)
             try:
-                value = self.patara_data.parameters[name].get_value()
+                p = self.patara_data.parameters[name]
             except KeyError:
                 # self.logger.error("KeyError for name {0}, addr {1}".format(name, addr + min_addr))
                 continue
+            value = p.get_value()
+            parameters.append(p)
             self.logger.debug("Name: {0}, value: {1}".format(name, value))
             if name in ["fault_state", "off_state", "standby_state", "pre-fire_state", "active_state"]:
                 if value is True:
@@ -553,9 +987,18 @@ class PataraControl(object):
             elif "interlock" in name:
                 if value is True:
                     interlocks.append(name)
+        block.store(data, None, parameters)
+        sequence = self.publish_parameters(parameters, t)
+        self.persist_block(block, data, t, sequence)
         self.channel1_state = channel1_state
         self.com0_state = com0_state
         self.set_state(state, shutter_state, faults, interlocks)
+        fault_active = state == "fault_state" or len(faults) > 0 or len(interlocks) > 0
+        if fault_active is True and self.fault_active is False and self.fault_capture is not None:
+            reason = ", ".join([name for name in [state] + faults + interlocks if name is not None])
+            self.logger.info("Fault detected, capturing poll cycles: {0}".format(reason))
+            self.fault_capture.trigger(t, reason)
+        self.fault_active = fault_active
 
         # with self.lock:
         #     self.active_fault_list = faults
@@ -563,9 +1006,627 @@ class PataraControl(object):
         return response
 
     def client_error(self, err):
+        if err.check(defer.CancelledError) is not None:
+            # Dropped from the queue when the client was closed, already reconnecting
+            self.logger.debug("Command cancelled: {0}".format(err))
+            return None
         self.logger.error("Modbus error: {0}".format(err))
         self.init_client()
 
+    def write_error(self, err):
+        """
+        Handle a failed write like client_error, but pass the failure on so that the
+        caller of write_parameter sees it.
+        """
+        self.client_error(err)
+        return err
+
+    def publish_parameters(self, parameters, t, unchanged=None):
+        """
+        Publish decoded parameters in a new snapshot (copy on write) and swap it in.
+        The parameters are tagged with a new sequence number. Readers holding the old
+        snapshot are unaffected.
+
+        Parameters in a block identical to the previous response are passed by name in
+        unchanged. Their values are kept and only the timestamp and sequence number are
+        replaced, without change detection or parameter notifiers. The parameter objects
+        keep the timestamp of their last decode.
+
+        :param parameters: List of PataraParameter that were updated in the same block
+        :param t: Acquisition timestamp of the block
+        :param unchanged: List of names of parameters with unchanged values
+        :return: Sequence number of the block
+        """
+        changed = list()
+        with self.publish_lock:
+            self.sequence += 1
+            sequence = self.sequence
+            values = dict(self.snapshot.values)
+            if unchanged is not None:
+                for name in unchanged:
+                    v = values.get(name)
+                    if v is not None:
+                        values[name] = pp.ParameterValue(v.value, t, sequence)
+            reference = self.notify_reference
+            for p in parameters:
+                values[p.name] = p.get_value_snapshot(sequence)
+                if p.name not in reference or p.is_changed(p.value, reference[p.name]) is True:
+                    reference[p.name] = p.value
+                    self.change_generation[p.name] = sequence
+                    self.staleness_reference[p.name] = 0
+                    changed.append(p.name)
+            snapshot = pp.ParameterSnapshot(sequence, t, values)
+            self.snapshot = snapshot
+        if changed and self.parameter_notifier_list:
+            for notifier in self.parameter_notifier_list:
+                notifier(changed, snapshot)
+        return sequence
+
+    def get_snapshot(self):
+        """
+        Get the current snapshot of decoded parameter values. The values dict must not be modified.
+        :return: ParameterSnapshot(sequence, timestamp, values)
+        """
+        return self.snapshot
+
+    def get_parameter_value(self, name):
+        """
+        Get the last decoded value of a parameter from the current snapshot without locking.
+        :param name: Name of parameter according to Patara eDrive User Manual
+        :return: ParameterValue (value, timestamp, sequence) or None if the parameter has not been read
+        """
+        return self.snapshot.values.get(name)
+
+    def get_parameter_values(self, name_list):
+        """
+        Get the values of several parameters from the same snapshot. If all parameters were
+        decoded from the same block (same poll cycle) the common sequence number and timestamp
+        is returned in the ParameterSet, otherwise they are None and each value carries its own
+        sequence number.
+
+        :param name_list: List of parameter names
+        :return: ParameterSet(sequence, timestamp, values), values is a list of ParameterValue or None
+        """
+        snapshot_values = self.snapshot.values
+        values = [snapshot_values.get(name) for name in name_list]
+        sequences = set([v.sequence if v is not None else None for v in values])
+        if len(sequences) == 1 and None not in sequences:
+            return pp.ParameterSet(values[0].sequence, values[0].timestamp, values)
+        return pp.ParameterSet(None, None, values)
+
+    def get_snapshot_arrays(self, name_list=None):
+        """
+        Get values and timestamps of several parameters from one snapshot as arrays.
+
+        :param name_list: List of parameter names. None or empty for all parameters in the snapshot.
+        :return: Tuple (sequence, names, values, timestamps, staleness). Values and timestamps are float
+                 arrays, NaN for parameters that have not been read. staleness is an int array with
+                 levels as returned by get_staleness.
+        """
+        snapshot = self.snapshot
+        snapshot_values = snapshot.values
+        if not name_list:
+            name_list = sorted(snapshot_values.keys())
+        n = len(name_list)
+        values = np.full(n, np.nan)
+        timestamps = np.full(n, np.nan)
+        staleness = np.full(n, 2, dtype=np.int8)
+        now = time.time()
+        for ind, name in enumerate(name_list):
+            p = snapshot_values.get(name)
+            if p is not None and p.value is not None:
+                values[ind] = p.value
+                timestamps[ind] = p.timestamp
+                staleness[ind] = self.get_staleness(name, p.timestamp, now)
+        return snapshot.sequence, list(name_list), values, timestamps, staleness
+
+    def build_stale_limits(self, patara_data):
+        """
+        Calculate the age limits of the parameters in the polled blocks from their poll interval
+        (the slowest of standby and active polling), and of parameters read on demand from their
+        max age. Derived parameters are refreshed with their source counter and use its limits.
+
+        :param patara_data: PataraHardwareParameters
+        :return: Dict of parameter name -> (warning age, invalid age, polled)
+        """
+        polled = {1: ("control", patara_data.coil_read_range),
+                  2: ("status", patara_data.discrete_input_read_range),
+                  4: ("input_registers", patara_data.input_register_read_range)}
+        limits = dict()
+        for name, p in patara_data.parameters.items():
+            func = p.get_function_code()
+            is_polled = True
+            if isinstance(p, pp.PataraDerivedParameter):
+                continue
+            if func in polled and polled[func][1] and \
+                    polled[func][1][0][0] <= p.get_address() <= polled[func][1][0][1]:
+                # The state handler polls the first read range of each function
+                key = polled[func][0]
+                interval = max(self.standby_polling_attrs[key], self.active_polling_attrs[key])
+            elif func in [1, 2, 3, 4]:
+                is_polled = False
+                interval = self.max_ages.get(name, self.default_max_age)
+            else:
+                continue
+            limits[name] = (self.stale_warning_factor * interval, self.stale_invalid_factor * interval, is_polled)
+        for p in patara_data.derived_parameters:
+            if p.source in limits:
+                limits[p.name] = limits[p.source]
+        return limits
+
+    def get_staleness(self, name, timestamp, now=None):
+        """
+        Classify the age of a parameter value against its poll interval.
+
+        :param name: Parameter name
+        :param timestamp: Timestamp of the value
+        :param now: Current time, None to use time.time()
+        :return: 0 if fresh, 1 if stale, 2 if invalid or never read. Parameters without
+                 age limits are always 0 once read.
+        """
+        if timestamp is None:
+            return 2
+        limits = self.stale_limits.get(name)
+        if limits is None:
+            return 0
+        if now is None:
+            now = time.time()
+        age = now - timestamp
+        if age > limits[1]:
+            return 2
+        if age > limits[0]:
+            return 1
+        return 0
+
+    def check_staleness(self, now=None):
+        """
+        Find the parameters whose staleness level changed since the last check and call the
+        parameter notifiers with them, so that the quality of their attributes is updated
+        without a new value.
+
+        :param now: Current time, None to use time.time()
+        :return: List of parameter names whose staleness level changed
+        """
+        if now is None:
+            now = time.time()
+        changed = list()
+        with self.publish_lock:
+            snapshot = self.snapshot
+            reference = self.staleness_reference
+            for name, p in snapshot.values.items():
+                if p.timestamp is None:
+                    continue
+                staleness = self.get_staleness(name, p.timestamp, now)
+                if staleness != reference.get(name, 0):
+                    reference[name] = staleness
+                    changed.append(name)
+        if changed and self.parameter_notifier_list:
+            self.logger.debug("Staleness changed: {0}".format(changed))
+            for notifier in self.parameter_notifier_list:
+                notifier(changed, snapshot)
+        return changed
+
+    def start_staleness_check(self):
+        """
+        Run check_staleness periodically, every staleness_check_interval seconds.
+        :return:
+        """
+        self.stop_staleness_check()
+        self.staleness_deferred = TangoTwisted.defer_later(self.staleness_check_interval,
+                                                           self.check_staleness)
+        self.staleness_deferred.addCallback(self.staleness_check_done)
+        self.staleness_deferred.addErrback(self.staleness_check_error)
+
+    def staleness_check_done(self, result):
+        if self.staleness_deferred is not None:
+            self.start_staleness_check()
+        return result
+
+    def staleness_check_error(self, err):
+        if err.type != defer.CancelledError:
+            self.logger.error("Error checking staleness: {0}".format(err))
+            if self.staleness_deferred is not None:
+                self.start_staleness_check()
+        return None
+
+    def stop_staleness_check(self):
+        d = self.staleness_deferred
+        self.staleness_deferred = None
+        if d is not None and d.called is False:
+            d.cancel()
+
+    def get_changes_since(self, token):
+        """
+        Get the parameters that changed outside their deadband since a change token. The token is
+        returned by a previous call, 0 for all parameters. It holds the change epoch in the high
+        bits and the sequence number in the low CHANGE_SEQUENCE_BITS bits. A token from another
+        epoch (e.g. from before a restart or register map change) returns all parameters.
+
+        :param token: Change token from a previous call
+        :return: Tuple (new token, list of names, list of ParameterValue)
+        """
+        epoch = token >> CHANGE_SEQUENCE_BITS
+        sequence = token & ((1 << CHANGE_SEQUENCE_BITS) - 1)
+        with self.publish_lock:
+            snapshot = self.snapshot
+            if epoch != self.change_epoch or sequence > snapshot.sequence:
+                sequence = 0
+            names = [name for name, generation in self.change_generation.items() if generation > sequence]
+            new_token = (self.change_epoch << CHANGE_SEQUENCE_BITS) | snapshot.sequence
+        names.sort()
+        return new_token, names, [snapshot.values[name] for name in names]
+
+    def record_history(self, block, t, sequence):
+        """
+        Append the decoded values of a register block to its history ring buffer and
+        window aggregates. These are created the first time the block is decoded.
+
+        :param block: ResponseBlock
+        :param t: Acquisition timestamp
+        :param sequence: Sequence number of the block
+        :return:
+        """
+        history = block.history
+        if history is None:
+            names = [p.name for p in block.parameters]
+            history = ph.BlockHistory(names, self.history_depth)
+            block.history = history
+            block.aggregator = ph.BlockAggregator(names, self.aggregate_windows)
+            block.statistics = ph.BlockStatistics(names, self.ewma_time, self.drift_thresholds)
+            history_index = dict(self.history_index)
+            aggregate_index = dict(self.aggregate_index)
+            statistics_index = dict(self.statistics_index)
+            for name in names:
+                history_index[name] = history
+                aggregate_index[name] = block.aggregator
+                statistics_index[name] = block.statistics
+            self.history_index = history_index
+            self.aggregate_index = aggregate_index
+            self.statistics_index = statistics_index
+        values = [p.value for p in block.parameters]
+        history.append(values, t, sequence)
+        block.aggregator.add(values, t)
+        if block.statistics.add(values, t) is True:
+            self.update_drift_list()
+
+    def update_drift_list(self):
+        """
+        Collect the drifting parameters of all blocks. The list is replaced, not modified,
+        and state notifiers are called if it changed.
+        :return:
+        """
+        drift_list = list()
+        for statistics in set(self.statistics_index.values()):
+            drift_list.extend(statistics.get_drifting())
+        drift_list.sort()
+        if drift_list != self.drift_list:
+            if drift_list:
+                self.logger.warning("Drifting parameters: {0}".format(drift_list))
+            self.drift_list = drift_list
+            self.invalidate_status()
+            self.notify_state()
+
+    def get_drift_list(self):
+        return self.drift_list
+
+    def get_statistics(self, name):
+        """
+        Get the running statistics of an analog parameter since start or the last reset.
+
+        :param name: Parameter name
+        :return: Dict with keys mean, std, ewma, drift, count. None if not available.
+        """
+        try:
+            statistics = self.statistics_index[name]
+        except KeyError:
+            return None
+        return statistics.get_statistics(name)
+
+    def reset_statistics(self):
+        """
+        Restart the running statistics of all blocks, e.g. after a deliberate change of operating point.
+        :return:
+        """
+        for statistics in set(self.statistics_index.values()):
+            statistics.reset()
+        self.update_drift_list()
+
+    def persist_block(self, block, data, t, sequence):
+        """
+        Append the raw values of a block to its persistent history file and compressed
+        history, if enabled. These are created the first time the block is decoded.
+
+        :param block: ResponseBlock
+        :param data: Raw registers or bits of the response
+        :param t: Acquisition timestamp
+        :param sequence: Sequence number of the block
+        :return:
+        """
+        if self.fault_capture is not None:
+            if self.fault_capture.add((block.func, block.min_addr, len(data)), sequence, t, data) is True:
+                self.save_fault_capture()
+        if self.compressed_history_bytes > 0:
+            compressed = block.compressed_history
+            if compressed is None:
+                compressed = ph.CompressedHistory(len(data), max_bytes=self.compressed_history_bytes)
+                block.compressed_history = compressed
+                if block.func in [3, 4]:
+                    block.raw_deadband = self.get_raw_deadbands(block.func, block.min_addr, len(data))
+            # Only the compressed history is deadbanded, the history file keeps the raw values
+            if block.raw_deadband is not None:
+                compressed.append(sequence, t, block.apply_raw_deadband(data))
+            else:
+                compressed.append(sequence, t, data)
+        if self.history_dir is None:
+            return
+        store = block.history_store
+        if store is None:
+            path = os.path.join(self.history_dir, "block_{0}_{1}_{2}.hist".format(block.func, block.min_addr,
+                                                                                  len(data)))
+            try:
+                store = ph.HistoryStore(path, block.func, block.min_addr, len(data), self.history_file_records)
+            except (IOError, OSError, ValueError) as e:
+                self.logger.error("Could not open history file {0}: {1}".format(path, e))
+                self.history_dir = None
+                return
+            block.history_store = store
+        store.append(sequence, t, data)
+
+    def get_raw_deadbands(self, func, min_addr, count):
+        """
+        Convert parameter deadbands to register counts for a block of registers.
+
+        :param func: Modbus function code
+        :param min_addr: First address of the block
+        :param count: Number of registers
+        :return: Tuple (absolute, relative) of arrays, or None if no register has a deadband
+        """
+        absolute = np.zeros(count, dtype=np.float64)
+        relative = np.zeros(count, dtype=np.float64)
+        for ind in range(count):
+            name = self.patara_data.get_name_from_modbus_addr(func, min_addr + ind)
+            p = self.patara_data.parameters.get(name)
+            if p is None or p.factor == 0:
+                continue
+            absolute[ind] = p.deadband / abs(p.factor)
+            relative[ind] = p.relative_deadband
+        if not absolute.any() and not relative.any():
+            return None
+        return absolute, relative
+
+    def get_history_stores(self):
+        """
+        Get the open persistent history stores.
+        :return: Dict with (func, min_addr, count) keys and HistoryStore values
+        """
+        return dict([(key, block.history_store) for key, block in self.response_blocks.items()
+                     if block.history_store is not None])
+
+    def read_stored_history(self, func, min_addr, t0=None, t1=None):
+        """
+        Read raw block values from the persistent history in a time range.
+
+        :param func: Modbus function code of the block
+        :param min_addr: Start address of the block
+        :param t0: Start time, None for the oldest record
+        :param t1: End time, None for the newest record
+        :return: Tuple of NumPy arrays (sequences, timestamps, values[record, register]). None if not stored.
+        """
+        for key, store in self.get_history_stores().items():
+            if key[0] == func and key[1] == min_addr:
+                return store.read_range(t0, t1)
+        return None
+
+    def save_fault_capture(self):
+        """
+        Freeze the fault capture buffers and save them to a file in fault_capture_dir.
+        :return: Path of the saved file, None if saving failed
+        """
+        capture = self.fault_capture.freeze()
+        t = float(capture["trigger_time"])
+        path = os.path.join(self.fault_capture_dir, "fault_{0}_{1:03d}.npz".format(
+            time.strftime("%Y%m%d_%H%M%S", time.localtime(t)), int((t % 1) * 1000)))
+        try:
+            ph.save_fault_capture(path, capture)
+        except (IOError, OSError) as e:
+            self.logger.error("Could not save fault capture {0}: {1}".format(path, e))
+            return None
+        self.logger.info("Saved fault capture {0}".format(path))
+        return path
+
+    def read_compressed_history(self, func, min_addr, t0=None, t1=None):
+        """
+        Reconstruct raw block values from the compressed history in a time range.
+
+        :param func: Modbus function code of the block
+        :param min_addr: Start address of the block
+        :param t0: Start time, None for the oldest record
+        :param t1: End time, None for the newest record
+        :return: Tuple of NumPy arrays (sequences, timestamps, values[record, register]). None if not stored.
+        """
+        for key, block in self.response_blocks.items():
+            if key[0] == func and key[1] == min_addr and block.compressed_history is not None:
+                return block.compressed_history.read_range(t0, t1)
+        return None
+
+    def find_parameter_block(self, name):
+        """
+        Find the polled block containing a parameter. If several polled blocks contain it,
+        the most frequently polled is used.
+
+        :param name: Parameter name
+        :return: Tuple (ResponseBlock, PataraParameter). (None, None) if not polled.
+        """
+        p = self.patara_data.parameters.get(name)
+        if p is None:
+            return None, None
+        if isinstance(p, pp.PataraCompositeParameter):
+            addr_list = p.get_addresses()
+        else:
+            addr_list = [p.get_address()]
+        found = None
+        for key, block in self.response_blocks.items():
+            (func, min_addr, count) = key
+            if func != p.get_function_code():
+                continue
+            if all([min_addr <= addr < min_addr + count for addr in addr_list]):
+                if found is None or block.hits + block.misses > found.hits + found.misses:
+                    found = block
+        if found is None:
+            return None, None
+        return found, p
+
+    def convert_raw_values(self, p, min_addr, raw_values):
+        """
+        Convert raw block values from a stored history to parameter values.
+
+        :param p: PataraParameter
+        :param min_addr: Start address of the block
+        :param raw_values: NumPy array of raw values [record, register]
+        :return: NumPy float array of parameter values
+        """
+        if isinstance(p, pp.PataraCompositeParameter):
+            (high_addr, low_addr) = p.get_addresses()
+            raw = ((raw_values[:, high_addr - min_addr].astype(np.int64) << 16) |
+                   raw_values[:, low_addr - min_addr].astype(np.int64))
+        else:
+            raw = raw_values[:, p.get_address() - min_addr]
+        if p.get_function_code() in [1, 2]:
+            return (raw != 0).astype(np.float64)
+        (factor, offset) = p.get_conversion()
+        return factor * raw.astype(np.float64) + offset
+
+    def query_history_range(self, name, t0=None, t1=None):
+        """
+        Get the history of a parameter in a time range. The in-memory history is used if it
+        covers the range, otherwise the persistent history file or compressed history.
+
+        :param name: Parameter name
+        :param t0: Start time, None for the oldest sample
+        :param t1: End time, None for the newest sample
+        :return: Tuple of NumPy arrays (timestamps, values). Empty arrays if not available.
+        """
+        return self.query_history([name], t0, t1)[0]
+
+    def query_history(self, name_list, t0=None, t1=None):
+        """
+        Get the history of several parameters in a time range. The in-memory history is used
+        if it covers the range, otherwise the persistent history file or compressed history.
+        The names are grouped by polled block, so that the stored history of each block is
+        read (and decompressed) once and all the parameters are converted from that read.
+
+        :param name_list: List of parameter names
+        :param t0: Start time, None for the oldest sample
+        :param t1: End time, None for the newest sample
+        :return: List of (timestamps, values) NumPy array tuples, one per name. Empty arrays if not available.
+        """
+        result = [(np.zeros(0), np.zeros(0)) for name in name_list]
+        # Parameters to read from stored history, ResponseBlock -> list of (index, name, parameter)
+        block_dict = dict()
+        for ind, name in enumerate(name_list):
+            (block, p) = self.find_parameter_block(name)
+            if block is None:
+                continue
+            history = block.history
+            if history is not None and name in history.columns:
+                oldest = history.get_oldest_time()
+                if oldest is not None and t0 is not None and oldest <= t0:
+                    result[ind] = history.read_range(name, t0, t1)
+                    continue
+            block_dict.setdefault(block, list()).append((ind, name, p))
+        for block, param_list in block_dict.items():
+            raw = None
+            for source in [block.history_store, block.compressed_history]:
+                if source is not None:
+                    raw = source.read_range(t0, t1)
+                    break
+            history = block.history
+            for (ind, name, p) in param_list:
+                if raw is not None:
+                    (sequences, timestamps, raw_values) = raw
+                    result[ind] = (timestamps, self.convert_raw_values(p, block.min_addr, raw_values))
+                elif history is not None and name in history.columns:
+                    result[ind] = history.read_range(name, t0, t1)
+        return result
+
+    def query_values_at(self, name_list, t):
+        """
+        Get the values of several parameters at a time, i.e. the last sample at or before t.
+
+        :param name_list: List of parameter names
+        :param t: Time (epoch seconds)
+        :return: Tuple of NumPy arrays (values, timestamps). NaN where no sample is available.
+        """
+        values = np.nan * np.ones(len(name_list))
+        timestamps = np.nan * np.ones(len(name_list))
+        for ind, name in enumerate(name_list):
+            (block, p) = self.find_parameter_block(name)
+            if block is None:
+                continue
+            history = block.history
+            if history is not None and name not in history.columns:
+                history = None
+            result = None
+            if history is not None:
+                oldest = history.get_oldest_time()
+                if oldest is not None and oldest <= t:
+                    result = history.read_at(name, t)
+            if result is None:
+                for source in [block.history_store, block.compressed_history]:
+                    if source is not None:
+                        record = source.read_at(t)
+                        if record is not None:
+                            (sequence, ts, raw_values) = record
+                            value = self.convert_raw_values(p, block.min_addr, np.array([raw_values]))[0]
+                            result = (ts, value)
+                        break
+                else:
+                    if history is not None:
+                        result = history.read_at(name, t)
+            if result is not None:
+                (timestamps[ind], values[ind]) = result
+        return values, timestamps
+
+    def close_history_stores(self):
+        for block in self.response_blocks.values():
+            if block.history_store is not None:
+                block.history_store.close()
+                block.history_store = None
+
+    def get_history(self, name, n=None):
+        """
+        Get the stored history of an analog parameter in chronological order.
+
+        :param name: Parameter name
+        :param n: Number of samples, None for all stored samples
+        :return: Tuple of NumPy arrays (timestamps, values). None if the parameter has no history.
+        """
+        try:
+            history = self.history_index[name]
+        except KeyError:
+            return None
+        return history.get_history(name, n)
+
+    def get_aggregate(self, name, window):
+        """
+        Get min, max, mean, std and count of an analog parameter over the last completed
+        window of the given length. Windows are aligned to multiples of the window length.
+
+        :param name: Parameter name
+        :param window: Window length in seconds, one of aggregate_windows
+        :return: Dict with keys min, max, mean, std, count, time (end of window).
+                 None if not available.
+        """
+        try:
+            aggregator = self.aggregate_index[name]
+        except KeyError:
+            return None
+        try:
+            return aggregator.get_aggregate(name, window)
+        except KeyError:
+            self.logger.error("Window {0} s not in aggregate windows {1}".format(window, self.aggregate_windows))
+            return None
+
     def get_parameter(self, name):
         """
         Get a stored patara parameter with name. If the parameter is not in the dictionary
@@ -573,61 +1634,74 @@ class PataraControl(object):
         :param name: Name of parameter according to Patara eDrive User Manual
         :return: PataraParameter (Retrieve value with .get_value method)
         """
-        with self.lock:
-            try:
-                p = self.patara_data.parameters[name]
-            except KeyError:
-                p = None
-        return p
+        return self.patara_data.parameters.get(name)
 
     def get_parameters(self, name_list):
-        p_list = list()
-        for name in name_list:
-            with self.lock:
-                try:
-                    p = self.patara_data.parameters[name]
-                except KeyError:
-                    p = None
-            p_list.append(p)
-        return p_list
+        parameters = self.patara_data.parameters
+        return [parameters.get(name) for name in name_list]
 
     def get_fault_list(self):
-        with self.lock:
-            # Use copy here
-            fl = self.active_fault_list
-        return fl
+        # The list is replaced, never modified, in set_state so no lock is needed
+        return self.active_fault_list
 
     def get_interlock_list(self):
-        with self.lock:
-            # Use copy here
-            il = self.active_interlock_list
-        return il
+        return self.active_interlock_list
 
     def set_status(self, new_status=None):
         if new_status is not None:
             self.status = new_status
-        for notifier in self.state_notifier_list:
-            new_status = self.get_status()
-            new_state = self.get_state()
-            notifier(new_state, new_status)
+            self.invalidate_status()
+        self.notify_state()
 
     def get_status(self):
-        status = "State: {0}\n\n".format(self.get_state().upper())
-        status += self.status
-        fault_string = ""
-        interlock_string = ""
-        if len(self.active_fault_list) > 0:
-            fault_string = "\n--------------------------------\nActive FAULTS:\n"
-            for fault in self.active_fault_list:
-                fault_string += fault
-                fault_string += "\n"
-        if len(self.active_interlock_list) > 0:
-            interlock_string = "\n--------------------------------\nActive INTERLOCKS:\n"
-            for interlock in self.active_interlock_list:
-                interlock_string += interlock
-                interlock_string += "\n"
-        final_status_string = status + fault_string + interlock_string
-        return final_status_string
+        """
+        Return the status string. It is cached and only rebuilt when one of its inputs
+        (state, status text, fault list, interlock list) has changed.
+        :return: Status string
+        """
+        with self.status_lock:
+            status_string = self._status_string
+            generation = self.status_generation
+        if status_string is None:
+            status_string = self.build_status()
+            with self.status_lock:
+                if generation == self.status_generation:
+                    self._status_string = status_string
+        return status_string
+
+    def invalidate_status(self):
+        with self.status_lock:
+            self.status_generation += 1
+            self._status_string = None
+
+    def build_status(self):
+        state = self.get_state()
+        if state is None:
+            state = "unknown"
+        parts = ["State: {0}\n\n".format(state.upper()), self.status]
+        if self.active_fault_list:
+            parts.append("\n--------------------------------\nActive FAULTS:\n")
+            parts.append("".join(["{0}\n".format(fault) for fault in self.active_fault_list]))
+        if self.active_interlock_list:
+            parts.append("\n--------------------------------\nActive INTERLOCKS:\n")
+            parts.append("".join(["{0}\n".format(interlock) for interlock in self.active_interlock_list]))
+        if self.drift_list:
+            parts.append("\n--------------------------------\nDRIFTING parameters:\n")
+            parts.append("".join(["{0}\n".format(name) for name in self.drift_list]))
+        return "".join(parts)
+
+    def notify_state(self):
+        """
+        Send current state and status to all state notifiers. The status string is
+        generated once and shared between the notifiers.
+        :return:
+        """
+        if not self.state_notifier_list:
+            return
+        new_state = self.get_state()
+        new_status = self.get_status()
+        for notifier in self.state_notifier_list:
+            notifier(new_state, new_status)
 
     def set_state(self, new_state, shutter_state=None, faults=None, interlocks=None):
         notify_state = False
@@ -640,9 +1714,8 @@ class PataraControl(object):
             self.active_interlock_list = interlocks
             notify_state = True
         if notify_state is True:
-            for notifier in self.state_notifier_list:
-                new_status = self.get_status()
-                notifier(new_state, new_status)
+            self.invalidate_status()
+            self.notify_state()
 
     def get_state(self):
         return self.state
@@ -654,6 +1727,26 @@ class PataraControl(object):
         if notifier not in self.state_notifier_list:
             self.state_notifier_list.append(notifier)
 
+    def add_parameter_notifier(self, notifier):
+        """
+        Add a callable notifier(names, snapshot) that is called from the decode path with the
+        names of the parameters whose value changed and the new ParameterSnapshot.
+        :param notifier: Callable
+        :return:
+        """
+        if notifier not in self.parameter_notifier_list:
+            self.parameter_notifier_list.append(notifier)
+
+    def add_register_map_notifier(self, notifier):
+        """
+        Add a callable notifier(map_name) that is called after the register map has been replaced,
+        e.g. when a different map is selected from the firmware version on connect.
+        :param notifier: Callable
+        :return:
+        """
+        if notifier not in self.register_map_notifier_list:
+            self.register_map_notifier_list.append(notifier)
+
 
 if __name__ == "__main__":
     pc = PataraControl("172.16.109.70", 502, 1)
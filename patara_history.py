@@ -0,0 +1,933 @@
+"""
+In-memory history of decoded parameter values. Each polled register block has a
+fixed size ring buffer with one column per parameter in the block, so appending a
+poll cycle is a single row copy into preallocated arrays.
+
+HistoryStore keeps the raw block values in a memory mapped file that survives restarts,
+CompressedHistory keeps them delta encoded in memory, and FaultCapture keeps the last
+poll cycles of all blocks for saving when a fault occurs.
+"""
+
+import os
+import threading
+import numpy as np
+
+
+def search_segments(timestamps, segments, t0=None, t1=None):
+    """
+    Binary search for t0 <= timestamp <= t1 in the chronologically ordered segments of a ring buffer.
+
+    :param timestamps: Timestamp array of the ring buffer
+    :param segments: List of (start, stop) index tuples in chronological order
+    :param t0: Start time, None for the oldest sample
+    :param t1: End time, None for the newest sample
+    :return: List of (start, stop) index tuples within the range
+    """
+    result = list()
+    for (start, stop) in segments:
+        ts = timestamps[start:stop]
+        i0 = 0 if t0 is None else int(np.searchsorted(ts, t0, side="left"))
+        i1 = len(ts) if t1 is None else int(np.searchsorted(ts, t1, side="right"))
+        if i1 > i0:
+            result.append((start + i0, start + i1))
+    return result
+
+
+class BlockHistory(object):
+    """
+    Ring buffer of the decoded values of the parameters in one polled block.
+    Values, timestamps and sequence numbers are stored in preallocated NumPy arrays.
+    """
+
+    def __init__(self, names, depth):
+        """
+
+        :param names: List of parameter names, one column each
+        :param depth: Number of samples to keep
+        """
+        self.names = list(names)
+        self.columns = dict([(name, col) for col, name in enumerate(self.names)])
+        self.depth = depth
+        self.values = np.zeros((depth, len(self.names)), dtype=np.float64)
+        self.timestamps = np.zeros(depth, dtype=np.float64)
+        self.sequences = np.zeros(depth, dtype=np.int64)
+        self.pos = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, values, t, sequence):
+        """
+        Append one sample per column.
+
+        :param values: Sequence of values in column order
+        :param t: Acquisition timestamp
+        :param sequence: Sequence number of the block
+        :return:
+        """
+        with self.lock:
+            pos = self.pos
+            self.values[pos, :] = values
+            self.timestamps[pos] = t
+            self.sequences[pos] = sequence
+            self.pos = (pos + 1) % self.depth
+            if self.count < self.depth:
+                self.count += 1
+
+    def append_repeat(self, t, sequence):
+        """
+        Append a copy of the last sample with a new timestamp. Used when the block
+        was identical to the previous poll.
+
+        :param t: Acquisition timestamp
+        :param sequence: Sequence number of the block
+        :return:
+        """
+        with self.lock:
+            if self.count == 0:
+                return
+            pos = self.pos
+            self.values[pos, :] = self.values[pos - 1, :]
+            self.timestamps[pos] = t
+            self.sequences[pos] = sequence
+            self.pos = (pos + 1) % self.depth
+            if self.count < self.depth:
+                self.count += 1
+
+    def get_order(self, n=None):
+        """
+        Get ring buffer indices of the last n samples in chronological order.
+        Must be called with the lock held.
+        """
+        count = self.count
+        if n is None or n > count:
+            n = count
+        start = (self.pos - n) % self.depth
+        if start + n <= self.depth:
+            return slice(start, start + n)
+        return np.r_[start:self.depth, 0:(start + n) % self.depth]
+
+    def get_history(self, name, n=None):
+        """
+        Get the last n samples of a parameter in chronological order.
+
+        :param name: Parameter name
+        :param n: Number of samples. None for all stored samples.
+        :return: Tuple of NumPy arrays (timestamps, values)
+        """
+        col = self.columns[name]
+        with self.lock:
+            order = self.get_order(n)
+            return self.timestamps[order].copy(), self.values[order, col].copy()
+
+    def get_segments(self):
+        """
+        Ring segments holding valid samples in chronological order. Must be called with lock held.
+        :return: List of (start, stop) index tuples
+        """
+        if self.count < self.depth:
+            return [(0, self.pos)]
+        return [(self.pos, self.depth), (0, self.pos)]
+
+    def read_range(self, name, t0=None, t1=None):
+        """
+        Get the samples of a parameter with t0 <= timestamp <= t1.
+
+        :param name: Parameter name
+        :param t0: Start time, None for the oldest sample
+        :param t1: End time, None for the newest sample
+        :return: Tuple of NumPy arrays (timestamps, values)
+        """
+        col = self.columns[name]
+        with self.lock:
+            ranges = search_segments(self.timestamps, self.get_segments(), t0, t1)
+            timestamps = np.concatenate([self.timestamps[a:b] for (a, b) in ranges] + [np.zeros(0)])
+            values = np.concatenate([self.values[a:b, col] for (a, b) in ranges] + [np.zeros(0)])
+        return timestamps, values
+
+    def read_at(self, name, t):
+        """
+        Get the last sample of a parameter with timestamp <= t.
+
+        :param name: Parameter name
+        :param t: Time
+        :return: Tuple (timestamp, value). None if there is no sample at or before t.
+        """
+        col = self.columns[name]
+        with self.lock:
+            for (start, stop) in reversed(self.get_segments()):
+                ind = int(np.searchsorted(self.timestamps[start:stop], t, side="right")) - 1
+                if ind >= 0:
+                    return float(self.timestamps[start + ind]), float(self.values[start + ind, col])
+        return None
+
+    def get_oldest_time(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            return float(self.timestamps[self.get_segments()[0][0]])
+
+    def get_block_history(self, n=None):
+        """
+        Get the last n samples of all columns in chronological order.
+
+        :param n: Number of samples. None for all stored samples.
+        :return: Tuple of NumPy arrays (timestamps, sequences, values[sample, column])
+        """
+        with self.lock:
+            order = self.get_order(n)
+            return self.timestamps[order].copy(), self.sequences[order].copy(), self.values[order, :].copy()
+
+    def clear(self):
+        with self.lock:
+            self.pos = 0
+            self.count = 0
+
+
+class BlockAggregator(object):
+    """
+    Aggregates (min, max, mean, std, count) of the parameters in one polled block over
+    fixed time windows. Windows are aligned to multiples of the window length. Samples are
+    accumulated incrementally (Welford mean and variance), vectorized over all windows and
+    columns, and the result of the last completed window is kept for each window length.
+    """
+
+    def __init__(self, names, windows):
+        """
+
+        :param names: List of parameter names, one column each
+        :param windows: List of window lengths in seconds
+        """
+        self.names = list(names)
+        self.columns = dict([(name, col) for col, name in enumerate(self.names)])
+        self.windows = [float(w) for w in windows]
+        self.window_index = dict([(w, ind) for ind, w in enumerate(self.windows)])
+        n_w = len(self.windows)
+        n_c = len(self.names)
+        self.window_len = np.array(self.windows, dtype=np.float64)
+        self.window_end = np.zeros(n_w, dtype=np.float64)
+        self.acc_min = np.zeros((n_w, n_c), dtype=np.float64)
+        self.acc_max = np.zeros((n_w, n_c), dtype=np.float64)
+        self.acc_mean = np.zeros((n_w, n_c), dtype=np.float64)
+        self.acc_m2 = np.zeros((n_w, n_c), dtype=np.float64)
+        self.acc_count = np.zeros(n_w, dtype=np.int64)
+        self.delta = np.zeros((n_w, n_c), dtype=np.float64)
+        self.res_min = np.zeros((n_w, n_c), dtype=np.float64)
+        self.res_max = np.zeros((n_w, n_c), dtype=np.float64)
+        self.res_mean = np.zeros((n_w, n_c), dtype=np.float64)
+        self.res_std = np.zeros((n_w, n_c), dtype=np.float64)
+        self.res_count = np.zeros(n_w, dtype=np.int64)
+        self.res_time = np.zeros(n_w, dtype=np.float64)
+        self.last_row = np.zeros(n_c, dtype=np.float64)
+        self.has_sample = False
+        self.lock = threading.Lock()
+        for w in range(n_w):
+            self.reset_window(w)
+
+    def reset_window(self, w):
+        self.acc_min[w, :] = np.inf
+        self.acc_max[w, :] = -np.inf
+        self.acc_mean[w, :] = 0.0
+        self.acc_m2[w, :] = 0.0
+        self.acc_count[w] = 0
+
+    def finish_window(self, w):
+        count = self.acc_count[w]
+        if count > 0:
+            self.res_min[w, :] = self.acc_min[w, :]
+            self.res_max[w, :] = self.acc_max[w, :]
+            self.res_mean[w, :] = self.acc_mean[w, :]
+            self.res_std[w, :] = np.sqrt(self.acc_m2[w, :] / count)
+            self.res_count[w] = count
+            self.res_time[w] = self.window_end[w]
+        self.reset_window(w)
+
+    def add(self, values, t):
+        """
+        Add one sample per column.
+
+        :param values: Sequence of values in column order
+        :param t: Acquisition timestamp
+        :return:
+        """
+        with self.lock:
+            self.last_row[:] = values
+            self.has_sample = True
+            self.accumulate(t)
+
+    def add_repeat(self, t):
+        """
+        Add a copy of the last sample with a new timestamp.
+        :param t: Acquisition timestamp
+        :return:
+        """
+        with self.lock:
+            if self.has_sample is True:
+                self.accumulate(t)
+
+    def accumulate(self, t):
+        if t >= self.window_end.min():
+            for w in np.nonzero(t >= self.window_end)[0]:
+                self.finish_window(w)
+                self.window_end[w] = (np.floor(t / self.window_len[w]) + 1) * self.window_len[w]
+        row = self.last_row
+        np.minimum(self.acc_min, row, out=self.acc_min)
+        np.maximum(self.acc_max, row, out=self.acc_max)
+        self.acc_count += 1
+        np.subtract(row, self.acc_mean, out=self.delta)
+        self.acc_mean += self.delta / self.acc_count[:, np.newaxis]
+        self.acc_m2 += self.delta * (row - self.acc_mean)
+
+    def get_aggregate(self, name, window):
+        """
+        Get the aggregate of a parameter over the last completed window.
+
+        :param name: Parameter name
+        :param window: Window length in seconds
+        :return: Dict with keys min, max, mean, std, count, time (end of window).
+                 None if no window has completed.
+        """
+        col = self.columns[name]
+        w = self.window_index[float(window)]
+        with self.lock:
+            if self.res_count[w] == 0:
+                return None
+            return {"min": float(self.res_min[w, col]), "max": float(self.res_max[w, col]),
+                    "mean": float(self.res_mean[w, col]), "std": float(self.res_std[w, col]),
+                    "count": int(self.res_count[w]), "time": float(self.res_time[w])}
+
+
+class BlockStatistics(object):
+    """
+    Running statistics of the parameters in one polled block since start (or reset): Welford
+    mean and variance, and an exponentially weighted moving average baseline with time
+    constant ewma_time. Drift is the difference between the EWMA baseline and the running mean,
+    and a parameter is flagged as drifting when the absolute drift exceeds its threshold times
+    the running standard deviation.
+    Each sample is O(1), vectorized over the columns of the block.
+    """
+
+    def __init__(self, names, ewma_time=600.0, thresholds=None, min_count=100):
+        """
+
+        :param names: List of parameter names, one column each
+        :param ewma_time: Time constant in seconds of the EWMA baseline
+        :param thresholds: Dict of parameter name -> drift threshold in standard deviations. Parameters
+                           not in the dict, or with a threshold <= 0, are not checked.
+        :param min_count: Number of samples before drift is checked
+        """
+        self.names = list(names)
+        self.columns = dict([(name, col) for col, name in enumerate(self.names)])
+        self.ewma_time = float(ewma_time)
+        self.min_count = min_count
+        n_c = len(self.names)
+        if thresholds is None:
+            thresholds = dict()
+        self.thresholds = np.array([thresholds.get(name, np.inf) for name in self.names], dtype=np.float64)
+        self.thresholds[self.thresholds <= 0] = np.inf
+        self.count = 0
+        self.mean = np.zeros(n_c, dtype=np.float64)
+        self.m2 = np.zeros(n_c, dtype=np.float64)
+        self.ewma = np.zeros(n_c, dtype=np.float64)
+        self.delta = np.zeros(n_c, dtype=np.float64)
+        self.last_row = np.zeros(n_c, dtype=np.float64)
+        self.last_time = None
+        self.drifting = list()
+        self.lock = threading.Lock()
+
+    def add(self, values, t):
+        """
+        Add one sample per column.
+
+        :param values: Sequence of values in column order
+        :param t: Acquisition timestamp
+        :return: True if the list of drifting parameters changed
+        """
+        with self.lock:
+            self.last_row[:] = values
+            return self.accumulate(t)
+
+    def add_repeat(self, t):
+        """
+        Add a copy of the last sample with a new timestamp.
+        :param t: Acquisition timestamp
+        :return: True if the list of drifting parameters changed
+        """
+        with self.lock:
+            if self.last_time is None:
+                return False
+            return self.accumulate(t)
+
+    def accumulate(self, t):
+        row = self.last_row
+        self.count += 1
+        if self.last_time is None:
+            self.ewma[:] = row
+        else:
+            alpha = 1.0 - np.exp(-max(t - self.last_time, 0.0) / self.ewma_time)
+            self.ewma += alpha * (row - self.ewma)
+        self.last_time = t
+        np.subtract(row, self.mean, out=self.delta)
+        self.mean += self.delta / self.count
+        self.m2 += self.delta * (row - self.mean)
+
+        if self.count < self.min_count:
+            return False
+        # |drift| / threshold > std, so that unchecked columns (infinite threshold) never drift
+        std = np.sqrt(self.m2 / self.count)
+        drift_ind = np.nonzero(np.abs(self.ewma - self.mean) / self.thresholds > std)[0]
+        if len(drift_ind) != len(self.drifting) or \
+                [self.names[ind] for ind in drift_ind] != self.drifting:
+            self.drifting = [self.names[ind] for ind in drift_ind]
+            return True
+        return False
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.mean[:] = 0.0
+            self.m2[:] = 0.0
+            self.last_time = None
+            self.drifting = list()
+
+    def get_drifting(self):
+        return self.drifting
+
+    def get_statistics(self, name):
+        """
+        Get the running statistics of a parameter.
+
+        :param name: Parameter name
+        :return: Dict with keys mean, std, ewma, drift, count. None if there are no samples.
+        """
+        col = self.columns[name]
+        with self.lock:
+            if self.count == 0:
+                return None
+            mean = float(self.mean[col])
+            ewma = float(self.ewma[col])
+            return {"mean": mean, "std": float(np.sqrt(self.m2[col] / self.count)),
+                    "ewma": ewma, "drift": ewma - mean, "count": self.count}
+
+
+class HistoryStore(object):
+    """
+    Persistent history of the raw values of one polled block, stored in a memory mapped file.
+
+    The file is a fixed size ring of fixed width records (sequence, timestamp, raw values)
+    after a 64 byte header. Appending a record is a copy into the mapped memory, so there are
+    no system calls on the decode path; the operating system writes the pages back to disk.
+    The sequence field is written last and the header position after the record, so a record
+    interrupted by a crash is never counted. Records are stored in time order around the ring,
+    so time range reads are binary searches on the timestamp column.
+    """
+
+    magic = b"PATHIST1"
+    version = 1
+    header_size = 64
+    header_dtype = np.dtype([("magic", "S8"), ("version", "<u4"), ("func", "<u4"), ("min_addr", "<u4"),
+                             ("n_values", "<u4"), ("capacity", "<u8"), ("pos", "<u8"), ("count", "<u8"),
+                             ("reserved", "<u8", (2,))])
+
+    def __init__(self, path, func=0, min_addr=0, n_values=0, capacity=100000, readonly=False):
+        """
+        Open a history file, creating it if it does not exist or does not match the block layout.
+
+        :param path: File path
+        :param func: Modbus function code of the block
+        :param min_addr: Start address of the block
+        :param n_values: Number of values (registers or bits) in the block
+        :param capacity: Number of records in the ring
+        :param readonly: Open an existing file for reading only, layout is taken from the file
+        """
+        self.path = path
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        if readonly is True:
+            self.open_file(np.memmap(path, dtype=np.uint8, mode="r"))
+            return
+        self.mm = None
+        if os.path.isfile(path):
+            try:
+                mm = np.memmap(path, dtype=np.uint8, mode="r+")
+                header = mm[:self.header_size].view(self.header_dtype)[0]
+                if (header["magic"] == self.magic and header["version"] == self.version and
+                        header["func"] == func and header["min_addr"] == min_addr and
+                        header["n_values"] == n_values and header["capacity"] == capacity and
+                        header["pos"] < capacity and header["count"] <= capacity):
+                    self.open_file(mm)
+                    return
+                del mm
+            except (ValueError, IOError, IndexError):
+                pass
+        self.create_file(func, min_addr, n_values, capacity)
+
+    @classmethod
+    def get_record_dtype(cls, n_values):
+        return np.dtype([("sequence", "<i8"), ("timestamp", "<f8"), ("values", "<u2", (n_values,))])
+
+    def create_file(self, func, min_addr, n_values, capacity):
+        record_dtype = self.get_record_dtype(n_values)
+        size = self.header_size + capacity * record_dtype.itemsize
+        with open(self.path, "wb") as fd:
+            fd.truncate(size)
+        mm = np.memmap(self.path, dtype=np.uint8, mode="r+", shape=(size,))
+        header = mm[:self.header_size].view(self.header_dtype)
+        header["magic"] = self.magic
+        header["version"] = self.version
+        header["func"] = func
+        header["min_addr"] = min_addr
+        header["n_values"] = n_values
+        header["capacity"] = capacity
+        header["pos"] = 0
+        header["count"] = 0
+        mm.flush()
+        self.open_file(mm)
+
+    def open_file(self, mm):
+        self.mm = mm
+        self.header = mm[:self.header_size].view(self.header_dtype)
+        h = self.header[0]
+        self.func = int(h["func"])
+        self.min_addr = int(h["min_addr"])
+        self.n_values = int(h["n_values"])
+        self.capacity = int(h["capacity"])
+        record_dtype = self.get_record_dtype(self.n_values)
+        self.records = mm[self.header_size:self.header_size + self.capacity * record_dtype.itemsize].view(record_dtype)
+
+    def append(self, sequence, t, values):
+        """
+        Append a record. The values are the raw register (or bit) values of the block.
+
+        :param sequence: Sequence number of the block, must be > 0
+        :param t: Acquisition timestamp
+        :param values: Raw values, length n_values
+        :return:
+        """
+        with self.lock:
+            header = self.header
+            pos = int(header["pos"][0])
+            record = self.records[pos:pos + 1]
+            record["sequence"] = 0
+            record["timestamp"] = t
+            record["values"] = values
+            record["sequence"] = sequence
+            header["pos"] = (pos + 1) % self.capacity
+            if header["count"][0] < self.capacity:
+                header["count"] += 1
+
+    def get_segments(self):
+        """
+        Ring segments holding valid records in chronological order. Must be called with lock held.
+        :return: List of (start, stop) index tuples
+        """
+        pos = int(self.header["pos"][0])
+        count = int(self.header["count"][0])
+        if count < self.capacity:
+            return [(0, pos)]
+        return [(pos, self.capacity), (0, pos)]
+
+    def read_range(self, t0=None, t1=None):
+        """
+        Read records with t0 <= timestamp <= t1.
+
+        :param t0: Start time, None for the oldest record
+        :param t1: End time, None for the newest record
+        :return: Tuple of NumPy arrays (sequences, timestamps, values[record, n_values])
+        """
+        with self.lock:
+            ranges = search_segments(self.records["timestamp"], self.get_segments(), t0, t1)
+            parts = [np.array(self.records[a:b]) for (a, b) in ranges]
+        if parts:
+            rec = np.concatenate(parts)
+            rec = rec[rec["sequence"] > 0]
+        else:
+            rec = np.zeros(0, dtype=self.records.dtype)
+        return rec["sequence"], rec["timestamp"], rec["values"]
+
+    def read_at(self, t):
+        """
+        Read the last record with timestamp <= t, with a binary search in the mapped file.
+
+        :param t: Time
+        :return: Tuple (sequence, timestamp, values). None if there is no record at or before t.
+        """
+        with self.lock:
+            for (start, stop) in reversed(self.get_segments()):
+                ind = int(np.searchsorted(self.records["timestamp"][start:stop], t, side="right")) - 1
+                # Skip records interrupted by a crash
+                while ind >= 0:
+                    rec = self.records[start + ind]
+                    if rec["sequence"] > 0:
+                        return int(rec["sequence"]), float(rec["timestamp"]), np.array(rec["values"])
+                    ind -= 1
+        return None
+
+    def get_oldest_time(self):
+        with self.lock:
+            (start, stop) = self.get_segments()[0]
+            if stop <= start:
+                return None
+            return float(self.records["timestamp"][start])
+
+    def flush(self):
+        if self.readonly is False:
+            self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.records = None
+        self.header = None
+        self.mm = None
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def put_varint(buf, n):
+    """
+    Append an unsigned integer to a bytearray as a LEB128 varint.
+    """
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def get_varint(buf, pos):
+    """
+    Read a LEB128 varint from a bytearray.
+    :return: Tuple (value, new position)
+    """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+class CompressedHistory(object):
+    """
+    Compressed history of the raw values of one polled block.
+
+    Records are stored in chunks. Each chunk starts with a keyframe holding all values,
+    followed by delta records holding only the registers that changed since the previous
+    record. Timestamps are stored with ms resolution. All integers are zigzag/varint encoded:
+
+    keyframe: time_ms, sequence, value[0] ... value[n-1]
+    delta:    dt_ms, dsequence, n_changed, (dindex, dvalue) * n_changed
+
+    When the total size exceeds max_bytes the oldest chunk is dropped.
+    """
+
+    def __init__(self, n_values, keyframe_interval=1000, max_bytes=10000000):
+        """
+
+        :param n_values: Number of values (registers or bits) in the block
+        :param keyframe_interval: Number of records per chunk
+        :param max_bytes: Maximum total size of the chunks
+        """
+        self.n_values = n_values
+        self.keyframe_interval = keyframe_interval
+        self.max_bytes = max_bytes
+        self.chunks = list()
+        self.chunk_start_time = list()
+        self.chunk_count = list()
+        self.size = 0
+        self.last_values = None
+        self.last_time_ms = 0
+        self.last_sequence = 0
+        self.lock = threading.Lock()
+
+    def append(self, sequence, t, values):
+        """
+        Append a record.
+
+        :param sequence: Sequence number of the block
+        :param t: Acquisition timestamp
+        :param values: Raw integer values, length n_values
+        :return:
+        """
+        values = [int(v) for v in values]
+        time_ms = int(round(t * 1000))
+        with self.lock:
+            if not self.chunks or self.chunk_count[-1] >= self.keyframe_interval:
+                self.start_chunk(sequence, time_ms, values)
+            else:
+                buf = self.chunks[-1]
+                size = len(buf)
+                put_varint(buf, zigzag(time_ms - self.last_time_ms))
+                put_varint(buf, zigzag(sequence - self.last_sequence))
+                last_values = self.last_values
+                changed = [ind for ind in range(self.n_values) if values[ind] != last_values[ind]]
+                put_varint(buf, len(changed))
+                prev_ind = 0
+                for ind in changed:
+                    put_varint(buf, ind - prev_ind)
+                    put_varint(buf, zigzag(values[ind] - last_values[ind]))
+                    prev_ind = ind
+                self.chunk_count[-1] += 1
+                self.size += len(buf) - size
+            self.last_values = values
+            self.last_time_ms = time_ms
+            self.last_sequence = sequence
+            while self.size > self.max_bytes and len(self.chunks) > 1:
+                self.size -= len(self.chunks.pop(0))
+                self.chunk_start_time.pop(0)
+                self.chunk_count.pop(0)
+
+    def start_chunk(self, sequence, time_ms, values):
+        buf = bytearray()
+        put_varint(buf, zigzag(time_ms))
+        put_varint(buf, zigzag(sequence))
+        for v in values:
+            put_varint(buf, zigzag(v))
+        self.chunks.append(buf)
+        self.chunk_start_time.append(time_ms / 1000.0)
+        self.chunk_count.append(1)
+        self.size += len(buf)
+
+    def decode_chunk(self, buf, count):
+        """
+        Decode a chunk into arrays.
+        :return: Tuple of NumPy arrays (sequences, timestamps, values[record, n_values])
+        """
+        n = self.n_values
+        sequences = np.zeros(count, dtype=np.int64)
+        times_ms = np.zeros(count, dtype=np.int64)
+        values = np.zeros((count, n), dtype=np.int64)
+        (v, pos) = get_varint(buf, 0)
+        time_ms = unzigzag(v)
+        (v, pos) = get_varint(buf, pos)
+        sequence = unzigzag(v)
+        row = [0] * n
+        for ind in range(n):
+            (v, pos) = get_varint(buf, pos)
+            row[ind] = unzigzag(v)
+        sequences[0] = sequence
+        times_ms[0] = time_ms
+        values[0, :] = row
+        for rec in range(1, count):
+            (v, pos) = get_varint(buf, pos)
+            time_ms += unzigzag(v)
+            (v, pos) = get_varint(buf, pos)
+            sequence += unzigzag(v)
+            (n_changed, pos) = get_varint(buf, pos)
+            ind = 0
+            for c in range(n_changed):
+                (v, pos) = get_varint(buf, pos)
+                ind += v
+                (v, pos) = get_varint(buf, pos)
+                row[ind] += unzigzag(v)
+            sequences[rec] = sequence
+            times_ms[rec] = time_ms
+            values[rec, :] = row
+        return sequences, times_ms / 1000.0, values
+
+    def read_range(self, t0=None, t1=None):
+        """
+        Reconstruct the records with t0 <= timestamp <= t1. Only the chunks overlapping
+        the range are decoded.
+
+        :param t0: Start time, None for the oldest record
+        :param t1: End time, None for the newest record
+        :return: Tuple of NumPy arrays (sequences, timestamps, values[record, n_values])
+        """
+        with self.lock:
+            chunk_start = self.chunk_start_time
+            first = 0
+            if t0 is not None:
+                first = max(np.searchsorted(chunk_start, t0, side="right") - 1, 0)
+            last = len(self.chunks)
+            if t1 is not None:
+                last = np.searchsorted(chunk_start, t1, side="right")
+            # Copy the chunks so that decoding can be done without the lock
+            chunks = [(bytearray(self.chunks[ind]), self.chunk_count[ind]) for ind in range(first, last)]
+        parts = [self.decode_chunk(buf, count) for (buf, count) in chunks]
+        if not parts:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64),
+                    np.zeros((0, self.n_values), dtype=np.int64))
+        sequences = np.concatenate([p[0] for p in parts])
+        timestamps = np.concatenate([p[1] for p in parts])
+        values = np.concatenate([p[2] for p in parts])
+        mask = np.ones(len(timestamps), dtype=bool)
+        if t0 is not None:
+            mask &= timestamps >= t0
+        if t1 is not None:
+            mask &= timestamps <= t1
+        return sequences[mask], timestamps[mask], values[mask]
+
+    def read_at(self, t):
+        """
+        Reconstruct the last record with timestamp <= t. Only the chunk containing t is decoded.
+
+        :param t: Time
+        :return: Tuple (sequence, timestamp, values). None if there is no record at or before t.
+        """
+        with self.lock:
+            ind = int(np.searchsorted(self.chunk_start_time, t, side="right")) - 1
+            if ind < 0:
+                return None
+            (buf, count) = (bytearray(self.chunks[ind]), self.chunk_count[ind])
+        (sequences, timestamps, values) = self.decode_chunk(buf, count)
+        rec = int(np.searchsorted(timestamps, t, side="right")) - 1
+        if rec < 0:
+            return None
+        return int(sequences[rec]), float(timestamps[rec]), values[rec]
+
+    def get_size(self):
+        return self.size
+
+    def get_oldest_time(self):
+        with self.lock:
+            if not self.chunk_start_time:
+                return None
+            return self.chunk_start_time[0]
+
+
+class CaptureBuffer(object):
+    """
+    Preallocated ring of raw block values for fault capture.
+    """
+
+    def __init__(self, n_values, capacity):
+        self.capacity = capacity
+        self.values = np.zeros((capacity, n_values), dtype=np.uint16)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.sequences = np.zeros(capacity, dtype=np.int64)
+        self.pos = 0
+        self.count = 0
+        self.post_count = 0
+
+    def append(self, sequence, t, values):
+        pos = self.pos
+        self.values[pos, :] = values
+        self.timestamps[pos] = t
+        self.sequences[pos] = sequence
+        self.pos = (pos + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def get_records(self):
+        """
+        Get the stored records in chronological order.
+        :return: Tuple of NumPy arrays (sequences, timestamps, values[record, n_values])
+        """
+        start = (self.pos - self.count) % self.capacity
+        order = (start + np.arange(self.count)) % self.capacity
+        return self.sequences[order], self.timestamps[order], self.values[order, :]
+
+
+class FaultCapture(object):
+    """
+    Rolling pre-trigger buffer of the raw values of every polled block. When triggered, the
+    buffers keep filling for post_trigger cycles and are then frozen and returned for saving.
+    Each buffer holds pre_trigger + post_trigger records, so the post-trigger records never
+    overwrite the pre-trigger records.
+    """
+
+    def __init__(self, pre_trigger=100, post_trigger=20, post_trigger_timeout=30.0):
+        """
+
+        :param pre_trigger: Number of poll cycles to keep before the trigger, for each block
+        :param post_trigger: Number of poll cycles to capture after the trigger, for each block
+        :param post_trigger_timeout: Maximum time in seconds to wait for the post-trigger cycles
+        """
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.post_trigger_timeout = post_trigger_timeout
+        self.buffers = dict()
+        self.triggered = False
+        self.trigger_time = None
+        self.trigger_reason = None
+        self.lock = threading.Lock()
+
+    def add(self, key, sequence, t, values):
+        """
+        Add the raw values of a block.
+
+        :param key: Block key (func, min_addr, count)
+        :param sequence: Sequence number of the block
+        :param t: Acquisition timestamp
+        :param values: Raw values
+        :return: True if a triggered capture is complete and should be frozen
+        """
+        with self.lock:
+            try:
+                buf = self.buffers[key]
+            except KeyError:
+                buf = CaptureBuffer(len(values), self.pre_trigger + self.post_trigger)
+                self.buffers[key] = buf
+            buf.append(sequence, t, values)
+            if self.triggered is False:
+                return False
+            buf.post_count += 1
+            if t - self.trigger_time > self.post_trigger_timeout:
+                return True
+            return all([b.post_count >= self.post_trigger for b in self.buffers.values()])
+
+    def trigger(self, t, reason):
+        """
+        Trigger a capture. Ignored if a capture is already in progress.
+
+        :param t: Trigger time
+        :param reason: Description of the trigger, e.g. the active faults
+        :return: True if the capture was started
+        """
+        with self.lock:
+            if self.triggered is True:
+                return False
+            self.triggered = True
+            self.trigger_time = t
+            self.trigger_reason = reason
+            for buf in self.buffers.values():
+                buf.post_count = 0
+            return True
+
+    def freeze(self):
+        """
+        Copy out the captured records and rearm the trigger.
+        :return: Dict of NumPy arrays suitable for np.savez
+        """
+        with self.lock:
+            result = {"trigger_time": np.array(self.trigger_time), "trigger_reason": np.array(self.trigger_reason)}
+            for key, buf in self.buffers.items():
+                (sequences, timestamps, values) = buf.get_records()
+                prefix = "block_{0}_{1}_{2}".format(*key)
+                result[prefix + "_sequence"] = sequences
+                result[prefix + "_timestamp"] = timestamps
+                result[prefix + "_values"] = values
+            self.triggered = False
+        return result
+
+
+def save_fault_capture(path, capture):
+    """
+    Save a frozen fault capture to a compressed .npz file.
+
+    :param path: File path
+    :param capture: Dict from FaultCapture.freeze
+    :return:
+    """
+    with open(path, "wb") as fd:
+        np.savez_compressed(fd, **capture)
+
+
+def load_fault_capture(path):
+    """
+    Load a fault capture file.
+
+    :param path: File path
+    :return: Dict of NumPy arrays. Keys trigger_time, trigger_reason and
+             block_<func>_<min_addr>_<count>_sequence/_timestamp/_values for each block.
+    """
+    data = np.load(path)
+    return dict([(key, data[key]) for key in data.files])
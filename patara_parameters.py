@@ -4,12 +4,27 @@ Created on Jul 25, 2018
 @author: Filip Lindau
 """
 import time
+from collections import namedtuple
+import patara_register_map as prm
 
 
 class PataraError(Exception):
     pass
 
 
+# Immutable copy of a decoded parameter value, published in the controller snapshot.
+# sequence is the number of the decoded block (poll cycle) the value came from.
+ParameterValue = namedtuple("ParameterValue", ["value", "timestamp", "sequence"])
+
+# Snapshot of all decoded values. sequence and timestamp are those of the latest decoded block,
+# values is a dict name -> ParameterValue.
+ParameterSnapshot = namedtuple("ParameterSnapshot", ["sequence", "timestamp", "values"])
+
+# Set of parameter values read from one snapshot. sequence and timestamp are common to all values
+# if they were decoded from the same block, otherwise None.
+ParameterSet = namedtuple("ParameterSet", ["sequence", "timestamp", "values"])
+
+
 class PataraParameter(object):
     """
     Stores a parameter. Identified by name. Optional read_rate can be used to indicate
@@ -38,6 +53,10 @@ class PataraParameter(object):
         self.desc = desc
         self.function = func
         self.address = address
+        self.category = None
+        self.unit = ""
+        self.deadband = 0.0
+        self.relative_deadband = 0.0
 
     def get_name(self):
         return self.name
@@ -59,6 +78,9 @@ class PataraParameter(object):
     def get_value(self):
         return self.value
 
+    def get_value_snapshot(self, sequence=None):
+        return ParameterValue(self.value, self.timestamp, sequence)
+
     def set_conversion(self, factor, offset):
         self.factor = factor
         self.offset = offset
@@ -84,6 +106,34 @@ class PataraParameter(object):
     def get_function_code(self):
         return self.function
 
+    def set_deadband(self, deadband, relative_deadband=0.0):
+        """
+        Set the change threshold used for events, notifiers and history compression.
+        A change is significant if abs(value - reference) > deadband + relative_deadband * abs(reference).
+
+        :param deadband: Absolute deadband in parameter units
+        :param relative_deadband: Deadband relative to the reference value
+        :return:
+        """
+        self.deadband = abs(deadband)
+        self.relative_deadband = abs(relative_deadband)
+
+    def get_deadband(self):
+        return self.deadband, self.relative_deadband
+
+    def is_changed(self, value, reference):
+        """
+        Check if value differs significantly from reference.
+        :param value: New value
+        :param reference: Last value considered changed
+        :return: True if the change is outside the deadband
+        """
+        if value is None or reference is None or (self.deadband == 0.0 and self.relative_deadband == 0.0):
+            return value != reference
+        threshold = self.deadband + self.relative_deadband * abs(reference)
+        # Small tolerance so that a deadband of whole register steps is not crossed by rounding
+        return abs(value - reference) > threshold * (1.0 + 1e-9)
+
     def __eq__(self, other):
         return self.name == other
 
@@ -95,6 +145,115 @@ class PataraParameter(object):
         return s
 
 
+class PataraCompositeParameter(PataraParameter):
+    """
+    32 bit unsigned parameter composed of a high and a low 16 bit register word. The
+    value is only updated when both words are decoded from the same response block, so
+    the high and low words always come from the same transaction.
+    """
+
+    def __init__(self, name, high_address, low_address, func, conversion_factor=1.0, read_rate=-1.0, desc=None):
+        """
+
+        :param name: Parameter name
+        :param high_address: Modbus address of the high word
+        :param low_address: Modbus address of the low word
+        :param func: Modbus function (3=holding register, 4=input register)
+        :param conversion_factor: Factor applied to the combined 32 bit value
+        :param read_rate:
+        :param desc: Description string
+        """
+        PataraParameter.__init__(self, name, address=high_address, func=func, conversion_factor=conversion_factor,
+                                 read_rate=read_rate, desc=desc)
+        self.high_address = high_address
+        self.low_address = low_address
+
+    def set_words(self, high_word, low_word, timestamp=None):
+        self.set_value((int(high_word) << 16) | int(low_word), timestamp)
+
+    def get_addresses(self):
+        return self.high_address, self.low_address
+
+
+class PataraDerivedParameter(PataraParameter):
+    """
+    Rate of change of a counter parameter. The counter is only known to the resolution of its
+    LSB, so the rate is measured between samples where the counter changed: the counts between
+    two changes are exact, and the time between them is known to within the poll interval. A new
+    rate is calculated at the first counter change at least min_interval seconds after the
+    previous one, so the window grows at low rates. If the counter does not change for
+    max_interval seconds the rate is set to 0. Counter wraparound is handled modulo the counter
+    range. A decreasing counter (reset) restarts the rate calculation.
+    """
+
+    def __init__(self, name, source, conversion_factor=1.0, modulus=2**32, min_interval=10.0, max_interval=3600.0,
+                 desc=None):
+        """
+
+        :param name: Parameter name
+        :param source: Name of the counter parameter
+        :param conversion_factor: Factor converting raw counts per second to the rate unit
+        :param modulus: Counter range
+        :param min_interval: Minimum time between counter changes used for the rate
+        :param max_interval: Time without counter changes after which the rate is 0
+        :param desc: Description string
+        """
+        PataraParameter.__init__(self, name, address=None, func=None, conversion_factor=conversion_factor,
+                                 read_rate=-1.0, desc=desc)
+        self.source = source
+        self.modulus = modulus
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # Last counter sample and the time it last changed
+        self.last_raw = None
+        self.change_time = None
+        # Counter value and time at the change starting the current window
+        self.ref_raw = None
+        self.ref_time = None
+
+    def update(self, raw_value, t):
+        """
+        Update the rate from a new counter sample. Once a rate is known every sample refreshes
+        the timestamp, so the rate is as fresh as the counter.
+
+        :param raw_value: Raw counter value
+        :param t: Sample timestamp
+        :return: True if the parameter was updated
+        """
+        if raw_value is None:
+            return False
+        if self.last_raw is None:
+            self.last_raw = raw_value
+            self.change_time = t
+            return False
+        delta = (raw_value - self.last_raw) % self.modulus
+        if delta == 0:
+            if t - self.change_time >= self.max_interval:
+                # Counter stopped, start a new window at the next change
+                self.ref_raw = None
+                self.raw_value = 0
+                self.value = 0.0
+        else:
+            self.last_raw = raw_value
+            self.change_time = t
+            if delta > self.modulus // 2:
+                # Counter was reset, not wrapped
+                self.ref_raw = None
+            elif self.ref_raw is None:
+                self.ref_raw = raw_value
+                self.ref_time = t
+            elif t - self.ref_time >= self.min_interval:
+                counts = (raw_value - self.ref_raw) % self.modulus
+                self.raw_value = counts
+                self.value = self.factor * counts / (t - self.ref_time)
+                self.ref_raw = raw_value
+                self.ref_time = t
+        if self.value is None:
+            return False
+        self.timestamp = t
+        return True
+
+
 class PataraHardwareParameters(object):
     """
     Holds parameters for the Patara. They are stored in the parameters dict.
@@ -107,12 +266,24 @@ class PataraHardwareParameters(object):
     For registers with numeric values, the conversion factor and offset is stored in
     the PataraParameter object.
 
+    32 bit values spread over a high and a low register are stored as composite parameters
+    in the composite_table dicts (keyed on function code). They are decoded with
+    set_composites_from_modbus_block when both words are present in the same response.
+
     The _read_range lists store which parameters should be read continuously (most only make
     sense to read once or never).
+
+    The parameters, tables and read ranges are created from a register map file, see
+    patara_register_map.
     """
 
-    def __init__(self):
+    def __init__(self, register_map=prm.DEFAULT_REGISTER_MAP):
+        """
+
+        :param register_map: Name of a register map in the register_maps directory or path to a map file
+        """
         self.parameters = dict()
+        self.register_map = None    # type: prm.PataraRegisterMap
         self.coil_table = dict()
         self.coil_read_range = None
         self.discrete_input_table = dict()
@@ -121,11 +292,129 @@ class PataraHardwareParameters(object):
         self.input_register_read_range = None
         self.holding_register_table = dict()
         self.holding_register_read_range = None
+        self.composite_table = {3: list(), 4: list()}
+        self.derived_parameters = list()
 
-        self.init_coils()
-        self.init_discrete()
-        self.init_holding_registers()
-        self.init_input_registers()
+        self.init_parameters(register_map)
+        self.init_derived_parameters()
+
+    def init_parameters(self, register_map):
+        """
+        Create parameters from a compiled register map. The address tables and read ranges
+        are shared with the compiled map and must not be modified.
+
+        :param register_map: Name of a register map in the register_maps directory or path to a map file
+        :return:
+        """
+        reg_map = prm.load_register_map(register_map)
+        self.register_map = reg_map
+        self.coil_table = reg_map.tables[1]
+        self.discrete_input_table = reg_map.tables[2]
+        self.holding_register_table = reg_map.tables[3]
+        self.input_register_table = reg_map.tables[4]
+        self.coil_read_range = reg_map.read_ranges[1]
+        self.discrete_input_read_range = reg_map.read_ranges[2]
+        self.holding_register_read_range = reg_map.read_ranges[3]
+        self.input_register_read_range = reg_map.read_ranges[4]
+
+        self.parameters = dict()
+        for (name, func, addr, factor, offset, read_rate, category, desc) in reg_map.parameter_specs:
+            p = PataraParameter(name, address=addr, func=func, conversion_factor=factor, read_rate=read_rate,
+                                desc=desc)
+            p.offset = offset
+            p.category = category
+            p.unit = reg_map.units.get(name, "")
+            self.parameters[name] = p
+
+        self.composite_table = {3: list(), 4: list()}
+        for (name, func, high_addr, low_addr, factor, offset, read_rate, category, desc) in reg_map.composite_specs:
+            p = PataraCompositeParameter(name, high_address=high_addr, low_address=low_addr, func=func,
+                                         conversion_factor=factor, read_rate=read_rate, desc=desc)
+            p.offset = offset
+            p.category = category
+            p.unit = reg_map.units.get(name, "")
+            self.composite_table[func].append(p)
+            self.parameters[name] = p
+
+    def init_derived_parameters(self):
+        name = "channel1_repetition_rate"
+        desc = "Channel 1 shot rate in shots/s, from channel1_pulsed_mode_shot_counter"
+        self.add_derived_parameter(name, "channel1_pulsed_mode_shot_counter", min_interval=10.0, desc=desc,
+                                   unit="shots/s")
+
+        name = "channel1_warranty_timer_rate"
+        desc = "Channel 1 warranty timer accumulation in hours per day, from channel1_warranty_timer"
+        self.add_derived_parameter(name, "channel1_warranty_timer", scale=86400.0, min_interval=600.0, desc=desc,
+                                   unit="h/day")
+
+    def add_derived_parameter(self, name, source, scale=1.0, min_interval=10.0, max_interval=3600.0, desc=None,
+                              unit=""):
+        """
+        Add a rate parameter derived from a 32 bit counter parameter. The rate is
+        source conversion factor * scale * raw counts per second.
+
+        :param name: Parameter name
+        :param source: Name of the counter parameter
+        :param scale: Factor converting source units per second to the rate unit
+        :param min_interval: Minimum time between counter changes used for the rate
+        :param max_interval: Time without counter changes after which the rate is 0
+        :param desc: Description string
+        :param unit: Unit of the rate
+        :return:
+        """
+        try:
+            src = self.parameters[source]
+        except KeyError:
+            return
+        p = PataraDerivedParameter(name, source, conversion_factor=src.factor * scale,
+                                   min_interval=min_interval, max_interval=max_interval, desc=desc)
+        p.unit = unit
+        self.derived_parameters.append(p)
+        self.parameters[name] = p
+
+    def set_deadbands(self, deadbands=None, default_lsb=1.0, default_relative=0.0):
+        """
+        Set parameter deadbands. Measurement parameters that are not part of a composite get a
+        default deadband of default_lsb times their register resolution. Other parameters
+        (settings, counters, bits) default to no deadband.
+
+        :param deadbands: Dict of parameter name -> (absolute deadband, relative deadband)
+        :param default_lsb: Default absolute deadband in units of the register resolution
+        :param default_relative: Default relative deadband for measurement parameters
+        :return:
+        """
+        if deadbands is None:
+            deadbands = dict()
+        composite_addresses = set()
+        for func, composite_list in self.composite_table.items():
+            for p in composite_list:
+                composite_addresses.update([(func, addr) for addr in p.get_addresses()])
+        for name, p in self.parameters.items():
+            if name in deadbands:
+                p.set_deadband(*deadbands[name])
+            elif p.category == "measurement" and (p.function, p.address) not in composite_addresses:
+                p.set_deadband(default_lsb * p.factor, default_relative)
+            else:
+                p.set_deadband(0.0, 0.0)
+
+    def update_derived_parameters(self, t, sources=None):
+        """
+        Update derived parameters whose source parameter was sampled at time t.
+
+        :param t: Timestamp of the block
+        :param sources: Names of the source parameters sampled at t. None to use the parameters updated at t.
+        :return: List of updated derived parameters
+        """
+        updated = list()
+        for p in self.derived_parameters:
+            src = self.parameters[p.source]
+            if sources is None:
+                sampled = src.timestamp == t
+            else:
+                sampled = p.source in sources
+            if sampled is True and p.update(src.raw_value, t) is True:
+                updated.append(p)
+        return updated
 
     def set_parameter_from_modbus_addr(self, modbus_func, addr, value, t=None):
         if modbus_func == 1:
@@ -153,6 +442,27 @@ class PataraHardwareParameters(object):
         self.parameters[name].set_value(value, t)
         return True
 
+    def set_composites_from_modbus_block(self, modbus_func, min_addr, data, t=None):
+        """
+        Decode composite parameters that have both their high and low words in the block.
+
+        :param modbus_func: Modbus function code of the block
+        :param min_addr: Start address of the block
+        :param data: List of register values in the block
+        :param t: Timestamp
+        :return: List of updated composite parameters
+        """
+        updated = list()
+        max_addr = min_addr + len(data)
+        for p in self.composite_table.get(modbus_func, []):
+            if min_addr <= p.high_address < max_addr and min_addr <= p.low_address < max_addr:
+                p.set_words(data[p.high_address - min_addr], data[p.low_address - min_addr], t)
+                updated.append(p)
+        return updated
+
+    def get_parameter_address(self, name):
+        return self.parameters[name].get_address()
+
     def get_name_from_modbus_addr(self, modbus_func, addr):
         if modbus_func == 1:
             try:
@@ -177,750 +487,3 @@ class PataraHardwareParameters(object):
         else:
             return None
         return name
-
-    def init_coils(self):
-        # Function 01: Read/write bits
-        name = "emission"
-        desc = "Laser emission state"
-        addr = 0
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "enable_standby"
-        desc = "Standby state, Commanding emission to OFF will reset this bit"
-        addr = 1
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "external_trigger"
-        desc = "OFF = The eDrive will run on internal triggering from the Timing Engine, " \
-               "ON = The eDrive will run on external triggering using the Trigger/Gate input"
-        addr = 2
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "internal_trigger_gating"
-        desc = "OFF = The internal trigger is free-running, " \
-               "ON = The Trigger/Gate input will be used to gate the internally generated trigger pulses"
-        addr = 3
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "shutter"
-        desc = "OFF = The shutter is always closed, " \
-               "ON = The shutter opens when emission is active"
-        addr = 4
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "clear_fault"
-        desc = "Set this bit to clear existing eDrive faults."
-        addr = 5
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "qsv_enable"
-        desc = "OFF = RF AO Q-switch driver is disabled, ON = RF AO Q-switch driver is enabled"
-        addr = 6
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "fps_enable"
-        desc = "OFF = Q-switch FPS is disabled, ON = Q-switch FPS is enabled"
-        addr = 7
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "fps_ppk_enable"
-        desc = "OFF = Q-switch FPS PPK is disabled, ON = Q-switch FPS PPK is enabled"
-        addr = 8
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "shutter_fps_enable"
-        desc = "OFF = Shutter FPS is disabled, ON = Shutter FPS is enabled"
-        addr = 9
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "marking_mode_trigger"
-        desc = "OFF = Marking mode trigger coil is disabled, ON = Marking mode trigger coil is enabled"
-        addr = 10
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "front_panel_locked_out"
-        desc = "OFF = Front panel access is locked out, ON = Front panel access is unlocked"
-        addr = 11
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "tec_enable"
-        desc = "Available only in manufacturing mode"
-        addr = 12
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel1_enable"
-        desc = "OFF = Channel 1 AIM is disabled, ON = Channel 1 AIM is enabled"
-        addr = 16
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel1_mode"
-        desc = "OFF = QCW (pulsed) operation is selected, ON = CW operation is selected," \
-               "Note: This bit can only be changed when the eDrive is not active and Channel 1 " \
-               "is disabled on models equipped with QCW only."
-        addr = 17
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel1_ramp_control"
-        desc = "OFF = Disable current ramping for Channel 1, ON = Enable current ramping for Channel 1"
-        addr = 18
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel1_slew_rate_control"
-        desc = "OFF = Slew rate control is disabled, ON = Slew rate control is enabled"
-        addr = 19
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel_com0_enable"
-        desc = "OFF = COM0 AIM is disabled, ON = COM0 AIM is enabled"
-        addr = 40
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel_com0_slew_enable"
-        desc = "OFF = Slew rate control is disabled, ON = Slew rate control is enabled"
-        addr = 41
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel_com0_tec_enable"
-        desc = "OFF = TEC on COM0 is disabled, ON = TEC on COM0 is enabled"
-        addr = 42
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel_com1_enable"
-        desc = "OFF = COM1 AIM is disabled, ON = COM1 AIM is enabled"
-        addr = 48
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel_com1_slew_enable"
-        desc = "OFF = Slew rate control is disabled, ON = Slew rate control is enabled"
-        addr = 49
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        name = "channel_com1_tec_enable"
-        desc = "OFF = TEC on COM1 is disabled, ON = TEC on COM1 is enabled"
-        addr = 50
-        self.coil_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=1, read_rate=3.0, desc=desc)
-
-        self.coil_read_range = [(0, 4, 3.0), (5, 50, -1.0)]
-
-    def init_discrete(self):
-        # Function 02: Read bits
-        name = "fault_state"
-        desc = "OFF = The eDrive is not in the fault state, ON = The eDrive is in the fault state"
-        addr = 0
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "off_state"
-        desc = ""
-        addr = 1
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "standby_state"
-        desc = ""
-        addr = 2
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "pre-fire_state"
-        desc = ""
-        addr = 3
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "active_state"
-        desc = ""
-        addr = 4
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_present"
-        desc = ""
-        addr = 5
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel2_present"
-        desc = ""
-        addr = 6
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel3_present"
-        desc = ""
-        addr = 7
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "chiller_flow_fault"
-        desc = ""
-        addr = 8
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "chiller_level_fault"
-        desc = ""
-        addr = 9
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "emergency_stop_fault"
-        desc = ""
-        addr = 10
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "q-switch_fault"
-        desc = ""
-        addr = 11
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_fault"
-        desc = ""
-        addr = 12
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel2_fault"
-        desc = ""
-        addr = 13
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel3_fault"
-        desc = ""
-        addr = 14
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "front_panel_fault"
-        desc = ""
-        addr = 15
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "laser_cover_interlock"
-        desc = "OFF = The laser cover interlock is grounded, ON = The laser cover interlock is open"
-        addr = 16
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "laser_coolant_flow_interlock"
-        desc = "OFF = The laser system coolant flow interlock is grounded, " \
-               "ON = The laser system coolant flow interlock is open"
-        addr = 17
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "q-switch_thermal_interlock"
-        desc = "OFF = The Q-switch thermal interlock is grounded, ON = The Q-switch thermal interlock is open"
-        addr = 18
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "q-switch_driver_thermal_fault"
-        desc = ""
-        addr = 19
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "q-switch_crystal_thermal_interlock"
-        desc = "OFF = The Q-switch thermal BNC interlock is shorted (safe), " \
-               "ON = The Q-switch thermal BNC interlock is open (faulted)"
-        addr = 20
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "q-switch_hvswr_fault"
-        desc = ""
-        addr = 21
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "q-switch_high_power_fault"
-        desc = ""
-        addr = 22
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "laser_shutter_state"
-        desc = "OFF = The shutter output is not energized, ON = The shutter output is energized"
-        addr = 23
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_present"
-        desc = ""
-        addr = 24
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_fault"
-        desc = ""
-        addr = 25
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_tolerance_fault"
-        desc = ""
-        addr = 26
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_comm_fault"
-        desc = ""
-        addr = 27
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "shutter_interlock_fault"
-        desc = ""
-        addr = 28
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_open_rtd_fault"
-        desc = ""
-        addr = 29
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_over_heat_fault"
-        desc = ""
-        addr = 30
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "tec_under_voltage_fault"
-        desc = ""
-        addr = 31
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_off_state"
-        desc = ""
-        addr = 32
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_standby"
-        desc = ""
-        addr = 33
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_active"
-        desc = ""
-        addr = 34
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_fault_state"
-        desc = ""
-        addr = 35
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_state_mismatch_fault"
-        desc = ""
-        addr = 36
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_comm_fault"
-        desc = ""
-        addr = 37
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_hardware_fault"
-        desc = ""
-        addr = 38
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_e-stop_fault"
-        desc = ""
-        addr = 39
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_comm_timeout_fault"
-        desc = ""
-        addr = 40
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_interlock_fault"
-        desc = ""
-        addr = 41
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_temp_fault"
-        desc = ""
-        addr = 42
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_overcurrent_fault"
-        desc = ""
-        addr = 43
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_low_voltage_fault"
-        desc = ""
-        addr = 44
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "channel1_current_tolerance_fault"
-        desc = ""
-        addr = 45
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_off_state"
-        desc = ""
-        addr = 80
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_standby_state"
-        desc = ""
-        addr = 81
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_active_state"
-        desc = ""
-        addr = 82
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_fault_state"
-        desc = ""
-        addr = 83
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_comm_fault"
-        desc = ""
-        addr = 84
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_hardware_fault"
-        desc = ""
-        addr = 85
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_temp_fault"
-        desc = ""
-        addr = 86
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_tec_fault"
-        desc = ""
-        addr = 87
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_tec_comm_fault"
-        desc = ""
-        addr = 88
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_tec_tolerance_fault"
-        desc = ""
-        addr = 89
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        name = "com0_tec_open_rtd_fault"
-        desc = ""
-        addr = 91
-        self.discrete_input_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=2, read_rate=3.0, desc=desc)
-
-        self.discrete_input_read_range = [(0, 91, 3.0)]
-
-    def init_holding_registers(self):
-        # Function 03: Read/write registers
-        name = "system_frequency"
-        desc = "This value represents the frequency of the internal timing engine. " \
-               "If Channel 1 is in CW mode, this frequency is only used for Q-switch pulse generation. " \
-               "If Channel 1 is in QCW mode, this frequency is used for pulsing of Channel 1 " \
-               "and the Q-switch pulses are tied to the current pulse. Range: 2 to 50,000. LSB value: 1 Hz"
-        addr = 0
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "trigger_out_config"
-        desc = "0 = Trigger out mimics QSW HIGH pulse, 1 = Trigger out mimics QSW HIGH pulse, " \
-               "2 = Trigger out sync on leading current pulse"
-        addr = 10
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "shutter_delay"
-        desc = "Range: 0 us to 500 ms. LSB value: 1 us"
-        addr = 14
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=1.0e-6, desc=desc)
-
-        name = "channel1_active_current"
-        desc = "Measured in amperes (A), this value represents the current level for Channel 1 " \
-               "when the eDrive is actively driving the array output in either CW or QCW modes. " \
-               "See standby current below. Range: 0 to 1,000. LSB value: 0.1 A"
-        addr = 16
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel1_standby_current"
-        desc = "Measured in amperes (A), this value represents the current level for Channel 1 " \
-               "when the eDrive is in standby CW or QCW mode or during the inactive portion of the QCW pulse. " \
-               "Range: 0 to 1,000. LSB value: 0.1 A"
-        addr = 17
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "tec_temp_setting"
-        desc = "This value represents the TEC temperature setting of the internal TEC. " \
-               "Range: -40.0 degC to 150.0 degC. LSB value: 0.1 degC"
-        addr = 88
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel_com0_tec_temp_setting"
-        desc = "This value represents the TEC temperature setting of the COM0 TEC. " \
-               "Range: -40.0 degC to 150.0 degC. LSB value: 0.1 degC"
-        addr = 104
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel_com1_tec_temp_setting"
-        desc = "This value represents the TEC temperature setting of the COM1 TEC. " \
-               "Range: -40.0 degC to 150.0 degC. LSB value: 0.1 degC"
-        addr = 120
-        self.holding_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=3, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        self.holding_register_read_range = [(0, 17, -1.0), (88, 104, -1.0)]
-
-    def init_input_registers(self):
-        name = "sc_firmware_version_x"
-        desc = ""
-        addr = 0
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "sc_firmware_version_y"
-        desc = ""
-        addr = 1
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "sc_firmware_version_z"
-        desc = ""
-        addr = 2
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "tec_sensed_temp"
-        desc = "This value represents the temperature reading for the TEC. " \
-               "Range: 0 degC to 1,000 degC. LSB value: 0.1 degC"
-        addr = 12
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "tec_sensed_voltage"
-        desc = "This value represents the y voltage reading for TEC. Range: 0 to 3,500, LSB value: 0.01 V"
-        addr = 13
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.01, desc=desc)
-
-        name = "tec_power"
-        desc = "This value represents the power of the TEC"
-        addr = 14
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel1_firmware_version_x"
-        desc = ""
-        addr = 16
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_firmware_version_y"
-        desc = ""
-        addr = 17
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_firmware_version_z"
-        desc = ""
-        addr = 18
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_sensed_current_flow"
-        desc = "This value represents the amount of current presently flowing through Channel 1. " \
-               "If the eDrive is in pulsed mode and active, the current reading during the active pulse " \
-               "will be returned. Range: 0 to 1,000. LSB value: 0.1 A"
-        addr = 19
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=2.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel1_power_supply_voltage"
-        desc = "This value represents the power supply voltage reading for Channel 1. " \
-               "Range: 0 to 3,500. LSB value: 0.1 V"
-        addr = 20
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel1_temperature"
-        desc = "This value represents the temperature reading for Channel 1. " \
-               "Range: 0 degC to 1,000 degC. LSB value: 0.1 degC"
-        addr = 21
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=2.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel1_current_limit"
-        desc = "This value represents the current limit setting for Channel 1. " \
-               "Range: 0 to 1,000. LSB value: 0.1 A"
-        addr = 22
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel1_warranty_timer_high"
-        desc = "This value represents the high word of the number of hours accumulated on the warranty timer " \
-               "of the Channel 1 AIM. Range: 0 to 4,294,967,295. LSB value: 1 s"
-        addr = 24
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_warranty_timer_low"
-        desc = "This value represents the low word of the number of hours accumulated on the warranty timer " \
-               "of the Channel 1 AIM. Range: 0 to 4,294,967,295. LSB value: 1 s"
-        addr = 25
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_pulsed_mode_shot_counter_high"
-        desc = "This value represents the Channel 1 shot counter high word. Range: 0 to 4,294,967,295"
-        addr = 30
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=2.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_pulsed_mode_shot_counter_low"
-        desc = "This value represents the Channel 1 shot counter low word. Range: 0 to 4,294,967,295"
-        addr = 31
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=2.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel1_pulsed_current_limit"
-        desc = "This value represents the current limit on Channel 1 in 0.1 A increments."
-        addr = 32
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "humidity_reading"
-        desc = "This value represents the humidity reading. Range: 0 to 100. LSB value: 1 percent humidity"
-        addr = 33
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel_com0_sensed_current"
-        desc = "Current from COM0 AIM in 0.1 A increments."
-        addr = 112
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel_com0_tec_sensed_temp"
-        desc = "This value represents the temperature reading for the COM0 TEC. " \
-               "Range: 0 degC to 1,000 degC. LSB value: 0.1 degC"
-        addr = 115
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel_com0_tec_sensed_voltage"
-        desc = "This value represents the y voltage reading for COM0 TEC. Range: 0 to 3,500, LSB value: 0.1 V"
-        addr = 116
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        name = "channel_com0_tec_power"
-        desc = "This value represents the power from COM0 TEC"
-        addr = 117
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=-1.0,
-                                                conversion_factor=1.0, desc=desc)
-
-        name = "channel_com1_tec_sensed_temp"
-        desc = "This value represents the temperature reading for the COM1 TEC. " \
-               "Range: 0 degC to 1,000 degC. LSB value: 0.1 degC"
-        addr = 123
-        self.input_register_table[addr] = name
-        self.parameters[name] = PataraParameter(name, address=addr, func=4, read_rate=1.0,
-                                                conversion_factor=0.1, desc=desc)
-
-        self.input_register_read_range = [(12, 33, 3.0), (112, 117, 1.0), (0, 18, -1.0)]
@@ -0,0 +1,194 @@
+"""
+Register maps for the eDrive are stored as csv files in the register_maps directory.
+A map file is parsed and compiled into lookup tables once per process, keyed on the hash of
+the map file so that devices using the same map share the tables.
+"""
+
+import os
+import csv
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger("PataraRegisterMap")
+while len(logger.handlers):
+    logger.removeHandler(logger.handlers[0])
+f = logging.Formatter("%(asctime)s - %(name)s.   %(funcName)s - %(levelname)s - %(message)s")
+fh = logging.StreamHandler()
+fh.setFormatter(f)
+logger.addHandler(fh)
+logger.setLevel(logging.INFO)
+
+REGISTER_MAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "register_maps")
+DEFAULT_REGISTER_MAP = "edrive_default"
+FIRMWARE_INDEX_FILE = os.path.join(REGISTER_MAP_DIR, "firmware_maps.csv")
+
+_compiled_maps = dict()
+_firmware_index = None
+_compiled_maps_lock = threading.Lock()
+
+
+class PataraRegisterMapError(Exception):
+    pass
+
+
+class PataraRegisterMap(object):
+    """
+    Compiled register map. All members are treated as read only once compiled, so the
+    lookup tables can be shared between PataraHardwareParameters instances.
+
+    parameter_specs: list of (name, func, address, factor, offset, read_rate, category, desc)
+    composite_specs: list of (name, func, high_address, low_address, factor, offset, read_rate, category, desc)
+    tables: dict func -> dict address -> name
+    read_ranges: dict func -> list of (min_addr, max_addr, read_rate)
+    units: dict name -> unit string, for parameters and composites with a unit
+    """
+
+    def __init__(self, name, file_hash):
+        self.name = name
+        self.file_hash = file_hash
+        self.parameter_specs = list()
+        self.composite_specs = list()
+        self.tables = {1: dict(), 2: dict(), 3: dict(), 4: dict()}
+        self.read_ranges = {1: list(), 2: list(), 3: list(), 4: list()}
+        self.units = dict()
+
+    def __str__(self):
+        return "Register map {0}: {1} parameters, {2} composites".format(self.name, len(self.parameter_specs),
+                                                                          len(self.composite_specs))
+
+
+def get_register_map_path(name):
+    if os.path.isfile(name):
+        return name
+    return os.path.join(REGISTER_MAP_DIR, "{0}.csv".format(name))
+
+
+def parse_address(addr_str):
+    """
+    Parse an address field. Single address "12" or span "12:33".
+    :param addr_str: Address string from the map file
+    :return: Tuple (first, last)
+    """
+    parts = addr_str.split(":")
+    if len(parts) == 1:
+        a = int(parts[0])
+        return a, a
+    return int(parts[0]), int(parts[1])
+
+
+def compile_register_map(name, data, file_hash):
+    """
+    Parse the csv contents of a register map file into a PataraRegisterMap.
+
+    :param name: Name of the register map
+    :param data: File contents
+    :param file_hash: Hash of the file contents
+    :return: PataraRegisterMap
+    """
+    reg_map = PataraRegisterMap(name, file_hash)
+    lines = [line for line in data.splitlines() if line.strip() and not line.startswith("#")]
+    reader = csv.DictReader(lines)
+    for row_ind, row in enumerate(reader):
+        try:
+            p_name = row["name"]
+            func = int(row["function"])
+            (addr_first, addr_last) = parse_address(row["address"])
+            factor = float(row["factor"])
+            offset = float(row["offset"])
+            read_rate = float(row["read_rate"])
+            category = row["category"]
+            desc = row["description"]
+            unit = (row.get("unit") or "").strip()
+        except (KeyError, ValueError, TypeError) as e:
+            raise PataraRegisterMapError("Register map {0} row {1}: {2}".format(name, row_ind, e))
+        if func not in reg_map.tables:
+            raise PataraRegisterMapError("Register map {0} row {1}: "
+                                         "wrong function code {2}".format(name, row_ind, func))
+        if unit != "":
+            reg_map.units[p_name] = unit
+        if category == "read_range":
+            reg_map.read_ranges[func].append((addr_first, addr_last, read_rate))
+        elif category == "composite":
+            reg_map.composite_specs.append((p_name, func, addr_first, addr_last, factor, offset,
+                                            read_rate, category, desc))
+        else:
+            reg_map.tables[func][addr_first] = p_name
+            reg_map.parameter_specs.append((p_name, func, addr_first, factor, offset, read_rate, category, desc))
+    return reg_map
+
+
+def load_register_map(name=DEFAULT_REGISTER_MAP):
+    """
+    Get a compiled register map. Maps are compiled once per process and cached keyed by the
+    hash of the file, so a changed file is compiled again.
+
+    :param name: Name of a map in the register_maps directory, or a path to a map file
+    :return: PataraRegisterMap
+    """
+    path = get_register_map_path(name)
+    try:
+        with open(path, "rb") as map_file:
+            data = map_file.read()
+    except IOError as e:
+        raise PataraRegisterMapError("Could not read register map {0}: {1}".format(path, e))
+    file_hash = hashlib.sha1(data).hexdigest()
+    with _compiled_maps_lock:
+        try:
+            return _compiled_maps[file_hash]
+        except KeyError:
+            pass
+        logger.info("Compiling register map {0}".format(path))
+        reg_map = compile_register_map(name, data.decode("ascii"), file_hash)
+        _compiled_maps[file_hash] = reg_map
+    return reg_map
+
+
+def load_firmware_index(path=FIRMWARE_INDEX_FILE):
+    """
+    Read the firmware index file. Each row holds firmware_x, firmware_y, firmware_z and the name
+    of the register map to use. A * matches any version number.
+
+    :param path: Path to index file
+    :return: List of ((x, y, z), map_name) tuples, in file order
+    """
+    index = list()
+    try:
+        with open(path, "rb") as index_file:
+            data = index_file.read().decode("ascii")
+    except IOError as e:
+        logger.warning("Could not read firmware index {0}: {1}".format(path, e))
+        return index
+    lines = [line for line in data.splitlines() if line.strip() and not line.startswith("#")]
+    for row_ind, row in enumerate(csv.DictReader(lines)):
+        try:
+            version = tuple([None if row[key].strip() == "*" else int(row[key])
+                             for key in ("firmware_x", "firmware_y", "firmware_z")])
+            index.append((version, row["register_map"].strip()))
+        except (KeyError, ValueError, AttributeError) as e:
+            raise PataraRegisterMapError("Firmware index {0} row {1}: {2}".format(path, row_ind, e))
+    return index
+
+
+def get_register_map_name(firmware_version):
+    """
+    Select register map from the eDrive system controller firmware version
+    (sc_firmware_version_x/y/z). The first matching row in the firmware index is used.
+
+    :param firmware_version: Tuple (x, y, z)
+    :return: Register map name. DEFAULT_REGISTER_MAP if no row matches.
+    """
+    global _firmware_index
+    with _compiled_maps_lock:
+        if _firmware_index is None:
+            _firmware_index = load_firmware_index()
+        index = _firmware_index
+    for (version, map_name) in index:
+        match = True
+        for v_index, v in zip(version, firmware_version):
+            if v_index is not None and v_index != v:
+                match = False
+                break
+        if match is True:
+            return map_name
+    return DEFAULT_REGISTER_MAP
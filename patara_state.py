@@ -41,6 +41,14 @@ class StateMessage(object):
         self.action_list.append(action)
 
     def execute_actions(self, *added_args, **added_kwargs):
+        """
+        Execute the actions of the message. Actions returning a deferred are collected. Controller
+        commands return deferreds that fire from the controller thread when the Modbus call has
+        completed, also when the command queue was idle. Other actions are done when they return.
+
+        :return: Deferred that fires when all action deferreds have fired, or errbacks on the first failure
+        """
+        action_deferreds = list()
         for action in self.action_list:
             f = action[0]
             args = action[1]
@@ -48,7 +56,17 @@ class StateMessage(object):
             kwargs = dict(action[2])
             kwargs.update(added_kwargs)
             logger.info("Executing {0}: \n {1}({2}, {3})".format(self.name, f, args, kwargs))
-            f(*args, **kwargs)
+            try:
+                result = f(*args, **kwargs)
+            except Exception as e:
+                return defer.fail(e)
+            if isinstance(result, defer.Deferred):
+                action_deferreds.append(result)
+        if not action_deferreds:
+            return defer.succeed(None)
+        if len(action_deferreds) == 1:
+            return action_deferreds[0]
+        return defer.DeferredList(action_deferreds, fireOnOneErrback=True, consumeErrors=True)
 
 
 class StateDispatcher(object):
@@ -118,8 +136,25 @@ class StateDispatcher(object):
             self.current_state = "unknown"
 
     def send_command(self, cmd, *data, **kw_data):
+        """
+        Send a command message to the current state. The actions are queued on the controller
+        and the call returns without waiting for them.
+
+        :param cmd: Message name
+        :return: Deferred that fires when the controller has completed the actions of the message
+        """
         self.logger.info("Sending command {0} to state {1}".format(cmd, self.current_state))
-        self._state_obj.check_message(cmd, *data, **kw_data)
+        if self._state_obj is None:
+            return defer.fail(RuntimeError("State handler not running"))
+        try:
+            result = self._state_obj.check_message(cmd, *data, **kw_data)
+        except Exception as e:
+            self.logger.error("Error in command {0}: {1}".format(cmd, e))
+            return defer.fail(e)
+        if isinstance(result, defer.Deferred):
+            return result
+        # A state that does not return a deferred did not handle the command
+        return defer.fail(ValueError("Command {0} not handled in state {1}".format(cmd, self.current_state)))
 
     def stop(self):
         self.logger.info("Stop state handler thread")
@@ -187,17 +222,23 @@ class State(object):
         self.next_state = None
         return result
 
-    def check_message(self, msg):
+    def check_message(self, msg_name, *msg_args, **msg_kwargs):
         """
         Check message with condition object released and take appropriate action.
         The condition object is released already in the send_message function.
 
         -- This could be a message queue if needed...
 
-        :param msg:
-        :return:
+        :param msg_name:
+        :param msg_args:
+        :param msg_kwargs:
+        :return: Deferred from the message actions. Failed deferred if the message is not accepted in this state.
         """
-        pass
+        return self.reject_message(msg_name)
+
+    def reject_message(self, msg_name):
+        self.logger.info("Message {0} not accepted in state {1}".format(msg_name, self.name.upper()))
+        return defer.fail(ValueError("Command {0} not accepted in state {1}".format(msg_name, self.name.upper())))
 
     def state_error(self, err):
         self.logger.error("Error {0} in state {1}".format(err, self.name.upper()))
@@ -216,7 +257,7 @@ class State(object):
         self.logger.info("Message {0} received".format(msg_name))
         with self.cond_obj:
             self.cond_obj.notify_all()
-            self.check_message(msg_name, *msg_args, **msg_kwargs)
+            return self.check_message(msg_name, *msg_args, **msg_kwargs)
 
     def stop_run(self):
         self.logger.info("Notify condition to stop run")
@@ -278,9 +319,21 @@ class StateConnect(State):
         State.state_enter(self, prev_state)
         self.controller.set_status("Connecting to Patara device.")
         d = self.controller.init_client()
+        d.addCallback(self.select_register_map)
         d.addCallbacks(self.check_requirements, self.state_error)
         self.deferred_list = [d]
 
+    def select_register_map(self, result):
+        """
+        Select register map from the firmware version once connected. The deferred
+        chain waits for the returned deferred.
+        :param result: Connected flag from init_client
+        :return:
+        """
+        if self.controller.connected is True:
+            return self.controller.select_register_map(True)
+        return result
+
     def check_requirements(self, result):
         self.logger.info("Check requirements result: {0}".format(result))
         if self.controller.connected is True:
@@ -297,13 +350,15 @@ class StateConnect(State):
         self.next_state = "unknown"
         self.stop_run()
 
-    def check_message(self, msg):
-        if msg == "disconnect":
+    def check_message(self, msg_name, *msg_args, **msg_kwargs):
+        if msg_name == "disconnect":
             self.logger.debug("Message disconnect... go to unknown.")
             d = self.deferred_list[0]   # type: defer.Deferred
             d.cancel()
             self.next_state = "unknown"
             self.stop_run()
+            return defer.succeed(None)
+        return self.reject_message(msg_name)
 
 
 class StateSetupAttributes(State):
@@ -510,20 +565,20 @@ class StatePolling(State):
         :param msg_name:
         :param msg_args:
         :param msg_kwargs:
-        :return:
+        :return: Deferred from the message actions. Failed deferred if the message is not accepted in this state.
         """
         if msg_name in self.message_list:
             self.logger.info("Message in list. Executing")
             self.logger.info("{0}, args: {1}, kwargs: {2}".format(msg_name, msg_args, msg_kwargs))
-            self.message_dict[msg_name].execute_actions(*msg_args, **msg_kwargs)
+            return self.message_dict[msg_name].execute_actions(*msg_args, **msg_kwargs)
         else:
-            self.logger.info("Message NOT in list.")
+            return self.reject_message(msg_name)
 
     def send_message(self, msg_name, *msg_args, **msg_kwargs):
         self.logger.info("Message {0} received".format(msg_name))
         with self.cond_obj:
             self.cond_obj.notify_all()
-            self.check_message(msg_name, *msg_args, **msg_kwargs)
+            return self.check_message(msg_name, *msg_args, **msg_kwargs)
 
     def poll_control_state(self, result):
         """
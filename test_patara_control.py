@@ -0,0 +1,598 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from twisted_cut import defer
+
+try:
+    import patara_control as pc
+    import patara_register_map as prm
+except ImportError:
+    # The controller needs pymodbus
+    pc = None
+
+
+class FakeResponse(object):
+    def __init__(self, function_code, registers=None, bits=None):
+        self.function_code = function_code
+        self.registers = registers
+        self.bits = bits
+
+
+class FakeClient(object):
+    """
+    Modbus client keeping holding registers in a dict. Writes wait for the release
+    event, so that the test can check the state of the queue while a write is running.
+    """
+    def __init__(self, fail_writes=False):
+        self.fail_writes = fail_writes
+        self.registers = dict()
+        self.release = threading.Event()
+        self.release.set()
+        self.closed = False
+
+    def write_register(self, address, value, **kwargs):
+        self.release.wait(2.0)
+        if self.fail_writes is True:
+            raise IOError("Write to {0} failed".format(address))
+        self.registers[address] = value
+        return FakeResponse(6)
+
+    def read_holding_registers(self, address, count, **kwargs):
+        return FakeResponse(3, registers=[self.registers.get(addr, 0) for addr in range(address, address + count)])
+
+    def close(self):
+        self.closed = True
+
+
+class Result(object):
+    """
+    Collect the result of a deferred fired from a controller thread.
+    """
+    def __init__(self, d):
+        self.event = threading.Event()
+        self.value = None
+        self.failed = None
+        d.addCallbacks(self.done, self.error)
+
+    def done(self, value):
+        self.value = value
+        self.failed = False
+        self.event.set()
+
+    def error(self, err):
+        self.value = err
+        self.failed = True
+        self.event.set()
+
+    def wait(self, timeout=2.0):
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class CommandQueueTest(unittest.TestCase):
+    name = "channel1_active_current"
+
+    def setUp(self):
+        self.controller = pc.PataraControl()
+        self.controller.client = FakeClient()
+        self.reconnects = 0
+        self.controller.init_client = self.reconnect
+
+    def reconnect(self):
+        self.reconnects += 1
+        self.controller.close_client()
+        self.controller.client = FakeClient()
+        return defer.succeed(True)
+
+    def test_write_idle_queue(self):
+        self.controller.client.release.clear()
+        d = self.controller.write_parameter(self.name, 10.0, process_now=True, readback=False)
+        result = Result(d)
+        # The write is running, the deferred must not fire before it completes
+        self.assertFalse(result.event.is_set())
+        self.controller.client.release.set()
+        self.assertTrue(result.wait())
+        self.assertFalse(result.failed)
+        self.assertEqual(result.value.function_code, 6)
+        self.assertFalse(self.controller.response_pending)
+
+    def test_failed_write_idle_queue(self):
+        self.controller.client.fail_writes = True
+        self.controller.client.release.clear()
+        d = self.controller.write_parameter(self.name, 10.0, process_now=True, readback=False)
+        result = Result(d)
+        self.assertFalse(result.event.is_set())
+        self.controller.client.release.set()
+        self.assertTrue(result.wait())
+        self.assertTrue(result.failed)
+        self.assertTrue(result.value.check(IOError) is not None)
+        self.assertEqual(self.reconnects, 1)
+
+    def test_failed_write_with_readback(self):
+        self.controller.client.fail_writes = True
+        d = self.controller.write_parameter(self.name, 10.0, process_now=True, readback=True)
+        result = Result(d)
+        self.assertTrue(result.wait())
+        self.assertTrue(result.failed)
+        self.assertTrue(result.value.check(defer.FirstError) is not None)
+        self.assertEqual(self.reconnects, 1)
+        self.assertTrue(self.controller.command_queue.empty())
+
+    def test_write_with_readback(self):
+        d = self.controller.write_parameter(self.name, 10.0, process_now=True, readback=True)
+        result = Result(d)
+        self.assertTrue(result.wait())
+        self.assertFalse(result.failed)
+        self.assertAlmostEqual(self.controller.get_parameter_value(self.name).value, 10.0, places=1)
+
+    def test_close_cancels_queued_commands(self):
+        client = self.controller.client
+        client.release.clear()
+        d_write = self.controller.write_parameter(self.name, 10.0, process_now=True, readback=False)
+        d_read = self.controller.read_parameter(self.name, process_now=False)
+        write_result = Result(d_write)
+        read_result = Result(d_read)
+        self.controller.close_client()
+        client.release.set()
+        self.assertTrue(write_result.wait())
+        self.assertFalse(write_result.failed)
+        # The read was cancelled, and client_error passes it on as None without reconnecting
+        self.assertTrue(read_result.wait())
+        self.assertEqual(read_result.value, None)
+        self.assertEqual(self.reconnects, 0)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = pc.PataraControl()
+        self.names = [self.controller.patara_data.get_name_from_modbus_addr(4, addr) for addr in [17, 18, 19]]
+
+    def test_old_snapshot_unchanged(self):
+        self.controller.process_input_registers(FakeResponse(4, registers=[1] * 22), min_addr=12)
+        first = self.controller.get_snapshot()
+        values = dict([(name, first.values[name].value) for name in self.names])
+        self.controller.process_input_registers(FakeResponse(4, registers=[2] * 22), min_addr=12)
+        snapshot = self.controller.get_snapshot()
+        self.assertFalse(snapshot is first)
+        self.assertEqual(snapshot.sequence, first.sequence + 1)
+        for name in self.names:
+            # A reader holding the old snapshot still sees the old values
+            self.assertEqual(first.values[name].value, values[name])
+            self.assertNotEqual(snapshot.values[name].value, values[name])
+            self.assertEqual(self.controller.get_parameter_value(name), snapshot.values[name])
+
+    def test_unread_parameter(self):
+        self.assertEqual(self.controller.get_parameter_value(self.names[0]), None)
+        self.assertEqual(self.controller.get_snapshot().sequence, 0)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class ParameterSetTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = pc.PataraControl()
+        self.input_names = [self.controller.patara_data.get_name_from_modbus_addr(4, addr) for addr in [17, 18, 19]]
+        bits = [False] * 92
+        bits[2] = True
+        self.controller.process_input_registers(FakeResponse(4, registers=[1] * 22), min_addr=12)
+        self.controller.process_status(FakeResponse(2, bits=bits), min_addr=0)
+
+    def test_same_block(self):
+        result = self.controller.get_parameter_values(self.input_names)
+        self.assertEqual(result.sequence, 1)
+        self.assertEqual(result.sequence, result.values[0].sequence)
+        self.assertEqual(result.timestamp, result.values[0].timestamp)
+        self.assertEqual(len(result.values), 3)
+
+    def test_different_blocks(self):
+        result = self.controller.get_parameter_values(self.input_names + ["standby_state"])
+        self.assertEqual(result.sequence, None)
+        self.assertEqual(result.timestamp, None)
+        self.assertEqual([v.sequence for v in result.values], [1, 1, 1, 2])
+        self.assertEqual(result.values[-1].value, True)
+
+    def test_unread_parameter(self):
+        result = self.controller.get_parameter_values(self.input_names + ["tec_temp_setting"])
+        self.assertEqual(result.sequence, None)
+        self.assertEqual(result.values[-1], None)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class HitPathTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = pc.PataraControl()
+        self.notified = list()
+        self.controller.add_parameter_notifier(self.notifier)
+
+    def notifier(self, names, snapshot):
+        self.notified.append(list(names))
+
+    def test_identical_registers(self):
+        regs = list(range(100, 122))
+        self.controller.process_input_registers(FakeResponse(4, registers=list(regs)), min_addr=12)
+        first = self.controller.get_snapshot()
+        self.assertEqual(len(self.notified), 1)
+        self.controller.process_input_registers(FakeResponse(4, registers=list(regs)), min_addr=12)
+        snapshot = self.controller.get_snapshot()
+        self.assertEqual(len(self.notified), 1)
+        self.assertEqual(snapshot.sequence, first.sequence + 1)
+        block = self.controller.response_blocks[(4, 12, 22)]
+        self.assertEqual(block.hits, 1)
+        for name in block.names:
+            v = snapshot.values[name]
+            self.assertEqual(v.value, first.values[name].value)
+            self.assertEqual(v.sequence, snapshot.sequence)
+            self.assertEqual(v.timestamp, snapshot.timestamp)
+        self.assertEqual(self.controller.get_changes_since(self.controller.get_changes_since(0)[0])[1], [])
+
+    def test_identical_bits(self):
+        bits = [False] * 92
+        bits[2] = True
+        self.controller.process_status(FakeResponse(2, bits=list(bits)), min_addr=0)
+        first = self.controller.get_snapshot()
+        self.controller.process_status(FakeResponse(2, bits=list(bits)), min_addr=0)
+        snapshot = self.controller.get_snapshot()
+        self.assertEqual(len(self.notified), 1)
+        self.assertEqual(self.controller.get_state(), "standby_state")
+        block = self.controller.response_blocks[(2, 0, 92)]
+        for name in block.names:
+            self.assertEqual(snapshot.values[name].value, first.values[name].value)
+            self.assertEqual(snapshot.values[name].sequence, snapshot.sequence)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class DeadbandTest(unittest.TestCase):
+    def setUp(self):
+        patara_data = pc.PataraControl().patara_data
+        self.name = patara_data.get_name_from_modbus_addr(4, 19)
+        self.other = patara_data.get_name_from_modbus_addr(4, 18)
+        self.factor = patara_data.parameters[self.other].factor
+        # Relative deadband of 10 % on one parameter, the default of one register step on the others
+        self.controller = pc.PataraControl(deadbands={self.other: (0.0, 0.1)})
+        self.notified = list()
+        self.controller.add_parameter_notifier(self.notifier)
+        self.regs = [100] * 22
+
+    def notifier(self, names, snapshot):
+        self.notified.append(names)
+
+    def poll(self, addr=None, value=None):
+        if addr is not None:
+            self.regs[addr - 12] = value
+        self.notified = list()
+        self.controller.process_input_registers(FakeResponse(4, registers=list(self.regs)), min_addr=12)
+        return [name for names in self.notified for name in names]
+
+    def test_default_deadband(self):
+        self.assertTrue(self.name in self.poll())
+        # One register step is within the deadband, but the snapshot has the new value
+        self.assertEqual(self.poll(19, 101), [])
+        p = self.controller.patara_data.parameters[self.name]
+        self.assertAlmostEqual(self.controller.get_parameter_value(self.name).value, 101 * p.factor)
+        # Changes add up against the last notified value
+        self.assertEqual(self.poll(19, 102), [self.name])
+        self.assertEqual(self.poll(19, 101), [])
+
+    def test_relative_deadband(self):
+        self.poll()
+        self.assertEqual(self.poll(18, 109), [])
+        self.assertEqual(self.poll(18, 111), [self.other])
+        self.assertEqual(self.poll(18, 101), [])
+        self.assertEqual(self.poll(18, 99), [self.other])
+        self.assertAlmostEqual(self.controller.get_parameter_value(self.other).value, 99 * self.factor)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class ChangeTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = pc.PataraControl()
+        self.name = self.controller.patara_data.get_name_from_modbus_addr(4, 19)
+        self.regs = [100] * 22
+        self.poll()
+
+    def poll(self, addr=None, value=None):
+        if addr is not None:
+            self.regs[addr - 12] = value
+        self.controller.process_input_registers(FakeResponse(4, registers=list(self.regs)), min_addr=12)
+
+    def test_changes(self):
+        (token, names, values) = self.controller.get_changes_since(0)
+        self.assertEqual(len(names), len(self.controller.response_blocks[(4, 12, 22)].names))
+        self.assertEqual(values[names.index(self.name)], self.controller.get_parameter_value(self.name))
+        self.poll()
+        (token, names, values) = self.controller.get_changes_since(token)
+        self.assertEqual(names, [])
+        self.poll(19, 110)
+        (new_token, names, values) = self.controller.get_changes_since(token)
+        self.assertEqual(names, [self.name])
+        self.assertEqual(new_token & ((1 << pc.CHANGE_SEQUENCE_BITS) - 1), self.controller.get_snapshot().sequence)
+        # Within the deadband is not a change
+        self.poll(19, 111)
+        self.assertEqual(self.controller.get_changes_since(new_token)[1], [])
+
+    def test_exact_as_double(self):
+        token = self.controller.get_changes_since(0)[0]
+        self.assertEqual(int(float(token)), token)
+        self.assertEqual(self.controller.get_changes_since(int(float(token)))[1], [])
+
+    def test_resync(self):
+        (token, names, values) = self.controller.get_changes_since(0)
+        # Token from another process
+        other = pc.PataraControl()
+        other.process_input_registers(FakeResponse(4, registers=list(self.regs)), min_addr=12)
+        self.assertEqual(len(other.get_changes_since(token)[1]), len(names))
+        # Sequence ahead of the snapshot
+        self.assertEqual(len(self.controller.get_changes_since(token + 5)[1]), len(names))
+        # New register map
+        self.controller.set_register_map(self.controller.register_map_name)
+        self.poll()
+        (new_token, new_names, values) = self.controller.get_changes_since(token)
+        self.assertEqual(len(new_names), len(names))
+        self.assertNotEqual(new_token >> pc.CHANGE_SEQUENCE_BITS, token >> pc.CHANGE_SEQUENCE_BITS)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class StalenessTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = pc.PataraControl(default_max_age=10.0)
+        self.name = self.controller.patara_data.get_name_from_modbus_addr(4, 19)
+        self.notified = list()
+        self.controller.add_parameter_notifier(self.notifier)
+
+    def notifier(self, names, snapshot):
+        self.notified.append(list(names))
+
+    def poll(self):
+        self.controller.process_input_registers(FakeResponse(4, registers=[100] * 22), min_addr=12)
+        return self.controller.get_parameter_value(self.name).timestamp
+
+    def test_limits(self):
+        limits = self.controller.stale_limits
+        # Input registers are polled every 0.3 s
+        self.assertEqual(limits[self.name][2], True)
+        self.assertAlmostEqual(limits[self.name][0], 0.9)
+        self.assertAlmostEqual(limits[self.name][1], 3.0)
+        # Holding registers are read on demand with the max age
+        self.assertEqual(limits["tec_temp_setting"], (30.0, 100.0, False))
+        # Derived rates follow their counter
+        self.assertEqual(limits["channel1_repetition_rate"], limits["channel1_pulsed_mode_shot_counter"])
+
+    def test_levels(self):
+        t = self.poll()
+        self.assertEqual(self.controller.get_staleness(self.name, t, t + 0.5), 0)
+        self.assertEqual(self.controller.get_staleness(self.name, t, t + 1.0), 1)
+        self.assertEqual(self.controller.get_staleness(self.name, t, t + 4.0), 2)
+        self.assertEqual(self.controller.get_staleness(self.name, None, t), 2)
+        self.assertEqual(self.controller.get_staleness("no_such_parameter", t, t + 100.0), 0)
+
+    def test_check_staleness(self):
+        t = self.poll()
+        self.notified = list()
+        self.assertEqual(self.controller.check_staleness(t + 0.5), [])
+        changed = self.controller.check_staleness(t + 1.0)
+        self.assertTrue(self.name in changed)
+        self.assertEqual(self.notified, [changed])
+        # Only changes of level are notified
+        self.assertEqual(self.controller.check_staleness(t + 1.5), [])
+        self.assertTrue(self.name in self.controller.check_staleness(t + 4.0))
+        # An identical response refreshes the values
+        t = self.poll()
+        self.assertTrue(self.name in self.controller.check_staleness(t))
+        self.assertEqual(self.controller.check_staleness(t + 0.5), [])
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class PersistenceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.controller = pc.PataraControl(history_dir=self.tmp_dir, compressed_history_bytes=100000)
+
+    def tearDown(self):
+        self.controller.close_history_stores()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_raw_history_keeps_small_changes(self):
+        regs = list(range(100, 122))
+        self.controller.process_input_registers(FakeResponse(4, registers=list(regs)), min_addr=12)
+        # A one LSB change is within the default deadband
+        regs[7] += 1
+        self.controller.process_input_registers(FakeResponse(4, registers=list(regs)), min_addr=12)
+        (s, t, v) = self.controller.read_stored_history(4, 12)
+        self.assertEqual(len(s), 2)
+        self.assertEqual(list(v[:, 7]), [107, 108])
+        self.assertEqual(list(v[-1]), regs)
+        block = self.controller.response_blocks[(4, 12, 22)]
+        (s_c, t_c, v_c) = block.compressed_history.read_range()
+        self.assertEqual(list(s_c), list(s))
+        self.assertEqual(list(v_c[:, 7]), [107, 107])
+        # A larger change is stored in both
+        regs[7] += 5
+        self.controller.process_input_registers(FakeResponse(4, registers=list(regs)), min_addr=12)
+        self.assertEqual(self.controller.read_stored_history(4, 12)[2][-1, 7], 113)
+        self.assertEqual(block.compressed_history.read_range()[2][-1, 7], 113)
+
+    def test_history_kept_after_restart(self):
+        for cycle in range(3):
+            regs = [cycle] * 22
+            self.controller.process_input_registers(FakeResponse(4, registers=regs), min_addr=12)
+        sequences = self.controller.read_stored_history(4, 12)[0]
+        self.controller.close_history_stores()
+        self.controller = pc.PataraControl(history_dir=self.tmp_dir)
+        self.assertEqual(self.controller.read_stored_history(4, 12), None)
+        # The file is opened again when the block is first decoded
+        self.controller.process_input_registers(FakeResponse(4, registers=[7] * 22), min_addr=12)
+        (s, t, v) = self.controller.read_stored_history(4, 12)
+        self.assertEqual(len(s), 4)
+        self.assertEqual(list(s[:3]), list(sequences))
+        self.assertEqual(list(v[:, 0]), [0, 1, 2, 7])
+        self.assertTrue((t[1:] >= t[:-1]).all())
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class FaultCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.controller = pc.PataraControl(fault_capture_dir=self.tmp_dir, pre_trigger_cycles=3,
+                                           post_trigger_cycles=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def poll(self, cycle, fault=False):
+        bits = [False] * 92
+        bits[2] = True
+        bits[8] = fault
+        self.controller.process_input_registers(FakeResponse(4, registers=[cycle] * 22), min_addr=12)
+        self.controller.process_status(FakeResponse(2, bits=bits), min_addr=0)
+
+    def test_capture_saved(self):
+        for cycle in range(5):
+            self.poll(cycle)
+        self.poll(5, fault=True)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+        self.poll(6, fault=True)
+        self.poll(7, fault=True)
+        files = os.listdir(self.tmp_dir)
+        self.assertEqual(len(files), 1)
+        capture = np.load(os.path.join(self.tmp_dir, files[0]))
+        self.assertTrue("chiller_flow_fault" in str(capture["trigger_reason"]))
+        # Three cycles before the trigger, and two after
+        self.assertEqual(list(capture["block_4_12_22_values"][:, 0]), [3, 4, 5, 6, 7])
+        self.assertEqual(len(capture["block_2_0_92_sequence"]), 5)
+        # A fault that stays active does not trigger again
+        self.poll(8, fault=True)
+        self.poll(9, fault=True)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class HistoryQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = pc.PataraControl(compressed_history_bytes=100000)
+        for cycle in range(5):
+            regs = [100 * cycle + addr for addr in range(22)]
+            self.controller.process_input_registers(FakeResponse(4, registers=regs), min_addr=12)
+        self.block = self.controller.response_blocks[(4, 12, 22)]
+        self.reads = 0
+        read_range = self.block.compressed_history.read_range
+
+        def counting_read_range(t0=None, t1=None):
+            self.reads += 1
+            return read_range(t0, t1)
+        self.block.compressed_history.read_range = counting_read_range
+
+    def test_one_read_per_block(self):
+        names = [self.controller.patara_data.get_name_from_modbus_addr(4, addr) for addr in range(12, 34)]
+        names = [name for name in names if name is not None]
+        self.assertTrue(len(names) > 2)
+        # Start before the in-memory history, so the compressed history is used
+        result = self.controller.query_history(names + ["no_such_parameter"], 0.0)
+        self.assertEqual(self.reads, 1)
+        self.assertEqual(len(result), len(names) + 1)
+        for name, (timestamps, values) in zip(names, result):
+            p = self.controller.patara_data.parameters[name]
+            self.assertEqual(len(timestamps), 5)
+            expected = self.controller.convert_raw_values(p, 12, self.block.compressed_history.read_range()[2])
+            self.assertTrue((values == expected).all())
+        self.assertEqual(len(result[-1][0]), 0)
+
+    def test_in_memory_history(self):
+        name = self.controller.patara_data.get_name_from_modbus_addr(4, 19)
+        t0 = self.block.history.get_oldest_time()
+        (timestamps, values) = self.controller.query_history_range(name, t0)
+        self.assertEqual(self.reads, 0)
+        self.assertEqual(len(values), 5)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class AggregateTest(unittest.TestCase):
+    def test_window_aggregates(self):
+        controller = pc.PataraControl(aggregate_windows=(0.1, ))
+        name = controller.patara_data.get_name_from_modbus_addr(4, 19)
+        factor = controller.patara_data.parameters[name].factor
+        regs = list(range(100, 122))
+        t_end = time.time() + 0.35
+        cycle = 0
+        while time.time() < t_end:
+            # Identical responses in between go through the hit path
+            regs[7] = [100, 110][(cycle // 3) % 2]
+            controller.process_input_registers(FakeResponse(4, registers=list(regs)), min_addr=12)
+            cycle += 1
+            time.sleep(0.005)
+        result = controller.get_aggregate(name, 0.1)
+        self.assertTrue(result["count"] > 6)
+        self.assertAlmostEqual(result["min"], 100 * factor)
+        self.assertAlmostEqual(result["max"], 110 * factor)
+        self.assertTrue(100 * factor < result["mean"] < 110 * factor)
+        # Windows are aligned to multiples of the window length
+        self.assertAlmostEqual(result["time"] / 0.1, round(result["time"] / 0.1), places=4)
+        # Window not in aggregate_windows
+        self.assertEqual(controller.get_aggregate(name, 1.0), None)
+
+
+@unittest.skipIf(pc is None, "pymodbus not installed")
+class RegisterMapSelectionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.map_path = os.path.join(self.tmp_dir, "edrive_test.csv")
+        shutil.copy(prm.get_register_map_path(prm.DEFAULT_REGISTER_MAP), self.map_path)
+        self.saved_index = prm._firmware_index
+        prm._firmware_index = [((5, 0, None), self.map_path)]
+        self.controller = pc.PataraControl()
+        self.selected = list()
+        self.controller.add_register_map_notifier(self.selected.append)
+        self.controller.process_input_registers(FakeResponse(4, registers=list(range(22))), min_addr=12)
+
+    def tearDown(self):
+        prm._firmware_index = self.saved_index
+        shutil.rmtree(self.tmp_dir)
+
+    def get_addresses(self):
+        patara_data = self.controller.patara_data
+        return [patara_data.get_parameter_address(name) for name in
+                ["sc_firmware_version_x", "sc_firmware_version_y", "sc_firmware_version_z"]]
+
+    def select_response(self, response):
+        addr_list = self.get_addresses()
+        return self.controller.select_register_map_cb(response, min_addr=min(addr_list), addr_list=addr_list)
+
+    def select(self, version):
+        addr_list = self.get_addresses()
+        min_addr = min(addr_list)
+        registers = [0] * (max(addr_list) - min_addr + 1)
+        for addr, v in zip(addr_list, version):
+            registers[addr - min_addr] = v
+        return self.select_response(FakeResponse(4, registers=registers))
+
+    def test_select_map(self):
+        self.assertEqual(self.select((5, 0, 3)), self.map_path)
+        self.assertEqual(self.selected, [self.map_path])
+        self.assertEqual(self.controller.register_map_name, self.map_path)
+        # Blocks decoded with the old map are dropped, the firmware version is published
+        self.assertEqual(len(self.controller.response_blocks), 0)
+        self.assertEqual(self.controller.get_parameter_value("sc_firmware_version_x").value, 5)
+        self.assertEqual(self.controller.get_parameter_value("channel1_sensed_current_flow"), None)
+
+    def test_keep_map(self):
+        self.assertEqual(self.select((4, 0, 3)), prm.DEFAULT_REGISTER_MAP)
+        self.assertEqual(self.selected, [])
+        self.assertEqual(len(self.controller.response_blocks), 1)
+        self.assertEqual(self.controller.get_parameter_value("sc_firmware_version_x").value, 4)
+
+    def test_unreadable_version(self):
+        # Modbus exception response, without registers
+        response = FakeResponse(132)
+        del response.registers
+        self.assertEqual(self.select_response(response), prm.DEFAULT_REGISTER_MAP)
+        self.assertEqual(self.selected, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
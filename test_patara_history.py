@@ -0,0 +1,226 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import patara_history as ph
+
+
+class VarintTest(unittest.TestCase):
+    def test_zigzag_round_trip(self):
+        for n in [0, 1, -1, 2, -2, 63, -64, 2 ** 31 - 1, -2 ** 31, 2 ** 40, -2 ** 40]:
+            z = ph.zigzag(n)
+            self.assertTrue(z >= 0)
+            self.assertEqual(ph.unzigzag(z), n)
+        self.assertEqual([ph.zigzag(n) for n in [0, -1, 1, -2, 2]], [0, 1, 2, 3, 4])
+
+    def test_varint_round_trip(self):
+        numbers = [0, 1, 127, 128, 255, 300, 16383, 16384, 2 ** 32 - 1, 2 ** 50]
+        buf = bytearray()
+        for n in numbers:
+            ph.put_varint(buf, n)
+        pos = 0
+        for n in numbers:
+            (v, pos) = ph.get_varint(buf, pos)
+            self.assertEqual(v, n)
+        self.assertEqual(pos, len(buf))
+
+    def test_varint_size(self):
+        for (n, size) in [(0, 1), (127, 1), (128, 2), (16383, 2), (16384, 3)]:
+            buf = bytearray()
+            ph.put_varint(buf, n)
+            self.assertEqual(len(buf), size)
+
+
+class CompressedHistoryTest(unittest.TestCase):
+    def make_records(self, count, n_values=4):
+        rng = np.random.RandomState(0)
+        values = np.zeros((count, n_values), dtype=np.int64)
+        row = rng.randint(0, 65536, n_values)
+        for rec in range(count):
+            # Few values change per record, some by large steps
+            ind = rng.randint(0, n_values)
+            row[ind] = rng.randint(0, 65536)
+            values[rec, :] = row
+        timestamps = 1000.0 + 0.3 * np.arange(count)
+        sequences = 1 + 3 * np.arange(count)
+        return sequences, timestamps, values
+
+    def test_round_trip(self):
+        (sequences, timestamps, values) = self.make_records(25)
+        history = ph.CompressedHistory(4, keyframe_interval=10)
+        for rec in range(len(sequences)):
+            history.append(int(sequences[rec]), timestamps[rec], values[rec])
+        (s, t, v) = history.read_range()
+        self.assertTrue(np.array_equal(s, sequences))
+        self.assertTrue(np.allclose(t, timestamps, atol=1e-3))
+        self.assertTrue(np.array_equal(v, values))
+        self.assertEqual(len(history.chunks), 3)
+
+    def test_read_range_and_at(self):
+        (sequences, timestamps, values) = self.make_records(25)
+        history = ph.CompressedHistory(4, keyframe_interval=10)
+        for rec in range(len(sequences)):
+            history.append(int(sequences[rec]), timestamps[rec], values[rec])
+        (s, t, v) = history.read_range(timestamps[8], timestamps[12])
+        self.assertTrue(np.array_equal(s, sequences[8:13]))
+        self.assertTrue(np.array_equal(v, values[8:13]))
+        (s, t, v) = history.read_at(timestamps[15] + 0.1)
+        self.assertEqual(s, sequences[15])
+        self.assertTrue(np.array_equal(v, values[15]))
+        self.assertEqual(history.read_at(timestamps[0] - 1.0), None)
+
+    def test_max_bytes(self):
+        (sequences, timestamps, values) = self.make_records(100)
+        history = ph.CompressedHistory(4, keyframe_interval=10, max_bytes=200)
+        for rec in range(len(sequences)):
+            history.append(int(sequences[rec]), timestamps[rec], values[rec])
+        self.assertTrue(history.get_size() <= 200 or len(history.chunks) == 1)
+        (s, t, v) = history.read_range()
+        self.assertEqual(s[-1], sequences[-1])
+        self.assertTrue(np.array_equal(v, values[-len(s):]))
+        self.assertAlmostEqual(history.get_oldest_time(), t[0], places=3)
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "history.dat")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fill(self, store, count):
+        for rec in range(count):
+            store.append(rec + 1, 100.0 + rec, [rec, 2 * rec, 7])
+
+    def test_wraparound(self):
+        store = ph.HistoryStore(self.path, 4, 12, 3, capacity=10)
+        self.fill(store, 25)
+        (s, t, v) = store.read_range()
+        self.assertTrue(np.array_equal(s, np.arange(16, 26)))
+        self.assertTrue(np.array_equal(t, 100.0 + np.arange(15, 25)))
+        self.assertTrue(np.array_equal(v[:, 1], 2 * np.arange(15, 25)))
+        self.assertEqual(store.get_oldest_time(), 115.0)
+        (s, t, v) = store.read_range(118.0, 121.5)
+        self.assertTrue(np.array_equal(s, np.arange(19, 23)))
+        self.assertEqual(store.read_at(121.5)[0], 22)
+        self.assertEqual(store.read_at(114.0), None)
+        store.close()
+
+    def test_reopen(self):
+        store = ph.HistoryStore(self.path, 4, 12, 3, capacity=10)
+        self.fill(store, 13)
+        store.close()
+        store = ph.HistoryStore(self.path, 4, 12, 3, capacity=10)
+        (s, t, v) = store.read_range()
+        self.assertTrue(np.array_equal(s, np.arange(4, 14)))
+        store.append(14, 113.0, [13, 26, 7])
+        self.assertEqual(store.read_range()[0][-1], 14)
+        store.close()
+        store = ph.HistoryStore(self.path, readonly=True)
+        self.assertEqual((store.func, store.min_addr, store.n_values, store.capacity), (4, 12, 3, 10))
+        self.assertTrue(np.array_equal(store.read_range()[0], np.arange(5, 15)))
+        store.close()
+
+    def test_reopen_other_layout(self):
+        store = ph.HistoryStore(self.path, 4, 12, 3, capacity=10)
+        self.fill(store, 5)
+        store.close()
+        store = ph.HistoryStore(self.path, 4, 12, 4, capacity=10)
+        self.assertEqual(len(store.read_range()[0]), 0)
+        store.close()
+
+    def test_interrupted_record(self):
+        store = ph.HistoryStore(self.path, 4, 12, 3, capacity=10)
+        self.fill(store, 5)
+        # A record with sequence 0 was not completely written
+        store.records["sequence"][4] = 0
+        self.assertTrue(np.array_equal(store.read_range()[0], np.arange(1, 5)))
+        self.assertEqual(store.read_at(110.0)[0], 4)
+        store.close()
+
+
+class BlockAggregatorTest(unittest.TestCase):
+    def test_windows(self):
+        aggregator = ph.BlockAggregator(["a", "b"], [1.0, 2.0])
+        self.assertEqual(aggregator.get_aggregate("a", 1.0), None)
+        samples = [(10.0, 1.0), (10.5, 3.0), (11.0, 5.0), (11.5, 7.0), (12.0, 0.0)]
+        for (t, v) in samples:
+            aggregator.add([v, -v], t)
+        result = aggregator.get_aggregate("a", 1.0)
+        self.assertEqual(result["count"], 2)
+        self.assertEqual(result["time"], 12.0)
+        self.assertEqual((result["min"], result["max"], result["mean"]), (5.0, 7.0, 6.0))
+        self.assertAlmostEqual(result["std"], 1.0)
+        result = aggregator.get_aggregate("a", 2.0)
+        self.assertEqual(result["count"], 4)
+        self.assertEqual(result["mean"], 4.0)
+        self.assertAlmostEqual(result["std"], np.std([1.0, 3.0, 5.0, 7.0]))
+        self.assertEqual(aggregator.get_aggregate("b", 2.0)["min"], -7.0)
+
+    def test_add_repeat(self):
+        aggregator = ph.BlockAggregator(["a"], [1.0])
+        aggregator.add_repeat(10.0)
+        aggregator.add([2.0], 10.1)
+        aggregator.add_repeat(10.6)
+        aggregator.add_repeat(11.0)
+        result = aggregator.get_aggregate("a", 1.0)
+        self.assertEqual(result["count"], 2)
+        self.assertEqual(result["std"], 0.0)
+
+    def test_large_offset(self):
+        aggregator = ph.BlockAggregator(["a"], [1.0])
+        rng = np.random.RandomState(0)
+        values = 1e6 + 1e-3 * rng.normal(size=100)
+        for ind, v in enumerate(values):
+            aggregator.add([v], 10.0 + 0.01 * ind)
+        aggregator.add([0.0], 11.0)
+        result = aggregator.get_aggregate("a", 1.0)
+        self.assertAlmostEqual(result["std"] / np.std(values), 1.0, places=6)
+
+
+class FaultCaptureTest(unittest.TestCase):
+    def test_pre_post_counts(self):
+        capture = ph.FaultCapture(pre_trigger=5, post_trigger=3)
+        key_a = (4, 12, 2)
+        key_b = (2, 0, 3)
+        sequence = 0
+        for cycle in range(10):
+            sequence += 1
+            self.assertFalse(capture.add(key_a, sequence, float(cycle), [cycle, cycle]))
+            sequence += 1
+            self.assertFalse(capture.add(key_b, sequence, float(cycle), [1, 0, 1]))
+        self.assertTrue(capture.trigger(9.5, "fault_state"))
+        self.assertFalse(capture.trigger(9.6, "again"))
+        done = False
+        for cycle in range(10, 13):
+            sequence += 1
+            self.assertFalse(capture.add(key_a, sequence, float(cycle), [cycle, cycle]))
+            sequence += 1
+            done = capture.add(key_b, sequence, float(cycle), [1, 1, 1])
+        # Complete when every block has its post-trigger cycles
+        self.assertTrue(done)
+        result = capture.freeze()
+        self.assertEqual(str(result["trigger_reason"]), "fault_state")
+        timestamps = result["block_4_12_2_timestamp"]
+        self.assertEqual(len(timestamps), 8)
+        self.assertEqual(np.sum(timestamps < 9.5), 5)
+        self.assertEqual(np.sum(timestamps > 9.5), 3)
+        self.assertTrue(np.array_equal(result["block_4_12_2_values"][:, 0], np.arange(5, 13)))
+        self.assertEqual(len(result["block_2_0_3_sequence"]), 8)
+        # Rearmed after freeze
+        self.assertTrue(capture.trigger(20.0, "fault_state"))
+
+    def test_post_trigger_timeout(self):
+        capture = ph.FaultCapture(pre_trigger=2, post_trigger=10, post_trigger_timeout=5.0)
+        capture.add((4, 12, 1), 1, 0.0, [0])
+        capture.trigger(0.5, "fault_state")
+        self.assertFalse(capture.add((4, 12, 1), 2, 1.0, [1]))
+        self.assertTrue(capture.add((4, 12, 1), 3, 6.0, [2]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+
+import patara_parameters as pp
+
+
+class CompositeParameterTest(unittest.TestCase):
+    def setUp(self):
+        self.patara_data = pp.PataraHardwareParameters()
+
+    def test_set_words(self):
+        p = pp.PataraCompositeParameter("counter", 30, 31, 4, conversion_factor=2.0)
+        p.set_words(0x1234, 0xabcd, 10.0)
+        self.assertEqual(p.raw_value, 0x1234abcd)
+        self.assertEqual(p.get_value(), 2.0 * 0x1234abcd)
+        self.assertEqual(p.get_timestamp(), 10.0)
+        self.assertEqual(p.get_addresses(), (30, 31))
+
+    def test_decode_from_block(self):
+        data = [0] * 22
+        # Shot counter high and low words at 30 and 31, block starting at 12
+        data[30 - 12] = 0x0001
+        data[31 - 12] = 0x0002
+        updated = self.patara_data.set_composites_from_modbus_block(4, 12, data, 5.0)
+        names = [p.name for p in updated]
+        self.assertTrue("channel1_pulsed_mode_shot_counter" in names)
+        p = self.patara_data.parameters["channel1_pulsed_mode_shot_counter"]
+        self.assertEqual(p.raw_value, 0x00010002)
+        self.assertAlmostEqual(p.get_value(), p.factor * 0x00010002)
+        self.assertEqual(p.get_timestamp(), 5.0)
+
+    def test_low_word_outside_block(self):
+        # Block ends at the high word of the shot counter, so it must not be decoded
+        data = [0] * (31 - 12)
+        updated = self.patara_data.set_composites_from_modbus_block(4, 12, data, 5.0)
+        self.assertFalse("channel1_pulsed_mode_shot_counter" in [p.name for p in updated])
+        self.assertEqual(self.patara_data.parameters["channel1_pulsed_mode_shot_counter"].get_value(), None)
+
+    def test_wrong_function(self):
+        updated = self.patara_data.set_composites_from_modbus_block(3, 12, [1] * 22, 5.0)
+        self.assertFalse("channel1_pulsed_mode_shot_counter" in [p.name for p in updated])
+
+    def test_words_keep_separate_parameters(self):
+        data = [0] * 22
+        data[24 - 12] = 3
+        data[25 - 12] = 7
+        for addr, reg in enumerate(data):
+            self.patara_data.set_parameter_from_modbus_addr(4, addr + 12, reg, 1.0)
+        self.patara_data.set_composites_from_modbus_block(4, 12, data, 1.0)
+        self.assertEqual(self.patara_data.parameters["channel1_warranty_timer_high"].get_value(), 3)
+        self.assertEqual(self.patara_data.parameters["channel1_warranty_timer_low"].get_value(), 7)
+        p = self.patara_data.parameters["channel1_warranty_timer"]
+        self.assertAlmostEqual(p.get_value(), p.factor * ((3 << 16) | 7))
+
+
+class DerivedParameterTest(unittest.TestCase):
+    def test_rate(self):
+        p = pp.PataraDerivedParameter("rate", "counter", conversion_factor=1.0, modulus=2 ** 32, min_interval=10.0)
+        self.assertFalse(p.update(1000, 0.0))
+        # First change starts the window
+        self.assertFalse(p.update(1100, 5.0))
+        self.assertFalse(p.update(1500, 10.0))
+        self.assertTrue(p.update(2100, 15.0))
+        self.assertAlmostEqual(p.get_value(), 100.0)
+        # Later samples refresh the timestamp
+        self.assertTrue(p.update(2200, 16.0))
+        self.assertAlmostEqual(p.get_value(), 100.0)
+        self.assertEqual(p.get_timestamp(), 16.0)
+
+    def test_wraparound(self):
+        p = pp.PataraDerivedParameter("rate", "counter", min_interval=1.0)
+        p.update(2 ** 32 - 10, 0.0)
+        p.update(2 ** 32 - 5, 1.0)
+        self.assertTrue(p.update(15, 3.0))
+        self.assertAlmostEqual(p.get_value(), 10.0)
+
+    def test_reset(self):
+        p = pp.PataraDerivedParameter("rate", "counter", min_interval=1.0)
+        p.update(1000, 0.0)
+        p.update(1010, 1.0)
+        self.assertFalse(p.update(10, 2.0))
+        self.assertFalse(p.update(30, 4.0))
+        self.assertTrue(p.update(50, 6.0))
+        self.assertAlmostEqual(p.get_value(), 10.0)
+
+    def test_coarse_counter(self):
+        # 10 shots/s on a counter with 1000 shot LSB, polled every 0.3 s
+        p = pp.PataraDerivedParameter("rate", "counter", conversion_factor=1000.0, min_interval=10.0)
+        rates = list()
+        t = 0.0
+        while t < 2000.0:
+            shots = 123456 + 10.0 * t
+            if p.update(int(shots // 1000), t) is True:
+                rates.append((t, p.get_value()))
+            t += 0.3
+        # A rate is available after two counter changes
+        self.assertTrue(rates[0][0] < 250.0)
+        for (t, rate) in rates:
+            self.assertAlmostEqual(rate, 10.0, delta=0.05)
+
+    def test_stopped_counter(self):
+        p = pp.PataraDerivedParameter("rate", "counter", min_interval=10.0, max_interval=100.0)
+        p.update(0, 0.0)
+        p.update(1, 5.0)
+        p.update(3, 25.0)
+        self.assertAlmostEqual(p.get_value(), 0.1)
+        p.update(3, 100.0)
+        self.assertAlmostEqual(p.get_value(), 0.1)
+        p.update(3, 125.0)
+        self.assertEqual(p.get_value(), 0.0)
+        # Restarting counter starts a new window
+        p.update(4, 300.0)
+        self.assertEqual(p.get_value(), 0.0)
+        p.update(6, 320.0)
+        self.assertAlmostEqual(p.get_value(), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
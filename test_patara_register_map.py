@@ -0,0 +1,211 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import patara_register_map as prm
+
+# Parameter table of the hand-written PataraHardwareParameters that edrive_default.csv replaced:
+# (name, func, address, factor, read_rate)
+BASELINE_PARAMETERS = [
+    ("emission", 1, 0, 1.0, 3.0),
+    ("enable_standby", 1, 1, 1.0, 3.0),
+    ("external_trigger", 1, 2, 1.0, 3.0),
+    ("internal_trigger_gating", 1, 3, 1.0, 3.0),
+    ("shutter", 1, 4, 1.0, 3.0),
+    ("clear_fault", 1, 5, 1.0, 3.0),
+    ("qsv_enable", 1, 6, 1.0, 3.0),
+    ("fps_enable", 1, 7, 1.0, 3.0),
+    ("fps_ppk_enable", 1, 8, 1.0, 3.0),
+    ("shutter_fps_enable", 1, 9, 1.0, 3.0),
+    ("marking_mode_trigger", 1, 10, 1.0, 3.0),
+    ("front_panel_locked_out", 1, 11, 1.0, 3.0),
+    ("tec_enable", 1, 12, 1.0, 3.0),
+    ("channel1_enable", 1, 16, 1.0, 3.0),
+    ("channel1_mode", 1, 17, 1.0, 3.0),
+    ("channel1_ramp_control", 1, 18, 1.0, 3.0),
+    ("channel1_slew_rate_control", 1, 19, 1.0, 3.0),
+    ("channel_com0_enable", 1, 40, 1.0, 3.0),
+    ("channel_com0_slew_enable", 1, 41, 1.0, 3.0),
+    ("channel_com0_tec_enable", 1, 42, 1.0, 3.0),
+    ("channel_com1_enable", 1, 48, 1.0, 3.0),
+    ("channel_com1_slew_enable", 1, 49, 1.0, 3.0),
+    ("channel_com1_tec_enable", 1, 50, 1.0, 3.0),
+    ("fault_state", 2, 0, 1.0, 3.0),
+    ("off_state", 2, 1, 1.0, 3.0),
+    ("standby_state", 2, 2, 1.0, 3.0),
+    ("pre-fire_state", 2, 3, 1.0, 3.0),
+    ("active_state", 2, 4, 1.0, 3.0),
+    ("channel1_present", 2, 5, 1.0, 3.0),
+    ("channel2_present", 2, 6, 1.0, 3.0),
+    ("channel3_present", 2, 7, 1.0, 3.0),
+    ("chiller_flow_fault", 2, 8, 1.0, 3.0),
+    ("chiller_level_fault", 2, 9, 1.0, 3.0),
+    ("emergency_stop_fault", 2, 10, 1.0, 3.0),
+    ("q-switch_fault", 2, 11, 1.0, 3.0),
+    ("channel1_fault", 2, 12, 1.0, 3.0),
+    ("channel2_fault", 2, 13, 1.0, 3.0),
+    ("channel3_fault", 2, 14, 1.0, 3.0),
+    ("front_panel_fault", 2, 15, 1.0, 3.0),
+    ("laser_cover_interlock", 2, 16, 1.0, 3.0),
+    ("laser_coolant_flow_interlock", 2, 17, 1.0, 3.0),
+    ("q-switch_thermal_interlock", 2, 18, 1.0, 3.0),
+    ("q-switch_driver_thermal_fault", 2, 19, 1.0, 3.0),
+    ("q-switch_crystal_thermal_interlock", 2, 20, 1.0, 3.0),
+    ("q-switch_hvswr_fault", 2, 21, 1.0, 3.0),
+    ("q-switch_high_power_fault", 2, 22, 1.0, 3.0),
+    ("laser_shutter_state", 2, 23, 1.0, 3.0),
+    ("tec_present", 2, 24, 1.0, 3.0),
+    ("tec_fault", 2, 25, 1.0, 3.0),
+    ("tec_tolerance_fault", 2, 26, 1.0, 3.0),
+    ("tec_comm_fault", 2, 27, 1.0, 3.0),
+    ("shutter_interlock_fault", 2, 28, 1.0, 3.0),
+    ("tec_open_rtd_fault", 2, 29, 1.0, 3.0),
+    ("tec_over_heat_fault", 2, 30, 1.0, 3.0),
+    ("tec_under_voltage_fault", 2, 31, 1.0, 3.0),
+    ("channel1_off_state", 2, 32, 1.0, 3.0),
+    ("channel1_standby", 2, 33, 1.0, 3.0),
+    ("channel1_active", 2, 34, 1.0, 3.0),
+    ("channel1_fault_state", 2, 35, 1.0, 3.0),
+    ("channel1_state_mismatch_fault", 2, 36, 1.0, 3.0),
+    ("channel1_comm_fault", 2, 37, 1.0, 3.0),
+    ("channel1_hardware_fault", 2, 38, 1.0, 3.0),
+    ("channel1_e-stop_fault", 2, 39, 1.0, 3.0),
+    ("channel1_comm_timeout_fault", 2, 40, 1.0, 3.0),
+    ("channel1_interlock_fault", 2, 41, 1.0, 3.0),
+    ("channel1_temp_fault", 2, 42, 1.0, 3.0),
+    ("channel1_overcurrent_fault", 2, 43, 1.0, 3.0),
+    ("channel1_low_voltage_fault", 2, 44, 1.0, 3.0),
+    ("channel1_current_tolerance_fault", 2, 45, 1.0, 3.0),
+    ("com0_off_state", 2, 80, 1.0, 3.0),
+    ("com0_standby_state", 2, 81, 1.0, 3.0),
+    ("com0_active_state", 2, 82, 1.0, 3.0),
+    ("com0_fault_state", 2, 83, 1.0, 3.0),
+    ("com0_comm_fault", 2, 84, 1.0, 3.0),
+    ("com0_hardware_fault", 2, 85, 1.0, 3.0),
+    ("com0_temp_fault", 2, 86, 1.0, 3.0),
+    ("com0_tec_fault", 2, 87, 1.0, 3.0),
+    ("com0_tec_comm_fault", 2, 88, 1.0, 3.0),
+    ("com0_tec_tolerance_fault", 2, 89, 1.0, 3.0),
+    ("com0_tec_open_rtd_fault", 2, 91, 1.0, 3.0),
+    ("system_frequency", 3, 0, 1.0, -1.0),
+    ("trigger_out_config", 3, 10, 1.0, -1.0),
+    ("shutter_delay", 3, 14, 1e-06, -1.0),
+    ("channel1_active_current", 3, 16, 0.1, -1.0),
+    ("channel1_standby_current", 3, 17, 0.1, -1.0),
+    ("tec_temp_setting", 3, 88, 0.1, -1.0),
+    ("channel_com0_tec_temp_setting", 3, 104, 0.1, -1.0),
+    ("channel_com1_tec_temp_setting", 3, 120, 0.1, -1.0),
+    ("sc_firmware_version_x", 4, 0, 1.0, -1.0),
+    ("sc_firmware_version_y", 4, 1, 1.0, -1.0),
+    ("sc_firmware_version_z", 4, 2, 1.0, -1.0),
+    ("tec_sensed_temp", 4, 12, 0.1, 1.0),
+    ("tec_sensed_voltage", 4, 13, 0.01, 1.0),
+    ("tec_power", 4, 14, 0.1, -1.0),
+    ("channel1_firmware_version_x", 4, 16, 1.0, -1.0),
+    ("channel1_firmware_version_y", 4, 17, 1.0, -1.0),
+    ("channel1_firmware_version_z", 4, 18, 1.0, -1.0),
+    ("channel1_sensed_current_flow", 4, 19, 0.1, 2.0),
+    ("channel1_power_supply_voltage", 4, 20, 0.1, 1.0),
+    ("channel1_temperature", 4, 21, 0.1, 2.0),
+    ("channel1_current_limit", 4, 22, 0.1, -1.0),
+    ("channel1_warranty_timer_high", 4, 24, 1.0, 1.0),
+    ("channel1_warranty_timer_low", 4, 25, 1.0, 1.0),
+    ("channel1_pulsed_mode_shot_counter_high", 4, 30, 1.0, 2.0),
+    ("channel1_pulsed_mode_shot_counter_low", 4, 31, 1.0, 2.0),
+    ("channel1_pulsed_current_limit", 4, 32, 0.1, -1.0),
+    ("humidity_reading", 4, 33, 1.0, 1.0),
+    ("channel_com0_sensed_current", 4, 112, 0.1, 1.0),
+    ("channel_com0_tec_sensed_temp", 4, 115, 0.1, 1.0),
+    ("channel_com0_tec_sensed_voltage", 4, 116, 0.1, 1.0),
+    ("channel_com0_tec_power", 4, 117, 1.0, -1.0),
+    ("channel_com1_tec_sensed_temp", 4, 123, 0.1, 1.0),
+]
+
+BASELINE_READ_RANGES = {
+    1: [(0, 4, 3.0), (5, 50, -1.0)],
+    2: [(0, 91, 3.0)],
+    3: [(0, 17, -1.0), (88, 104, -1.0)],
+    4: [(12, 33, 3.0), (112, 117, 1.0), (0, 18, -1.0)],
+}
+
+
+class DefaultMapTest(unittest.TestCase):
+    def setUp(self):
+        self.reg_map = prm.load_register_map()
+
+    def test_parameter_parity(self):
+        specs = dict([(spec[0], spec) for spec in self.reg_map.parameter_specs])
+        self.assertEqual(len(specs), len(BASELINE_PARAMETERS))
+        for (name, func, addr, factor, read_rate) in BASELINE_PARAMETERS:
+            spec = specs[name]
+            self.assertEqual((spec[1], spec[2], spec[5]), (func, addr, read_rate), name)
+            self.assertAlmostEqual(spec[3], factor, msg=name)
+            self.assertEqual(spec[4], 0.0, name)
+
+    def test_table_parity(self):
+        for (name, func, addr, factor, read_rate) in BASELINE_PARAMETERS:
+            self.assertEqual(self.reg_map.tables[func][addr], name)
+        for func in [1, 2, 3, 4]:
+            self.assertEqual(len(self.reg_map.tables[func]),
+                             len([p for p in BASELINE_PARAMETERS if p[1] == func]))
+
+    def test_read_range_parity(self):
+        for func in [1, 2, 3, 4]:
+            self.assertEqual(self.reg_map.read_ranges[func], BASELINE_READ_RANGES[func])
+
+    def test_compiled_once(self):
+        self.assertTrue(prm.load_register_map() is self.reg_map)
+
+
+class FirmwareIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_index = prm._firmware_index
+
+    def tearDown(self):
+        prm._firmware_index = self.saved_index
+        shutil.rmtree(self.tmp_dir)
+
+    def write_index(self, rows):
+        path = os.path.join(self.tmp_dir, "firmware_maps.csv")
+        with open(path, "w") as index_file:
+            index_file.write("# Test index\n")
+            index_file.write("firmware_x,firmware_y,firmware_z,register_map\n")
+            for row in rows:
+                index_file.write("{0}\n".format(row))
+        return path
+
+    def test_shipped_index(self):
+        index = prm.load_firmware_index()
+        self.assertTrue(len(index) > 0)
+        self.assertEqual(index[-1], ((None, None, None), prm.DEFAULT_REGISTER_MAP))
+        prm._firmware_index = None
+        self.assertEqual(prm.get_register_map_name((1, 2, 3)), prm.DEFAULT_REGISTER_MAP)
+
+    def test_first_match_is_used(self):
+        path = self.write_index(["2,1,0,map_exact", "2,*,*,map_major", "*,*,*,map_any"])
+        index = prm.load_firmware_index(path)
+        self.assertEqual(index[0], ((2, 1, 0), "map_exact"))
+        self.assertEqual(index[1], ((2, None, None), "map_major"))
+        prm._firmware_index = index
+        self.assertEqual(prm.get_register_map_name((2, 1, 0)), "map_exact")
+        self.assertEqual(prm.get_register_map_name((2, 1, 1)), "map_major")
+        self.assertEqual(prm.get_register_map_name((2, 5, 7)), "map_major")
+        self.assertEqual(prm.get_register_map_name((3, 1, 0)), "map_any")
+
+    def test_no_match_gives_default(self):
+        path = self.write_index(["2,1,0,map_exact"])
+        prm._firmware_index = prm.load_firmware_index(path)
+        self.assertEqual(prm.get_register_map_name((1, 0, 0)), prm.DEFAULT_REGISTER_MAP)
+
+    def test_invalid_row(self):
+        path = self.write_index(["2,x,0,map_bad"])
+        self.assertRaises(prm.PataraRegisterMapError, prm.load_firmware_index, path)
+
+    def test_missing_index(self):
+        self.assertEqual(prm.load_firmware_index(os.path.join(self.tmp_dir, "missing.csv")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from twisted_cut import defer
+from test_patara_control import FakeClient, Result
+
+try:
+    import patara_state as ps
+except ImportError:
+    # The state handler needs PyTango and pymodbus
+    ps = None
+
+
+@unittest.skipIf(ps is None, "PyTango or pymodbus not installed")
+class StateMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = ps.PataraControl()
+        self.client = FakeClient()
+        self.controller.client = self.client
+        self.controller.init_client = self.reconnect
+
+    def reconnect(self):
+        self.controller.close_client()
+        self.controller.client = FakeClient()
+        return defer.succeed(True)
+
+    def test_write_completes_after_io(self):
+        msg = ps.StateMessage("set_tec_temperature")
+        msg.add_action(self.controller.write_parameter, "tec_temp_setting", value=39.2,
+                       process_now=True, readback=False)
+        self.client.release.clear()
+        result = Result(msg.execute_actions())
+        # Idle queue, the write starts at once but must not be reported done before it completes
+        self.assertFalse(result.event.is_set())
+        self.client.release.set()
+        self.assertTrue(result.wait())
+        self.assertFalse(result.failed)
+        self.assertEqual(self.client.registers[88], 392)
+
+    def test_failed_write(self):
+        msg = ps.StateMessage("set_temperatures")
+        msg.add_action(self.controller.write_parameter, "tec_temp_setting", value=39.2,
+                       process_now=True, readback=False)
+        msg.add_action(self.controller.write_parameter, "channel_com1_tec_temp_setting", value=25.0,
+                       process_now=True, readback=False)
+        self.client.fail_writes = True
+        self.client.release.clear()
+        result = Result(msg.execute_actions())
+        self.assertFalse(result.event.is_set())
+        self.client.release.set()
+        self.assertTrue(result.wait())
+        self.assertTrue(result.failed)
+        self.assertTrue(result.value.check(defer.FirstError) is not None)
+
+    def test_action_without_deferred(self):
+        msg = ps.StateMessage("status")
+        msg.add_action(self.controller.set_status, "Test")
+        result = Result(msg.execute_actions())
+        self.assertTrue(result.event.is_set())
+        self.assertFalse(result.failed)
+
+
+if __name__ == "__main__":
+    unittest.main()